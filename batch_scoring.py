@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy 版の一括採点
+------------------
+hand_total / role_breakdown のベクトル版。大量の手牌（分析・BOT調整・複数卓の清算）を
+まとめて採点する。結果はスカラー版（server.py）と完全に一致する:
+役判定は同じ hand_table のレコードを引き、ドラは牌IDごとの重みの和をとるだけ。
+
+    hands, lengths = encode_hands([[0, 8], [27], ...])
+    scores = score_hands(hands, lengths, compile_dora_weights(dora))
+    scores.totals   # float64  hand_total
+    scores.roles    # int64    role_breakdown(...)["total"]
+    scores.bust     # bool     ツモ以外で 10.5 超え
+"""
+
+from __future__ import annotations
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from hand_table import (
+    DEAD, MAX_BASE_HALF, MAX_EAST, OVER, TARGET_HALF, TSUMO_KINDS, HandTable, evaluate_signature, shared_table,
+)
+from tiles import EAST, NUM_TILE_TYPES, TILE_HALF, TILE_RANK
+
+PAD = NUM_TILE_TYPES  # 詰め物の牌ID（点数・ドラとも 0）。-1 で詰めてもよい
+
+RECORD_DTYPE = np.dtype([("total_half", "u1"), ("flags", "u1"), ("cutin", "u1"), ("pad", "u1"), ("role", "<u2")])
+
+_RANK = np.array(TILE_RANK + [-1], dtype=np.int64)
+
+# 牌ごとの (素点×2, 東, ドラ点) を1つの int64 に詰めて、1回の gather と和で集計する
+_EAST_SHIFT = 20
+_DORA_SHIFT = 40
+_FIELD_MASK = (1 << 20) - 1
+
+
+def _tile_codes(dora_weights: Sequence[int]) -> np.ndarray:
+    codes = [
+        TILE_HALF[t] | (int(t == EAST) << _EAST_SHIFT) | (int(dora_weights[t]) << _DORA_SHIFT)
+        for t in range(NUM_TILE_TYPES)
+    ]
+    return np.array(codes + [0], dtype=np.int64)  # 末尾が PAD（-1 もここを指す）
+
+
+class BatchScores(NamedTuple):
+    totals: np.ndarray   # float64
+    roles: np.ndarray    # int64（バーストは 0）
+    bust: np.ndarray     # bool
+    flags: np.ndarray    # uint8（hand_table の flags）
+
+
+def encode_hands(hands: Sequence[Sequence[int]], width: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """牌IDのリストのリスト -> (PAD 詰めの 2次元配列, 枚数)"""
+    lengths = np.fromiter((len(h) for h in hands), dtype=np.int64, count=len(hands))
+    w = width if width is not None else int(lengths.max(initial=0))
+    out = np.full((len(hands), w), PAD, dtype=np.int16)
+    for i, h in enumerate(hands):
+        out[i, : len(h)] = h
+    return out, lengths
+
+
+def score_hands(
+    hands: np.ndarray,
+    lengths: np.ndarray,
+    dora_weights: Sequence[int],
+    table: Optional[HandTable] = None,
+) -> BatchScores:
+    """(N, W) の牌ID配列と枚数からまとめて採点する。
+
+    lengths 以降の列は PAD（または -1）で埋めておくこと（encode_hands はそうする）。
+    """
+    table = table or shared_table()
+    hands = np.asarray(hands)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n, w = hands.shape
+
+    codes = _tile_codes(dora_weights)
+    packed = np.zeros(n, dtype=np.int64)
+    for j in range(w):
+        packed += codes[hands[:, j]]
+    base_half = packed & _FIELD_MASK
+    n_east = (packed >> _EAST_SHIFT) & _FIELD_MASK
+    dora = packed >> _DORA_SHIFT
+
+    kind_idx = np.zeros(n, dtype=np.int64)
+    if w >= 2:
+        a, b = hands[:, 0], hands[:, 1]
+        two = lengths == 2
+        kind_idx[two & (_RANK[a] == _RANK[b])] = TSUMO_KINDS.index(5)
+        kind_idx[two & (a == b)] = TSUMO_KINDS.index(10)
+
+    max_len = table.max_len
+    in_table = (lengths <= max_len) & (base_half <= MAX_BASE_HALF) & (n_east <= MAX_EAST)
+    slot = ((kind_idx * (max_len + 1) + lengths) * (MAX_EAST + 1) + n_east) * (MAX_BASE_HALF + 1) + base_half
+    slot[~in_table] = 0
+    recs = np.frombuffer(table.records(), dtype=RECORD_DTYPE)[slot]
+    total_half = recs["total_half"].astype(np.int64)
+    flags = recs["flags"]
+    role = recs["role"].astype(np.int64)
+
+    # 表の範囲外はほぼ全部「素点で 10.5 超え」のバースト（東の加点もツモもない）
+    outside = ~in_table
+    over = outside & (base_half > TARGET_HALF) & (lengths != 2)
+    total_half[over] = base_half[over]
+    flags[over] = OVER | DEAD
+    role[over] = 0
+    # それ以外（東5枚など通常ありえない手）はスカラーで計算して埋める
+    for i in np.flatnonzero(outside & ~over):
+        o = evaluate_signature(TSUMO_KINDS[kind_idx[i]], int(lengths[i]), int(n_east[i]), int(base_half[i]))
+        total_half[i], flags[i], role[i] = o.total_half, o.flags, o.role
+
+    bust = (flags & DEAD) != 0
+    roles = np.where(bust, 0, role + dora)
+    return BatchScores(total_half / 2.0, roles, bust, flags)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+BOT の手番のベンチマーク
+------------------------
+BOT のいるルームを --rooms 件、それぞれ --steps 手ずつ --interval 秒おきに動かし、CPU 時間と起床の遅れを比べる。
+1手の中身は数えるだけ（ルームの中身は動かさない）なので、差はスケジューリングの分だけ。
+
+    legacy   以前の実装: ルームごとに asyncio のタスクを立てて、1手ごとに asyncio.sleep(interval)
+    current  bot_scheduler.BotScheduler: 全ルームの期限を1つのヒープに積み、期限の来たルームをまとめて動かす
+
+    python -m bench.bots [--rooms 5000] [--steps 10] [--interval 0.35]
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import time
+from typing import List, Optional
+
+from bot_scheduler import BotScheduler
+
+
+def summarize(name: str, cpu: float, wakeups: int, avg_ms: float, p99_ms: float, max_ms: float) -> None:
+    print(f"{name:8s} cpu {cpu * 1e3:8.1f} ms  wakeups {wakeups:7d}  "
+          f"lag avg {avg_ms:6.2f} ms  p99 {p99_ms:6.2f} ms  max {max_ms:6.2f} ms")
+
+
+async def legacy(rooms: int, steps: int, interval: float) -> None:
+    loop = asyncio.get_running_loop()
+    lags: List[float] = []
+
+    async def run(i: int) -> None:
+        due = loop.time()
+        for _ in range(steps):
+            lags.append(max(0.0, loop.time() - due))
+            await asyncio.sleep(interval)
+            due += interval
+
+    c0 = time.process_time()
+    await asyncio.gather(*(run(i) for i in range(rooms)))
+    cpu = time.process_time() - c0
+    lags.sort()
+    summarize("legacy", cpu, rooms * steps, sum(lags) / len(lags) * 1e3,
+              lags[int(0.99 * (len(lags) - 1))] * 1e3, lags[-1] * 1e3)
+
+
+async def current(rooms: int, steps: int, interval: float) -> None:
+    left = {}
+
+    async def step(room_id: str) -> Optional[float]:
+        left[room_id] -= 1
+        return interval if left[room_id] else None
+
+    sched = BotScheduler(step, interval=interval)
+    c0 = time.process_time()
+    for i in range(rooms):
+        left[f"R{i:05d}"] = steps
+        sched.schedule(f"R{i:05d}")
+    while len(sched) or sched.running is not None:
+        await asyncio.sleep(interval)
+    cpu = time.process_time() - c0
+    st = sched.stats.as_dict()   # p99 は直近 LAG_WINDOW 手の分
+    summarize("current", cpu, st["wakeups"], st["lag_avg_ms"], st["lag_p99_ms"], st["lag_max_ms"])
+    print(f"{'':8s} rooms/wakeup {st['rooms_per_wakeup']}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rooms", type=int, default=5000)
+    ap.add_argument("--steps", type=int, default=10)
+    ap.add_argument("--interval", type=float, default=0.35)
+    args = ap.parse_args()
+    asyncio.run(legacy(args.rooms, args.steps, args.interval))
+    asyncio.run(current(args.rooms, args.steps, args.interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+ルーム作成のベンチマーク
+------------------------
+create_room / free_match（空き卓探し + 着席）を同時に大量に投げたときのスループットと、
+create_room 1回にかかった時間（dict のリサイズなどで止まった時間）を比べる。
+
+    legacy   以前の実装: グローバルロック + random.choices で空きIDを探す + 1つの dict
+    current  server.RoomManager: ロック無し + 連番の置換でID + シャード分けした表。
+             free_match は matchmaking.MatchPool で同じ周回の到着をまとめて着席させる
+             （BOT 補充・開局まで本番と同じに行うので、その分 ops/s は legacy より下がる）
+
+表への1件の追加で一番長く止まった時間（dict のリサイズ）も、1つの dict とシャード分けで比べる。
+最後に、空きのあるフリールームの数を変えて free_match 1回（1人ずつ到着）の時間を測る。
+
+    python -m bench.rooms [--burst 20000] [--rooms 200000] [--no-gc]
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import gc
+import random
+import string
+import time
+from typing import Dict, List, Optional
+
+from engine import Player, Room
+from room_table import ShardedRooms
+from server import RoomManager
+
+
+class LegacyRoomManager:
+    """比較用: 以前の RoomManager の作成まわり"""
+
+    def __init__(self) -> None:
+        self.rooms: Dict[str, Room] = {}
+        self._global_lock = asyncio.Lock()
+        self.free_room_id: Optional[str] = None
+
+    @staticmethod
+    def gen_room_id(n: int = 6) -> str:
+        return "".join(random.choices(string.ascii_uppercase + string.digits, k=n))
+
+    async def create_room(self) -> Room:
+        async with self._global_lock:
+            while True:
+                rid = self.gen_room_id()
+                if rid not in self.rooms:
+                    room = Room(room_id=rid, lock=asyncio.Lock())
+                    self.rooms[rid] = room
+                    return room
+
+    async def get_free_room(self) -> Room:
+        async with self._global_lock:
+            room = self.rooms.get(self.free_room_id) if self.free_room_id else None
+            if room and room.seats_filled() < 4:
+                return room
+            while True:
+                rid = self.gen_room_id()
+                if rid not in self.rooms:
+                    room = Room(room_id=rid, is_free_match=True, lock=asyncio.Lock())
+                    self.rooms[rid] = room
+                    self.free_room_id = rid
+                    return room
+
+
+async def _burst(manager, n: int, slowest: List[float]) -> None:
+    """create_room と free_match を半々で n 件同時に"""
+    async def create(i: int) -> None:
+        t0 = time.perf_counter()
+        await manager.create_room()
+        slowest.append(time.perf_counter() - t0)
+
+    async def free_match(i: int) -> None:
+        if isinstance(manager, LegacyRoomManager):
+            room = await manager.get_free_room()
+            async with room.lock:
+                seat = next(s for s, v in room.seat_to_sid.items() if v is None)
+                room.players_by_sid[f"s{i}"] = Player(sid=f"s{i}", name="p", seat_index=seat)
+                room.seat_to_sid[seat] = f"s{i}"
+        else:
+            await manager.pool.join(f"s{i}", "p")   # 同じ周回の到着をまとめて着席
+
+    await asyncio.gather(*((create if i % 2 else free_match)(i) for i in range(n)))
+
+
+async def run(factory, burst: int, total: int) -> dict:
+    manager = factory()
+    slowest: List[float] = []
+    t0 = time.perf_counter()
+    done = 0
+    while done < total:
+        await _burst(manager, burst, slowest)
+        done += burst
+    elapsed = time.perf_counter() - t0
+    slowest.sort()
+    return {
+        "rooms": len(manager.rooms),
+        "ops_per_s": done / elapsed,
+        "p99_us": slowest[int(len(slowest) * 0.99)] * 1e6,
+        "max_ms": slowest[-1] * 1e3,
+    }
+
+
+def worst_insert_ms(table, n: int) -> float:
+    worst = 0.0
+    for i in range(n):
+        key = f"R{i:08d}"
+        t0 = time.perf_counter()
+        table[key] = i
+        worst = max(worst, time.perf_counter() - t0)
+    return worst * 1e3
+
+
+async def join_latency_us(open_rooms: int, joins: int = 2000) -> float:
+    """空きのあるフリールームが open_rooms 卓あるところへ1人ずつ来たときの、1回あたりの時間"""
+    manager = RoomManager()
+    for i in range(open_rooms):
+        room = manager.new_room(is_free_match=True)
+        for k in range(1 + i % 3):
+            manager.add_player_locked(room, Player(sid=f"w{i}-{k}", name="p", seat_index=k))
+        manager.pool.offer(room)
+    t0 = time.perf_counter()
+    for i in range(joins):
+        await manager.pool.join(f"s{i}", "p")
+    return (time.perf_counter() - t0) / joins * 1e6
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--burst", type=int, default=20000, help="同時に投げる件数")
+    ap.add_argument("--rooms", type=int, default=200000, help="合計の作成・参加件数")
+    ap.add_argument("--no-gc", action="store_true", help="GC を止めて測る（GC の停止時間を除く）")
+    args = ap.parse_args()
+    if args.no_gc:
+        gc.disable()
+    print(f"{'impl':<8} {'rooms':>8} {'ops/s':>10} {'create p99 us':>14} {'max ms':>8}")
+    for name, factory in (("legacy", LegacyRoomManager), ("current", RoomManager)):
+        r = asyncio.run(run(factory, args.burst, args.rooms))
+        print(f"{name:<8} {r['rooms']:>8} {r['ops_per_s']:>10.0f} {r['p99_us']:>14.1f} {r['max_ms']:>8.2f}")
+    n = args.rooms * 10
+    print(f"worst single insert into {n} entries: dict {worst_insert_ms({}, n):.2f} ms, "
+          f"sharded {worst_insert_ms(ShardedRooms(), n):.2f} ms")
+    for open_rooms in (100, 10000, 100000):
+        print(f"free_match with {open_rooms:>6} open rooms: {asyncio.run(join_latency_us(open_rooms)):.1f} us/join")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+スナップショットのベンチマーク
+------------------------------
+対局中のルーム（4人・配牌済み・チャット履歴あり）を --rooms 件作り、snapshot.py の各段階の時間とサイズを測る。
+
+    capture   値へのコピーの合計と、CAPTURE_CHUNK 件ごとにイベントループを止める最長の時間
+    save      encode + 書き込み（fsync・置き換えまで。スレッドで動く部分）
+    load      読み込み + Room への復元
+
+    python -m bench.snapshot [--rooms 10000] [--path /tmp/toppan-bench.snapshot]
+"""
+
+from __future__ import annotations
+import argparse
+import os
+import time
+
+import snapshot
+from chatlog import ChatHistory
+from engine import Player, Room, _new_game_locked
+
+
+def make_rooms(n: int) -> list:
+    rooms = []
+    for i in range(n):
+        room = Room(room_id=f"R{i:05d}")
+        for seat in range(4):
+            sid = f"s{i}-{seat}"
+            room.players_by_sid[sid] = Player(sid=sid, name=f"P{seat}", seat_index=seat, is_bot=seat == 3)
+            room.seat_to_sid[seat] = sid
+        room.host_sid = room.seat_to_sid[0]
+        _new_game_locked(room)
+        st = room.state
+        for p in room.players():
+            p.hand.extend([st.wall.pop(), st.wall.pop()])
+            p.bet_points = 10
+        st.phase = "playing"
+        st.turn_seat = 1
+        room.chat_log = ChatHistory()
+        for k in range(10):
+            room.chat_log.append({"name": "P1", "seat": 1, "message": f"msg {k}"})
+        rooms.append(room)
+    return rooms
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rooms", type=int, default=10000)
+    ap.add_argument("--path", default="/tmp/toppan-bench.snapshot")
+    args = ap.parse_args()
+
+    rooms = make_rooms(args.rooms)
+    captured, pauses = [], []
+    t0 = time.perf_counter()
+    for i in range(0, len(rooms), snapshot.CAPTURE_CHUNK):
+        c0 = time.perf_counter()
+        captured += snapshot.capture(rooms[i:i + snapshot.CAPTURE_CHUNK])
+        pauses.append(time.perf_counter() - c0)
+    t1 = time.perf_counter()
+    size = snapshot.save(args.path, captured)
+    t2 = time.perf_counter()
+    restored, _ = snapshot.load(args.path)
+    t3 = time.perf_counter()
+    assert len(restored) == len(rooms)
+    assert snapshot.capture(restored[:1]) == captured[:1]
+    os.unlink(args.path)
+    print(f"{args.rooms} rooms, {size / 1e6:.2f} MB ({size / args.rooms:.0f} B/room)")
+    print(f"capture {(t1 - t0) * 1e3:8.1f} ms  (event loop, longest pause {max(pauses) * 1e3:.1f} ms "
+          f"per {snapshot.CAPTURE_CHUNK} rooms)")
+    print(f"save    {(t2 - t1) * 1e3:8.1f} ms  (thread)")
+    print(f"load    {(t3 - t2) * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
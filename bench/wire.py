@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Socket.IO 直列化のベンチマーク
+------------------------------
+4人卓を数ラウンド回して実際の state（スナップショット / パッチ）を集め、
+json / orjson / msgpack（入っていれば）ごとに1パケットのエンコード時間とバイト数、
+4人へのブロードキャストを「1人ずつエンコード」と「同じパケットをまとめて1回」で比べる。
+
+    python -m bench.wire [--rounds 20] [--repeat 200]
+"""
+
+from __future__ import annotations
+import argparse
+import importlib.util
+import json
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+from socketio import packet
+
+from engine import GameState, Player, Room, _draw_tile_for_player, _end_round, _prepare_betting_phase, \
+    _start_playing_phase, _stay_for_player, drain_effects
+from server import _viewer_payload, _viewer_variant, build_state_payload
+from state_sync import ViewerSync
+from wire import OrjsonCodec, orjson
+
+SIDS = ("s0", "s1", "s2", "s3")
+
+
+def _room(seed: int) -> Room:
+    room = Room(room_id="BENCH")
+    for i, sid in enumerate(SIDS):
+        room.players_by_sid[sid] = Player(sid=sid, name=f"player{i}", seat_index=i, points=300)
+        room.seat_to_sid[i] = sid
+    room.host_sid = SIDS[0]
+    room.state = GameState(dealer_seat=0)
+    room.state.shuffle_wall(seed)
+    return room
+
+
+def collect(rounds: int) -> List[List[Tuple[object, str, dict]]]:
+    """ブロードキャストごとの [(共有キー, event, data)]。全員がすぐ ack する想定
+
+    共有キーは server.emit_room_state と同じ決め方で、None 以外の同じキーは同じパケットになる。
+    """
+    room = _room(1)
+    syncs = {sid: ViewerSync() for sid in SIDS}
+    broadcasts = []
+
+    def broadcast() -> None:
+        public = build_state_payload(room)
+        room.state_version += 1
+        out = []
+        for sid in SIDS:
+            payload = _viewer_payload(room, public, sid)
+            variant = _viewer_variant(public, payload)
+            key = syncs[sid].share_key(variant) if type(variant) is not tuple else None
+            event, data = syncs[sid].packet(room.state_version, payload, variant)
+            out.append((key if event == "state_patch" else None, event, json.loads(json.dumps(data))))
+            syncs[sid].ack(room.state_version)
+        broadcasts.append(out)
+
+    for _ in range(rounds):
+        _prepare_betting_phase(room)
+        broadcast()
+        for p in room.players():
+            if p.seat_index != room.state.dealer_seat:
+                p.bet_points = 5
+        _start_playing_phase(room)
+        broadcast()
+        while room.state.phase == "playing":
+            p = room.players_by_sid[room.seat_to_sid[room.state.turn_seat]]
+            if len(p.hand) < 3 and len(room.state.wall) > 0:
+                _draw_tile_for_player(room, p)
+            else:
+                _stay_for_player(room, p)
+            broadcast()
+        if room.state.phase != "ended":
+            _end_round(room)
+        drain_effects(room)
+        broadcast()
+    return broadcasts
+
+
+def _encoders() -> Dict[str, callable]:
+    def text(codec):
+        def enc(event: str, data: dict):
+            packet.Packet.json = codec
+            return packet.Packet(packet.EVENT, data=[event, data], namespace="/").encode()
+        return enc
+
+    encoders = {"json": text(json)}
+    if orjson is not None:
+        encoders["orjson"] = text(OrjsonCodec)
+    if importlib.util.find_spec("msgpack") is not None:
+        from socketio.msgpack_packet import MsgPackPacket
+        encoders["msgpack"] = lambda event, data: MsgPackPacket(packet.EVENT, data=[event, data], namespace="/").encode()
+    return encoders
+
+
+def _time(fn, items, repeat: int) -> float:
+    """items 全部をエンコードする時間（秒）の中央値"""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for item in items:
+            fn(*item)
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rounds", type=int, default=20)
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+
+    broadcasts = collect(args.rounds)
+    packets = [(event, data) for b in broadcasts for _, event, data in b]
+    snapshots = [x for x in packets if x[0] == "state"]
+    patches = [x for x in packets if x[0] == "state_patch"]
+    # まとめ送り: 共有キーが同じパケットは1回だけエンコードする（server.emit_room_state と同じ）
+    grouped = []
+    for b in broadcasts:
+        seen = set()
+        for key, event, data in b:
+            if key is None or key not in seen:
+                seen.add(key)
+                grouped.append((event, data))
+
+    print(f"{len(broadcasts)} broadcasts x {len(SIDS)} viewers: "
+          f"{len(snapshots)} snapshots, {len(patches)} patches, {len(grouped)} encoded when shared")
+    print(f"{'serializer':<10} {'snapshot us':>12} {'bytes':>7} {'patch us':>9} {'bytes':>7} "
+          f"{'bcast per-sid us':>17} {'bcast shared us':>16}")
+    for name, enc in _encoders().items():
+        snap_us = _time(enc, snapshots, args.repeat) / max(len(snapshots), 1) * 1e6
+        patch_us = _time(enc, patches, args.repeat) / max(len(patches), 1) * 1e6
+        per_sid = _time(enc, packets, args.repeat) / len(broadcasts) * 1e6
+        shared = _time(enc, grouped, args.repeat) / len(broadcasts) * 1e6
+        snap_b = statistics.mean(len(enc(*x)) for x in snapshots) if snapshots else 0
+        patch_b = statistics.mean(len(enc(*x)) for x in patches) if patches else 0
+        print(f"{name:<10} {snap_us:>12.1f} {snap_b:>7.0f} {patch_us:>9.1f} {patch_b:>7.0f} "
+              f"{per_sid:>17.1f} {shared:>16.1f}")
+    packet.Packet.json = json
+
+
+if __name__ == "__main__":
+    main()
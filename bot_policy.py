@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+BOT の方針テーブル（動的計画法で事前計算）
+------------------------------------------
+子の BOT の「引く/止める」とベット額を、期待値最大化の動的計画法で解いて
+コンパクトな表に書き出す。サーバは起動時に読み込み、判断は表を1回引くだけになる。
+難易度ごとに別ファイルを作り、TOPPAN_BOT_POLICY で切り替える（コード変更不要）。
+
+表のキー:
+- 山の残りの偏り: 残りに占める字牌の割合を WALL_BUCKETS で区切ったバケット
+- 親の見えている牌: 伏せ札以外の枚数・素点・東の有無
+- 自分の手: 1枚目なら牌ID、2枚以上なら（ツモ種別, 枚数, 東の有無, 素点）
+
+モデル（近似）:
+- 山は無限とみなし、バケットの字牌割合から各牌種の確率を決める
+- ドラは考えない（役倍率はドラ抜き、親の役は 1）
+- 親はサーバの BOT と同じ手順で打つ（役ありか 8 以上で止める、10 なら引く）。
+  子の番での親の伏せ札は、この手順で親が止まったという条件付きの分布をとる
+- 親の BOT の判断は表に含めない（従来どおり _bot_should_draw）
+
+Generate:
+    python bot_policy.py --difficulty normal            # -> policies/normal.bin
+"""
+
+from __future__ import annotations
+import argparse
+import os
+import struct
+import tempfile
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from hand_table import DEAD, SPECIAL, TARGET_HALF, HandTable, shared_table
+from tiles import EAST, IS_HONOR, NUM_TILE_TYPES, TILE_HALF, TILE_RANK
+
+POLICY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "policies")
+
+# 残りの山に占める字牌の割合の区切り（標準の山は 28/136 ≒ 0.21）
+WALL_BUCKETS = (0.10, 0.17, 0.24, 0.31)
+BUCKET_HONOR_SHARE = (0.05, 0.135, 0.205, 0.275, 0.40)   # 各バケットの代表値
+NUM_BUCKETS = len(BUCKET_HONOR_SHARE)
+
+MAX_N = TARGET_HALF          # バーストしていない手の最大枚数（1枚 0.5 以上）
+NUM_BASES = TARGET_HALF + 1  # 素点×2 は 0..21
+MAX_DEALER_VISIBLE = 3       # 子が打つとき親は4枚以下（5枚で役ありになり終局）
+NUM_DEALER_KEYS = (MAX_DEALER_VISIBLE + 1) * 2 * NUM_BASES
+NUM_STATES = NUM_TILE_TYPES + 3 * 2 * NUM_BASES + (MAX_N - 2) * 2 * NUM_BASES
+
+POLICY_VERSION = 1
+HEADER = struct.Struct("<4sHHHH16s")   # magic, version, buckets, dealer keys, states, difficulty
+MAGIC = b"TPBP"
+MAX_BET = 10
+
+
+class Difficulty(NamedTuple):
+    margin: float      # 引く期待値が止める期待値をこれだけ上回ったときだけ引く
+    bet_scale: float   # ベット = 期待値 × bet_scale（min_bet..10 に丸める）
+    min_bet: int
+
+
+DIFFICULTIES: Dict[str, Difficulty] = {
+    "easy": Difficulty(margin=0.30, bet_scale=4.0, min_bet=1),
+    "normal": Difficulty(margin=0.10, bet_scale=8.0, min_bet=1),
+    "hard": Difficulty(margin=0.0, bet_scale=20.0, min_bet=0),
+}
+
+
+# ---------------------- Keys ----------------------
+
+def wall_bucket(counts: Sequence[int]) -> int:
+    remaining = sum(counts)
+    share = sum(counts[EAST:]) / remaining if remaining else 0.0
+    for i, edge in enumerate(WALL_BUCKETS):
+        if share < edge:
+            return i
+    return len(WALL_BUCKETS)
+
+
+def state_index(kind: int, n: int, has_east: int, base_half: int, first: Optional[int] = None) -> int:
+    """手の状態の添字。1枚なら牌ID、2枚以上はシグネチャ（東は有無だけ見れば足りる）。"""
+    if n == 1:
+        return first
+    if n == 2:
+        return NUM_TILE_TYPES + ((kind // 5) * 2 + has_east) * NUM_BASES + base_half
+    return NUM_TILE_TYPES + 3 * 2 * NUM_BASES + ((n - 3) * 2 + has_east) * NUM_BASES + base_half
+
+
+def dealer_key(visible_n: int, visible_east: int, visible_base_half: int) -> int:
+    return (visible_n * 2 + visible_east) * NUM_BASES + visible_base_half
+
+
+# ---------------------- Model ----------------------
+
+def tile_probs(bucket: int) -> List[float]:
+    honor = BUCKET_HONOR_SHARE[bucket]
+    return [honor / 7 if IS_HONOR[t] else (1 - honor) / 27 for t in range(NUM_TILE_TYPES)]
+
+
+def _tile_classes(probs: Sequence[float]) -> List[Tuple[int, int, float]]:
+    """(素点×2, 東か, 確率) に牌種をまとめる（2枚目以降の遷移はこれだけで決まる）"""
+    acc: Dict[Tuple[int, int], float] = defaultdict(float)
+    for t, p in enumerate(probs):
+        acc[(TILE_HALF[t], int(t == EAST))] += p
+    return [(h, e, p) for (h, e), p in sorted(acc.items())]
+
+
+def _pair_kind(a: int, b: int) -> int:
+    if a == b:
+        return 10
+    if TILE_RANK[a] == TILE_RANK[b]:
+        return 5
+    return 0
+
+
+def _dealer_draws(table: HandTable, kind: int, n: int, has_east: int, base_half: int) -> Optional[str]:
+    """親（サーバの BOT 相当）の判断。止めたときの結果種別、引くなら None。"""
+    o = table.outcome(kind, n, has_east, base_half)
+    if o.flags & DEAD:
+        return "bust"
+    if o.flags & SPECIAL:
+        return "special"
+    total = o.total_half
+    if total == TARGET_HALF - 1:     # 10 なら十半狙いで引く
+        return None
+    if total >= 16:                  # 8 以上で止める
+        return "stay"
+    return None
+
+
+class DealerModel(NamedTuple):
+    bust: float                         # 親がバーストする確率
+    special: float                      # 親が役ありで止める確率 × 役倍率
+    stay: Dict[int, Dict[int, float]]   # 親の見えている牌 -> {親の合計×2: 確率}
+
+
+def dealer_model(table: HandTable, probs: Sequence[float]) -> DealerModel:
+    """親の打ち方を前向きに展開し、終局の形と（見えている牌ごとの）合計の分布を求める。"""
+    classes = _tile_classes(probs)
+    bust = special = 0.0
+    stay: Dict[int, Dict[int, float]] = defaultdict(lambda: defaultdict(float))
+    # 状態: (伏せ札, 見えている枚数, 見えている東の有無, 見えている素点, ツモ種別) -> 確率
+    frontier: Dict[Tuple[int, int, int, int, int], float] = {(h, 0, 0, 0, 0): p for h, p in enumerate(probs) if p}
+    while frontier:
+        nxt: Dict[Tuple[int, int, int, int, int], float] = defaultdict(float)
+        for (h, vn, ve, vb, kind), mass in frontier.items():
+            n = vn + 1
+            has_east = int(h == EAST or ve)
+            base = TILE_HALF[h] + vb
+            result = _dealer_draws(table, kind, n, has_east, base)
+            if result == "bust":
+                bust += mass
+            elif result == "special":
+                special += mass * table.outcome(kind, n, has_east, base).role
+            elif result == "stay":
+                total = table.outcome(kind, n, has_east, base).total_half
+                stay[dealer_key(vn, ve, vb)][total] += mass
+            elif vn == 0:
+                for t, p in enumerate(probs):
+                    if p:
+                        nxt[(h, 1, int(t == EAST), TILE_HALF[t], _pair_kind(h, t))] += mass * p
+            else:
+                for half, east, p in classes:
+                    vb2 = min(vb + half, 2 * NUM_BASES)   # これ以上は必ずバースト
+                    nxt[(h, vn + 1, int(ve or east), vb2, 0)] += mass * p
+        frontier = nxt
+    return DealerModel(bust, special, {k: dict(v) for k, v in stay.items()})
+
+
+def _stay_value(table: HandTable, kind: int, n: int, has_east: int, base_half: int, dealer: Sequence[Tuple[int, float]]) -> float:
+    """子が止めたときの期待値（ベット1あたり）。dealer は親の (合計×2, 確率) の正規化済み分布。"""
+    o = table.outcome(kind, n, has_east, base_half)
+    if o.flags & DEAD:
+        return -1.0
+    if o.flags & SPECIAL:
+        return float(o.role)
+    c = o.total_half
+    win = sum(p for d, p in dealer if c > d)
+    return win - (1.0 - win)
+
+
+def solve_child(
+    table: HandTable,
+    probs: Sequence[float],
+    dealer: Sequence[Tuple[int, float]],
+    margin: float,
+) -> Tuple[Dict[int, bool], List[float]]:
+    """親の合計の分布を固定して子の最適方針を解く。(引くか, 1枚目ごとの期待値) を返す。"""
+    classes = _tile_classes(probs)
+    draw: Dict[int, bool] = {}
+    # value[(n, has_east, base)]（3枚以上。ツモ種別は関係ない）
+    value: Dict[Tuple[int, int, int], float] = {}
+
+    def v_next(n: int, has_east: int, base: int) -> float:
+        if base >= NUM_BASES:
+            # 素点 10.5 超えは東の加点もなくバースト（3枚以上ならツモもない）
+            return -1.0
+        return value[(n, has_east, base)]
+
+    for n in range(MAX_N, 2, -1):
+        for has_east in (0, 1):
+            for base in range(n, NUM_BASES):
+                stay = _stay_value(table, 0, n, has_east, base, dealer)
+                go = -1.0
+                if n < MAX_N:
+                    go = sum(p * v_next(n + 1, int(has_east or e), base + half) for half, e, p in classes)
+                value[(n, has_east, base)] = max(stay, go)
+                draw[state_index(0, n, has_east, base)] = go > stay + margin
+
+    two: Dict[Tuple[int, int, int], float] = {}
+    for kind in (0, 5, 10):
+        for has_east in (0, 1):
+            for base in range(2, NUM_BASES):
+                stay = _stay_value(table, kind, 2, has_east, base, dealer)
+                go = sum(p * v_next(3, int(has_east or e), base + half) for half, e, p in classes)
+                two[(kind, has_east, base)] = max(stay, go)
+                draw[state_index(kind, 2, has_east, base)] = go > stay + margin
+
+    first_values: List[float] = []
+    for t0 in range(NUM_TILE_TYPES):
+        stay = _stay_value(table, 0, 1, int(t0 == EAST), TILE_HALF[t0], dealer)
+        go = 0.0
+        for t, p in enumerate(probs):
+            kind = _pair_kind(t0, t)
+            has_east = int(t0 == EAST or t == EAST)
+            base = TILE_HALF[t0] + TILE_HALF[t]
+            if base >= NUM_BASES:
+                go += p * _stay_value(table, kind, 2, has_east, base, dealer)   # ツモならそのまま勝ち
+            else:
+                go += p * two[(kind, has_east, base)]
+        first_values.append(max(stay, go))
+        draw[state_index(0, 1, 0, 0, first=t0)] = go > stay + margin
+    return draw, first_values
+
+
+# ---------------------- Solve / serialize ----------------------
+
+def solve(difficulty: Difficulty, table: Optional[HandTable] = None) -> Tuple[bytes, bytes]:
+    """(ベット表, 引く/止める のビット列) を作る。"""
+    table = table or shared_table()
+    bets = bytearray(NUM_BUCKETS * NUM_TILE_TYPES)
+    bits = bytearray((NUM_BUCKETS * NUM_DEALER_KEYS * NUM_STATES + 7) // 8)
+    for bucket in range(NUM_BUCKETS):
+        probs = tile_probs(bucket)
+        model = dealer_model(table, probs)
+        ev = [model.bust - model.special] * NUM_TILE_TYPES
+        for dk, totals in model.stay.items():
+            mass = sum(totals.values())
+            dealer = [(d, p / mass) for d, p in totals.items()]
+            draw, first_values = solve_child(table, probs, dealer, difficulty.margin)
+            base_bit = (bucket * NUM_DEALER_KEYS + dk) * NUM_STATES
+            for idx, go in draw.items():
+                if go:
+                    bit = base_bit + idx
+                    bits[bit >> 3] |= 1 << (bit & 7)
+            for t0 in range(NUM_TILE_TYPES):
+                ev[t0] += mass * first_values[t0]
+        for t0 in range(NUM_TILE_TYPES):
+            bet = int(round(ev[t0] * difficulty.bet_scale)) if ev[t0] > 0 else 0
+            bets[bucket * NUM_TILE_TYPES + t0] = max(difficulty.min_bet, min(MAX_BET, bet))
+    return bytes(bets), bytes(bits)
+
+
+def write_policy(path: str, name: str, difficulty: Difficulty) -> None:
+    bets, bits = solve(difficulty)
+    header = HEADER.pack(MAGIC, POLICY_VERSION, NUM_BUCKETS, NUM_DEALER_KEYS, NUM_STATES, name.encode()[:16])
+    d = os.path.dirname(os.path.abspath(path))
+    os.makedirs(d, exist_ok=True)
+    # 同時に生成しても一時ファイルが被らないように（hand_table.write_table と同じ）
+    fd, tmp = tempfile.mkstemp(dir=d, prefix=".policy.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header + bets + bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class BotPolicy:
+    """読み込んだ方針表。判断はどれも表を1回引くだけ。"""
+
+    def __init__(self, name: str, bets: bytes, bits: bytes) -> None:
+        self.name = name
+        self._bets = bets
+        self._bits = bits
+
+    @classmethod
+    def load(cls, path: str) -> "BotPolicy":
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, buckets, dealer_keys, states, name = HEADER.unpack_from(data, 0)
+        if (magic, version, buckets, dealer_keys, states) != (MAGIC, POLICY_VERSION, NUM_BUCKETS, NUM_DEALER_KEYS, NUM_STATES):
+            raise ValueError(f"incompatible bot policy: {path}")
+        n_bets = NUM_BUCKETS * NUM_TILE_TYPES
+        bets = data[HEADER.size:HEADER.size + n_bets]
+        bits = data[HEADER.size + n_bets:]
+        if len(bits) != (NUM_BUCKETS * NUM_DEALER_KEYS * NUM_STATES + 7) // 8:
+            raise ValueError(f"truncated bot policy: {path}")
+        return cls(name.rstrip(b"\0").decode(), bets, bits)
+
+    def bet(self, first_tile: int, counts: Sequence[int]) -> int:
+        return self._bets[wall_bucket(counts) * NUM_TILE_TYPES + first_tile]
+
+    def should_draw(self, hand, dealer_hand, counts: Sequence[int]) -> Optional[bool]:
+        """子の判断。hand / dealer_hand は hand_table.Hand。表の範囲外なら None。"""
+        kind, n, n_east, base = hand.signature()
+        if n == 0 or base >= NUM_BASES or n > MAX_N:
+            return None
+        first = dealer_hand[0]
+        vn = len(dealer_hand) - 1
+        vb = dealer_hand.base_half - TILE_HALF[first]
+        ve = int(dealer_hand.n_east - (first == EAST) > 0)
+        if vn > MAX_DEALER_VISIBLE or vb >= NUM_BASES:
+            return None
+        idx = state_index(kind, n, int(n_east > 0), base, first=hand[0])
+        bit = (wall_bucket(counts) * NUM_DEALER_KEYS + dealer_key(vn, ve, vb)) * NUM_STATES + idx
+        return bool(self._bits[bit >> 3] & (1 << (bit & 7)))
+
+
+def policy_path(name_or_path: str) -> str:
+    if name_or_path in DIFFICULTIES:
+        return os.path.join(POLICY_DIR, f"{name_or_path}.bin")
+    return name_or_path
+
+
+def load_policy(name_or_path: str) -> BotPolicy:
+    """難易度名（policies/<name>.bin）またはファイルパスから読み込む。"""
+    return BotPolicy.load(policy_path(name_or_path))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description="Solve and write bot policy tables")
+    ap.add_argument("--difficulty", choices=sorted(DIFFICULTIES), action="append",
+                    help="difficulty to generate (repeatable, default: all)")
+    ap.add_argument("-o", "--output", help="output path (only with a single --difficulty)")
+    args = ap.parse_args(argv)
+    names = args.difficulty or sorted(DIFFICULTIES)
+    if args.output and len(names) != 1:
+        ap.error("--output needs exactly one --difficulty")
+    for name in names:
+        path = args.output or policy_path(name)
+        write_policy(path, name, DIFFICULTIES[name])
+        print(f"wrote {path} ({os.path.getsize(path)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
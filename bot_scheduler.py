@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+BOT の行動のスケジューラ
+------------------------
+以前は BOT のいるルームごとに asyncio のタスクを1つ立て、1手ごとに 0.35 秒 sleep していた。
+フリーマッチで BOT 入りのルームが何千もあると、眠っているタスクと起床がその数だけある。
+ここでは全ルームの「次に BOT が動く時刻」を1つのヒープに積み、ワーカーごとに1つのタイマーで回す
+（ワーカーはルームを room_id で分け持つので、スケジューラもワーカーの数だけになる。cluster.py）。
+
+- schedule: ルームを delay 秒後に動かす。もう積んであれば何もしない（以前の bot_running と同じ）
+- 起床: 期限の来たルームをまとめて取り出し、1つずつ step を呼ぶ。BOT_BATCH 件ごとにイベントループへ戻す
+- ペース: step が返した秒数後にそのルームをまた積む（None なら BOT の番は終わり）。step の最中に人間の操作で
+  積まれていても、その期限は step が返した秒数で置き換える（以前のルームごとのタスクと同じく1手ごとの間は必ず空く）。
+  ルームごとに時刻を持つので、ルームどうしが同じ拍子に揃うことはない
+- 遅れ: 期限から実際に step を呼ぶまでの時間を stats に残す（/api/stats の "bots"）
+
+ルームの中身には触らない。1手進めて送るのは server.py の step（_bot_turn）。
+bench/bots.py で以前のルームごとのタスクと CPU 時間・起床の遅れを比べられる。
+"""
+
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BOT_STEP_INTERVAL = float(os.environ.get("TOPPAN_BOT_INTERVAL", "0.35"))   # BOT の1手ごとの間（秒）
+BOT_BATCH = int(os.environ.get("TOPPAN_BOT_BATCH", "256"))   # 1回にループを止めて動かすルーム数
+BOT_RETRY_DELAY = 0.05   # ルームのロックが塞がっていたときに試し直すまで（秒）
+LAG_WINDOW = 1024   # 遅れの分位を出すのに残す件数（直近）
+
+Step = Callable[[str], Awaitable[Optional[float]]]   # room_id -> 次に動かすまでの秒数（None なら終わり）
+
+
+@dataclass
+class SchedulerStats:
+    wakeups: int = 0     # タイマーで起きた回数
+    steps: int = 0       # step を呼んだ回数
+    lag_max: float = 0.0   # 期限からの遅れの最大（秒）
+    lag_total: float = 0.0
+    lags: Deque[float] = field(default_factory=lambda: deque(maxlen=LAG_WINDOW))
+
+    def as_dict(self) -> Dict[str, float]:
+        recent = sorted(self.lags)
+
+        def pct(q: float) -> float:
+            return recent[min(len(recent) - 1, int(q * len(recent)))] * 1e3 if recent else 0.0
+
+        return {
+            "wakeups": self.wakeups,
+            "steps": self.steps,
+            "rooms_per_wakeup": round(self.steps / self.wakeups, 2) if self.wakeups else 0.0,
+            "lag_avg_ms": round(self.lag_total / self.steps * 1e3, 3) if self.steps else 0.0,
+            "lag_p50_ms": round(pct(0.5), 3),
+            "lag_p99_ms": round(pct(0.99), 3),
+            "lag_max_ms": round(self.lag_max * 1e3, 3),
+        }
+
+
+class BotScheduler:
+    """(期限, 通し番号, room_id) のヒープと、次の期限に合わせた1つのタイマー"""
+
+    def __init__(self, step: Step, interval: float = BOT_STEP_INTERVAL, batch: int = BOT_BATCH) -> None:
+        self.step = step
+        self.interval = interval
+        self.batch = max(1, batch)
+        self.seq = itertools.count()      # 同じ期限なら積んだ順
+        self.stats = SchedulerStats()
+        self._reset(None)
+
+    def _reset(self, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        """イベントループが替わったら（テストで asyncio.run を繰り返すなど）前のループの予定は捨てる"""
+        self.loop = loop
+        self.heap: List[Tuple[float, int, str]] = []
+        self.due: Dict[str, float] = {}   # 積んであるルーム -> 期限
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.timer_at: Optional[float] = None
+        self.running: Optional[asyncio.Task] = None   # 期限の来たルームを動かしている間だけ
+
+    def __len__(self) -> int:
+        return len(self.due)
+
+    def __contains__(self, room_id: str) -> bool:
+        return room_id in self.due
+
+    def schedule(self, room_id: str, delay: float = 0.0) -> None:
+        """room_id を delay 秒後に動かす（もう積んであれば何もしない）"""
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self._reset(loop)
+        if room_id in self.due:
+            return
+        at = loop.time() + delay
+        self.due[room_id] = at
+        heapq.heappush(self.heap, (at, next(self.seq), room_id))
+        self._arm(loop)
+
+    def cancel(self, room_id: str) -> None:
+        """積んであっても動かさない（ヒープの中身は取り出したときに読み飛ばす）"""
+        self.due.pop(room_id, None)
+
+    def _arm(self, loop: asyncio.AbstractEventLoop) -> None:
+        """一番早い期限にタイマーを合わせる（動かしている最中なら、終わったときに合わせ直す）"""
+        if self.running is not None or not self.heap:
+            return
+        at = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_at <= at:
+                return
+            self.timer.cancel()
+        self.timer_at = at
+        self.timer = loop.call_at(at, self._wake)
+
+    def _wake(self) -> None:
+        self.timer = self.timer_at = None
+        self.stats.wakeups += 1
+        self.running = asyncio.ensure_future(self._run_due())
+
+    def _pop_due(self, now: float) -> List[Tuple[float, str]]:
+        """期限が now までのルームを期限順に取り出す（due には動かす直前まで残す）"""
+        batch = []
+        while self.heap and self.heap[0][0] <= now:
+            at, _, room_id = heapq.heappop(self.heap)
+            if self.due.get(room_id) == at:   # cancel 済みの古い項目は飛ばす
+                batch.append((at, room_id))
+        return batch
+
+    async def _run_due(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            # 起きた時点で期限の来ていたものだけ動かす（動かしている間に積まれた次の手は次の起床で）
+            batch = self._pop_due(loop.time())
+            for i, (at, room_id) in enumerate(batch):
+                if i and i % self.batch == 0:
+                    await asyncio.sleep(0)
+                if self.due.get(room_id) != at:   # 待っている間に cancel された
+                    continue
+                del self.due[room_id]
+                lag = max(0.0, loop.time() - at)
+                st = self.stats
+                st.steps += 1
+                st.lag_total += lag
+                st.lags.append(lag)
+                if lag > st.lag_max:
+                    st.lag_max = lag
+                try:
+                    delay = await self.step(room_id)
+                except Exception:
+                    logger.exception("bot step failed in room %s", room_id)
+                    delay = None
+                if delay is not None:
+                    self.due.pop(room_id, None)   # step の最中に積まれた分より、step が返した間を優先する
+                    self.schedule(room_id, delay)
+        finally:
+            self.running = None
+            self._arm(loop)
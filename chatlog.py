@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+チャットの履歴と送信制限
+------------------------
+- ChatHistory: ルームごとの直近のチャット（リングバッファ）。参加・再接続時にまとめて送り直す
+- ChatRateLimiter: sid ごとのトークンバケット。連投で state の送信が詰まらないようにする
+"""
+
+from __future__ import annotations
+import time
+from collections import deque
+from typing import Deque, List, Optional
+
+CHAT_HISTORY_SIZE = 50      # ルームごとに覚えておくメッセージ数
+CHAT_MAX_LENGTH = 200       # 1メッセージの最大文字数（超えた分は切る）
+CHAT_BURST = 5              # 続けて送れる数
+CHAT_RATE = 1.0             # 1秒あたりに回復する数
+
+
+class ChatHistory:
+    """直近 CHAT_HISTORY_SIZE 件のチャット。古いものから捨てる"""
+
+    __slots__ = ("messages", "seq")
+
+    def __init__(self, size: int = CHAT_HISTORY_SIZE) -> None:
+        self.messages: Deque[dict] = deque(maxlen=size)
+        self.seq = 0
+
+    def append(self, payload: dict) -> dict:
+        """通し番号 id を付けて覚え、そのまま送れる形で返す"""
+        self.seq += 1
+        payload = {**payload, "id": self.seq}
+        self.messages.append(payload)
+        return payload
+
+    def recent(self) -> List[dict]:
+        return list(self.messages)
+
+
+class ChatRateLimiter:
+    """トークンバケット: CHAT_BURST 件まで続けて送れ、その後は CHAT_RATE 件/秒"""
+
+    __slots__ = ("tokens", "updated", "burst", "rate")
+
+    def __init__(self, burst: int = CHAT_BURST, rate: float = CHAT_RATE) -> None:
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated: Optional[float] = None
+
+    def allow(self, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
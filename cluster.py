@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+複数ワーカーでの実行
+--------------------
+ワーカー（uvicorn のプロセス）ごとに別のポートで待ち受け、ルームは room_id から決まる1つのワーカーだけが持つ。
+
+- ClusterConfig: ワーカー数・自分の番号・各ワーカーの公開URL（環境変数から）。
+  shard_of(room_id) は crc32 なので、どのプロセスで計算しても同じワーカーになる（hash() はプロセスごとに違う）
+- create_room / free_match は接続先のワーカーが自分の持ち分のIDでルームを作る。
+  join_room は持ち主でなければ redirect（持ち主のURL）を返し、client.js がそちらへ移って参加し直す
+- Socket.IO の送信はクライアントマネージャ（TOPPAN_SIO_MESSAGE_QUEUE）で他のワーカーにも届く:
+
+      (未設定)            ワーカー1つ分（python-socketio の既定）
+      memory://<name>     同じプロセス内のバス（テスト用）
+      unix://<path>       このモジュールのブローカー（python -m cluster が立てる）
+      redis://...         python-socketio の AsyncRedisManager（redis パッケージが要る）
+
+  送り先がこのワーカーに繋がっている sid だけなら、キューには流さずその場で送る。
+
+    python -m cluster --workers 4 --port 8000     # 8000..8003 で4ワーカー + ブローカー
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import os
+import pickle
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+_FRAME = struct.Struct("!I")   # ブローカーとのやり取り: 4バイトの長さ + pickle
+
+
+def shard_of(room_id: str, workers: int) -> int:
+    return zlib.crc32(room_id.encode()) % workers
+
+
+class ClusterConfig(NamedTuple):
+    index: int = 0            # このワーカーの番号
+    urls: tuple = ("",)       # 各ワーカーの公開URL（"" は同じオリジン）
+
+    @property
+    def workers(self) -> int:
+        return len(self.urls)
+
+    @classmethod
+    def from_env(cls) -> "ClusterConfig":
+        urls = tuple(u.strip().rstrip("/") for u in os.environ.get("TOPPAN_WORKER_URLS", "").split(",") if u.strip())
+        if not urls:
+            return cls()
+        index = int(os.environ.get("TOPPAN_WORKER_INDEX", "0"))
+        if not 0 <= index < len(urls):
+            raise ValueError(f"TOPPAN_WORKER_INDEX={index} is out of range for {len(urls)} workers")
+        return cls(index, urls)
+
+    def owner(self, room_id: str) -> int:
+        return shard_of(room_id, self.workers) if self.workers > 1 else 0
+
+    def owns(self, room_id: str) -> bool:
+        return self.owner(room_id) == self.index
+
+    def url_for(self, room_id: str) -> str:
+        return self.urls[self.owner(room_id)]
+
+
+# ---------------------- Client managers ----------------------
+
+class _LocalFirst:
+    """送り先の sid が全部このワーカーにいればキューに流さない（ルームは持ち主のワーカーに集まるので大半がこれ）"""
+
+    async def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        target = to or room
+        targets = target if isinstance(target, (list, tuple)) else [target]
+        if target is not None and all(self.is_connected(sid, namespace or "/") for sid in targets):
+            kwargs["ignore_queue"] = True
+        return await super().emit(event, data, namespace=namespace, room=target, skip_sid=skip_sid,
+                                  callback=callback, **kwargs)
+
+
+_MEMORY_BUSES: Dict[str, Set[asyncio.Queue]] = {}
+
+
+class MemoryManager(_LocalFirst, AsyncPubSubManager):
+    """同じプロセス内の AsyncServer どうしで送り合う（テスト用）"""
+
+    name = "memory"
+
+    def __init__(self, url: str = "memory://default", channel: str = "socketio", write_only: bool = False,
+                 logger: Any = None) -> None:
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.subscribers = _MEMORY_BUSES.setdefault(url, set())
+        self.subscribers.add(self.queue)
+
+    async def _publish(self, data: Any) -> None:
+        for q in self.subscribers:
+            if q is not self.queue:
+                q.put_nowait(data)
+
+    async def _listen(self):
+        while True:
+            yield await self.queue.get()
+
+
+class UnixSocketManager(_LocalFirst, AsyncPubSubManager):
+    """run_broker が立てた unix ソケットのブローカー越しに送り合う"""
+
+    name = "unix"
+
+    def __init__(self, url: str, channel: str = "socketio", write_only: bool = False, logger: Any = None) -> None:
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len("unix://"):]
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.connecting = asyncio.Lock()   # 送信と受信で同じ接続を使う
+
+    async def _connect(self) -> None:
+        async with self.connecting:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+
+    async def _publish(self, data: Any) -> None:
+        await self._connect()
+        body = pickle.dumps(data)
+        self.writer.write(_FRAME.pack(len(body)) + body)
+        await self.writer.drain()
+
+    async def _listen(self):
+        await self._connect()
+        try:
+            while True:
+                head = await self.reader.readexactly(_FRAME.size)
+                yield await self.reader.readexactly(_FRAME.unpack(head)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # ブローカーが落ちた。少し待って繋ぎ直す（AsyncPubSubManager._thread が _listen を呼び直す）
+            self.writer = self.reader = None
+            await asyncio.sleep(1.0)
+            raise
+
+
+class RedisManager(_LocalFirst, socketio.AsyncRedisManager):
+    name = "redis"
+
+
+def client_manager(url: Optional[str] = None) -> Optional[AsyncPubSubManager]:
+    """TOPPAN_SIO_MESSAGE_QUEUE からクライアントマネージャを作る。未設定なら None（既定のまま）"""
+    url = url if url is not None else os.environ.get("TOPPAN_SIO_MESSAGE_QUEUE", "")
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryManager(url)
+    if url.startswith("unix://"):
+        return UnixSocketManager(url)
+    if url.startswith(("redis://", "rediss://")):
+        return RedisManager(url)
+    raise ValueError(f"unsupported TOPPAN_SIO_MESSAGE_QUEUE {url!r} (memory://, unix://, redis://)")
+
+
+# ---------------------- Broker / launcher ----------------------
+
+async def run_broker(path: str) -> None:
+    """受け取ったフレームを他の全接続へそのまま流す"""
+    peers: List[asyncio.StreamWriter] = []
+
+    async def relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peers.append(writer)
+        try:
+            while True:
+                head = await reader.readexactly(_FRAME.size)
+                frame = head + await reader.readexactly(_FRAME.unpack(head)[0])
+                for peer in peers:
+                    if peer is not writer:
+                        peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            peers.remove(writer)
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(relay, path)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=8000, help="最初のワーカーのポート（以降 +1 ずつ）")
+    ap.add_argument("--public-url", default="http://localhost", help="クライアントから見たホスト（ポートは付けない）")
+    args = ap.parse_args()
+
+    sock = os.path.join(tempfile.gettempdir(), f"toppan-{os.getpid()}.sock")
+    urls = ",".join(f"{args.public_url.rstrip('/')}:{args.port + i}" for i in range(args.workers))
+    procs = []
+
+    async def run() -> None:
+        broker = asyncio.create_task(run_broker(sock))
+        while not os.path.exists(sock):
+            await asyncio.sleep(0.01)
+        for i in range(args.workers):
+            env = dict(os.environ, TOPPAN_WORKER_INDEX=str(i), TOPPAN_WORKER_URLS=urls,
+                       TOPPAN_SIO_MESSAGE_QUEUE=f"unix://{sock}")
+            procs.append(subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "server:app", "--host", args.host, "--port", str(args.port + i)],
+                env=env,
+            ))
+        await broker
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+        if os.path.exists(sock):
+            os.unlink(sock)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,868 @@
+# -*- coding: utf-8 -*-
+"""
+十半 (Toppan) game engine
+-------------------------
+ルールと卓の状態遷移だけを持つ同期コア（asyncio・Socket.IO に依存しない）。
+コマンド関数は Room の状態を直接書き換え、エラーなら文字列を返す。
+通信・タイマーなどの副作用は実行せず、Effect として room.outbox に積むだけなので、
+サーバ（server.py）は drain_effects で取り出して実行し、
+バッチ処理やワーカープロセス（simulate.py）は読み捨てればよい。
+"""
+
+from __future__ import annotations
+import logging
+import os
+import random
+import struct
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Union
+
+from tiles import STANDARD_TILES, TILE_VALUE, Wall, compile_dora_weights
+from odds import draw_odds
+from bot_policy import BotPolicy, load_policy
+from hand_table import (
+    Hand, DEAD, SPECIAL, TARGET, TOPPAN, TSUMO, TSUMO_PAIR, cutin_for, shared_table,
+)
+
+logger = logging.getLogger(__name__)
+
+SEATS = ["東", "南", "西", "北"]
+DEFAULT_BET = 1
+INITIAL_HAND_SIZE = 1
+# TOPPAN_BOT_ODDS=1 で、ヒューリスティックの BOT も山の残りから次の1枚の確率（odds.py）を見る。
+# ベットと引く/止めるの加減が変わり卓の点の動きも変わるので、既定は従来どおり見ない
+BOT_USE_ODDS = os.environ.get("TOPPAN_BOT_ODDS", "0") not in ("", "0")
+BOT_MAX_BUST_RISK = 0.75        # 次の1枚のバースト確率がこれ以上なら BOT は引かない（BOT_USE_ODDS のとき）
+BOT_SPECIAL_BET_WEIGHT = 5.0    # 次の1枚で役が付く確率に掛けてベットに足す（BOT_USE_ODDS のとき）
+
+# 役判定テーブル（hand_table.py）。起動時に mmap し、無ければ生成する
+HAND_TABLE = shared_table()
+
+
+def _load_bot_policy(name_or_path: str) -> Optional[BotPolicy]:
+    """方針表を読む。表が無い・壊れているときは警告だけ出してヒューリスティックに戻す
+
+    policies/ はリポジトリに含めないので、生成前の環境でもサーバは起動できるようにする。
+    """
+    if not name_or_path:
+        return None
+    try:
+        return load_policy(name_or_path)
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning("bot policy %r unavailable, using the heuristic bot: %s", name_or_path, e)
+        return None
+
+
+# BOT の方針表（bot_policy.py）。TOPPAN_BOT_POLICY に難易度名かパスを指定すると、
+# 子の BOT の判断とベットは表引きになる。未指定なら従来のヒューリスティック
+BOT_POLICY: Optional[BotPolicy] = _load_bot_policy(os.environ.get("TOPPAN_BOT_POLICY", ""))
+
+# ---------------------- Scoring & Models ----------------------
+
+def make_standard_tiles(rng: Optional[random.Random] = None) -> List[int]:
+    """Return a shuffled 136-tile mahjong-like set (no flowers) as tile IDs (see tiles.py)."""
+    tiles = list(STANDARD_TILES)
+    (rng or random).shuffle(tiles)
+    return tiles
+
+def tile_value(tile: int) -> float:
+    # 数牌は数字、字牌（東南西北白發中）は 0.5
+    return TILE_VALUE[tile]
+
+# 役判定はシグネチャ表を1回引くだけ（hand_table.py）
+
+def hand_total(hand: List[int]) -> float:
+    return HAND_TABLE.lookup(hand).total_half / 2
+
+def is_toppan(hand):
+    return bool(HAND_TABLE.lookup(hand).flags & TOPPAN)
+
+def is_tsumo(hand):
+    # 同じ牌、または同じ数字の2枚
+    return bool(HAND_TABLE.lookup(hand).flags & TSUMO)
+
+def count_role(hand: List[int], dora_weights: List[int]) -> float:
+    """役のカウント"""
+    breakdown = role_breakdown(hand, dora_weights)
+    return breakdown["total"]
+
+def count_dora(hand: List[int], dora_weights: List[int]) -> int:
+    """ドラの合計を返す（dora_weights は GameState.dora_weights。山ごとに事前計算済み）"""
+    return sum(dora_weights[t] for t in hand)
+
+def role_breakdown(hand: List[int], dora_weights: List[int]) -> dict:
+    """役の内訳を返す: {total: int, items: [{name, points, multiplier}] }"""
+    outcome = HAND_TABLE.lookup(hand)
+    flags = outcome.flags
+    if flags & DEAD:
+        return {"total": 0, "items": []}
+
+    items = [{"name": "基本", "points": 1, "multiplier": 1}]
+    if flags & TSUMO:
+        pts = 10 if flags & TSUMO_PAIR else 5
+        items.append({"name": "ツモ", "points": pts, "multiplier": pts})
+    dora_total = count_dora(hand, dora_weights)
+    if dora_total:
+        items.append({"name": "ドラ", "points": dora_total, "multiplier": dora_total})
+    if flags & TOPPAN:
+        items.append({"name": "十半", "points": 10, "multiplier": 10})
+    if len(hand) >= 5:
+        extra = (len(hand) - 4) * 5
+        items.append({"name": f"{len(hand)}枚引き", "points": extra, "multiplier": extra})
+
+    return {"total": outcome.role + dora_total, "items": items}
+
+def is_special_role(hand) -> bool:
+    return bool(HAND_TABLE.lookup(hand).flags & SPECIAL)
+
+def special_role_cutin(hand: List[int]) -> Optional[dict]:
+    return cutin_for(HAND_TABLE.lookup(hand), len(hand))
+
+@dataclass
+class Player:
+    sid: str
+    name: str
+    seat_index: int
+    hand: Hand = field(default_factory=Hand)    # 牌ID（tiles.py）。集計は append 時に増分更新
+    discards: List[int] = field(default_factory=list)  # ← 未使用だが互換で残す
+    ready: bool = False
+    status: str = "playing"  # "playing" | "stay" | "bust"
+    points: int = 300
+    initial_points: Optional[int] = None  # ← 開始前に入力した持ち点（未入力は None）
+    bet_points: Optional[int] = None   # ← このラウンドのベット（子のみ）
+    is_bot: bool = False
+
+    def __post_init__(self) -> None:
+        if not isinstance(self.hand, Hand):
+            self.hand = Hand(self.hand)
+
+@dataclass
+class GameState:
+    phase: str = "waiting"    # "waiting" | "reset_prompt" | "betting" | "playing" | "ended"
+    wall: Wall = field(default_factory=Wall)      # 並び + 残り枚数
+    turn_seat: Optional[int] = None
+    # 十半用
+    dealer_seat: int = 0                # 親（東固定）
+    dealer_first_hidden: bool = True    # 親の1枚目を伏せる
+    dora_displays: List[int] = field(default_factory=list)  # 参考表示用
+    results: dict = field(default_factory=dict)   # 清算結果（_end_round）。クライアントへは settlement で1回だけ送る
+    cutin: Optional[dict] = None
+    # dora_displays から作る牌IDごとのドラ点。山の世代(wall_gen)と一緒に更新する
+    dora_weights: Optional[List[int]] = None
+    wall_gen: int = 0
+
+    def __post_init__(self) -> None:
+        if not isinstance(self.wall, Wall):
+            self.wall = Wall(self.wall)
+        if self.dora_weights is None:
+            self.dora_weights = compile_dora_weights(self.dora_displays)
+
+    def set_wall(self, wall: Iterable[int], dora: List[int]) -> None:
+        """山とドラ表示牌を差し替える。ドラ点はここで1回だけ計算し直す。"""
+        self.wall = wall if isinstance(wall, Wall) else Wall(wall)
+        self.dora_displays = dora
+        self.dora_weights = compile_dora_weights(dora)
+        self.wall_gen += 1
+
+    def shuffle_wall(self, seed: int) -> None:
+        """seed から山とドラ表示牌を作り直す（同じ seed なら同じ山）。山のバッファは使い回す"""
+        if self.wall.seed is None:
+            self.wall = Wall.shuffled(seed)
+        else:
+            self.wall.reshuffle(seed)
+        self.dora_displays = self.wall.dora()
+        self.dora_weights = compile_dora_weights(self.dora_displays)
+        self.wall_gen += 1
+
+@dataclass
+class Room:
+    room_id: str
+    host_sid: Optional[str] = None
+    players_by_sid: Dict[str, Player] = field(default_factory=dict)
+    seat_to_sid: Dict[int, Optional[str]] = field(default_factory=lambda: {0: None, 1: None, 2: None, 3: None})
+    state: GameState = field(default_factory=GameState)
+    lock: Any = field(default=None, repr=False, compare=False)   # server.py が asyncio.Lock を入れる
+    is_free_match: bool = False
+    outbox: List[Effect] = field(default_factory=list, repr=False, compare=False)   # 未実行の副作用
+    rng: Optional[random.Random] = field(default=None, repr=False, compare=False)  # 山の seed 用（最初に使うときに作る）
+    state_version: int = 0   # クライアントへ送った state のバージョン（server.py が進める）
+    broadcast: Any = field(default=None, repr=False, compare=False)   # server.py の送信まとめ役
+    settlement_seq: int = 0  # 清算の通し番号（results["id"]。ラウンドをまたいで増える）
+    chat_log: Any = field(default=None, repr=False, compare=False)   # server.py のチャット履歴
+    journal: Any = field(default=None, repr=False, compare=False)    # server.py の操作ログ（eventlog.py）
+    event_seq: int = 0       # 操作ログの通し番号（ルームごと）
+
+    def seats_filled(self) -> int:
+        return sum(1 for s in self.seat_to_sid.values() if s)
+
+    def player_sids(self) -> List[str]:
+        return [sid for sid in self.seat_to_sid.values() if sid]
+
+    def players(self) -> List[Player]:
+        return [self.players_by_sid[sid] for sid in self.player_sids()]
+
+    def humans(self) -> int:
+        return sum(1 for p in self.players() if not p.is_bot)
+
+# ---------------------- Effects ----------------------
+
+class RoundSettled(NamedTuple):
+    """清算が終わった。サーバは清算チャット・0点以下の退室・次ラウンドへの自動進行を行う"""
+    results: dict
+
+
+Effect = Union[RoundSettled]
+
+
+def drain_effects(room: Room) -> List[Effect]:
+    """積まれた副作用を取り出して outbox を空にする"""
+    effects, room.outbox = room.outbox, []
+    return effects
+
+# ---------------------- Event log ----------------------
+
+# 操作ログ（eventlog.py）の種類。コマンドは受け付けた（検証を通った）ときだけ、状態を書き換える前に積む。
+# BOT の行動も同じコマンド関数を通るので同じ形で残る。山の seed も残すので、再生に乱数は要らない
+EV_CHECKPOINT = 0       # ルーム丸ごと（作成時・スナップショットからの復元時）
+EV_SEATS = 1            # 席と host の変化（新しい sid は新しい Player）
+EV_REBIND = 2           # 席はそのままで sid の付け替え（payload: 新しい sid）
+EV_NEW_GAME = 3         # arg: 山の seed
+EV_NEXT_ROUND = 4
+EV_DEALER_RESET = 5     # arg: 山の seed（リセットしないなら -1）
+EV_BET = 6              # arg: ベット額
+EV_DRAW = 7
+EV_STAY = 8
+EV_INITIAL_POINTS = 9   # arg: 持ち点
+EV_ADD_POINTS = 10      # arg: 追加する点数
+
+
+def _log(room: Room, op: int, seat: int = -1, arg: int = 0, payload: bytes = b"") -> None:
+    if room.journal is not None:
+        room.journal.record(room, op, seat, arg, payload)
+
+
+def _log_seats(room: Room) -> None:
+    """席・host が前の記録から変わっていれば EV_SEATS を積む"""
+    if room.journal is not None:
+        room.journal.seats(room)
+
+# ---------------------- Seats ----------------------
+
+def seat_label(i: int) -> str:
+    return SEATS[i]
+
+def first_open_seat(seat_to_sid: Dict[int, Optional[str]]) -> Optional[int]:
+    for i in range(4):
+        if not seat_to_sid[i]:
+            return i
+    return None
+
+def _next_active_seat(room: Room, from_seat: int) -> Optional[int]:
+    # 次の "playing" 状態の着席者へ
+    for step in range(1, 5):
+        nxt = (from_seat + step) % 4
+        sid = room.seat_to_sid.get(nxt)
+        if not sid:
+            continue
+        p = room.players_by_sid[sid]
+        if p.status == "playing":
+            return nxt
+    return None
+
+def _next_seated_seat(room: Room, from_seat: int) -> Optional[int]:
+    # 次の着席者（東→南→西→北の順）
+    for step in range(1, 5):
+        nxt = (from_seat + step) % 4
+        if room.seat_to_sid.get(nxt):
+            return nxt
+    return None
+
+def _all_done(room: Room) -> bool:
+    return all(p.status != "playing" for p in room.players())
+
+def _sync_free_room_bots_locked(room: Room) -> None:
+    if not room.is_free_match:
+        return
+    humans = [p for p in room.players() if not p.is_bot]
+    bots = [p for p in room.players() if p.is_bot]
+    if len(humans) == 0 and len(bots) > 0:
+        for b in list(bots):
+            if room.seat_to_sid.get(b.seat_index) == b.sid:
+                room.seat_to_sid[b.seat_index] = None
+            room.players_by_sid.pop(b.sid, None)
+        _log_seats(room)
+        return
+    if len(humans) == 1 and len(bots) == 0:
+        seat = first_open_seat(room.seat_to_sid)
+        if seat is None:
+            return
+        bot_sid = f"BOT-FREE-{room.room_id}-{seat}"
+        bot = Player(sid=bot_sid, name="BOT", seat_index=seat, is_bot=True)
+        room.players_by_sid[bot_sid] = bot
+        room.seat_to_sid[seat] = bot_sid
+    elif len(humans) >= 2 and len(bots) > 0:
+        for b in list(bots):
+            if room.seat_to_sid.get(b.seat_index) == b.sid:
+                room.seat_to_sid[b.seat_index] = None
+            room.players_by_sid.pop(b.sid, None)
+        if room.host_sid and room.host_sid not in room.players_by_sid:
+            sids = room.player_sids()
+            room.host_sid = sids[0] if sids else None
+    _log_seats(room)
+
+# ---------------------- Round flow ----------------------
+
+def _advance_turn(room: Room) -> None:
+    st = room.state
+    if st.turn_seat is None:
+        return
+    for step in range(1, 5):
+        nxt = (st.turn_seat + step) % 4
+        sid = room.seat_to_sid.get(nxt)
+        if not sid:
+            continue
+        p = room.players_by_sid.get(sid)
+        if p and p.status == "playing":
+            st.turn_seat = nxt
+            return
+    # playing が誰もいない
+    st.turn_seat = None
+
+def _all_children_bet(room: Room) -> bool:
+    st = room.state
+    for p in room.players():
+        if p.seat_index == st.dealer_seat:
+            continue
+        if p.bet_points is None:
+            return False
+    return True
+
+def _deal_initial_tiles(room: Room, count: int = INITIAL_HAND_SIZE) -> None:
+    st = room.state
+    if count <= 0:
+        return
+    for p in room.players():
+        while len(p.hand) < count and st.wall:
+            p.hand.append(st.wall.pop())
+
+def _clear_for_next_round(room: Room) -> None:
+    for p in room.players():
+        p.hand.clear()
+        p.discards = []
+        p.status = "playing"
+        if p.seat_index != room.state.dealer_seat:
+            p.bet_points = None
+        else:
+            p.bet_points = None
+
+def _start_playing_phase(room: Room) -> None:
+    st = room.state
+    # betting時に配られていない場合の保険
+    _deal_initial_tiles(room, INITIAL_HAND_SIZE)
+    st.phase = "playing"
+    st.turn_seat = st.dealer_seat
+
+def _prepare_betting_phase(room: Room) -> None:
+    st = room.state
+    _clear_for_next_round(room)
+    _deal_initial_tiles(room, INITIAL_HAND_SIZE)
+    st.phase = "betting"
+    st.turn_seat = None
+    st.dealer_first_hidden = True
+    st.results = {}
+    st.cutin = None
+
+def _start_next_round_locked(room: Room) -> None:
+    st = room.state
+    _log(room, EV_NEXT_ROUND)
+    _clear_for_next_round(room)
+    # 山・ドラは原則固定。次ラウンド開始前に親へリセット確認
+    room.state = GameState(
+        phase="reset_prompt",
+        wall=st.wall,
+        turn_seat=None,
+        dealer_seat=st.dealer_seat,
+        dealer_first_hidden=True,
+        dora_displays=getattr(st, "dora_displays", []),
+        results={},
+        cutin=None,
+        dora_weights=st.dora_weights,
+        wall_gen=st.wall_gen,
+    )
+
+# ---------------------- Play ----------------------
+
+def _draw_tile_for_player(room: Room, p: Player) -> Optional[str]:
+    st = room.state
+    if st.phase != "playing":
+        return "Not in playing phase"
+    if p.seat_index != st.turn_seat:
+        return "Not your turn"
+    if p.status != "playing":
+        return "You are not in playing state"
+    _log(room, EV_DRAW, p.seat_index)
+    if not st.wall:
+        # 山切れで流局。引く操作は受け付けて清算まで済んでいる（エラーではない。再生でも同じに当たる）
+        _void_round_by_empty_wall(room)
+        return None
+    tile = st.wall.pop()
+    p.hand.append(tile)
+    # 手牌の集計は Hand が持っているので、判定はテーブルを1回引くだけ
+    outcome = HAND_TABLE.lookup(p.hand)
+    cutin = cutin_for(outcome, len(p.hand))
+    if cutin:
+        label = cutin["label"]
+        sound = cutin.get("sound", "normal")
+        st.cutin = {"seat": p.seat_index, "label": label, "sound": sound, "sig": f"{p.seat_index}:{len(p.hand)}:{label}:{sound}"}
+    else:
+        st.cutin = None
+    if outcome.flags & DEAD:
+        p.status = "bust"
+        if p.seat_index == st.dealer_seat:
+            _end_round(room)
+        else:
+            nxt = _next_active_seat(room, st.turn_seat)
+            if nxt is None:
+                _end_round(room)
+            else:
+                st.turn_seat = nxt
+    return None
+
+def _stay_for_player(room: Room, p: Player) -> Optional[str]:
+    st = room.state
+    if st.phase != "playing":
+        return "Not in playing phase"
+    if p.seat_index != st.turn_seat:
+        return "Not your turn"
+    if p.status != "playing":
+        return "You are not in playing state"
+    _log(room, EV_STAY, p.seat_index)
+    p.status = "stay"
+    if p.seat_index == st.dealer_seat and is_special_role(p.hand):
+        _end_round(room)
+        return None
+    nxt = _next_active_seat(room, st.turn_seat)
+    if nxt is None:
+        _end_round(room)
+    else:
+        st.turn_seat = nxt
+    return None
+
+def _end_round(room: Room) -> None:
+    st = room.state
+    st.cutin = None
+    st.dealer_first_hidden = False  # 親の伏せ札を公開
+    # 親・子それぞれの合計
+    current_dealer_seat = st.dealer_seat
+    dealer_sid = room.seat_to_sid.get(current_dealer_seat)
+    dealer = room.players_by_sid[dealer_sid] if dealer_sid else None
+    dealer_sum = hand_total(dealer.hand) if dealer else 0.0
+    dealer_breakdown = role_breakdown(dealer.hand, room.state.dora_weights) if dealer else {"total": 0, "items": []}
+    dealer_role = dealer_breakdown["total"]
+
+    results = {}
+    dealer_delta = 0
+    for p in room.players():
+        if p.seat_index == st.dealer_seat:
+            continue
+        child_sum = hand_total(p.hand)
+        child_breakdown = role_breakdown(p.hand, room.state.dora_weights)
+        if is_special_role(dealer.hand):
+            result_value = -dealer_role
+        elif len(dealer.hand) >= 5 and dealer_sum <= TARGET:
+            result_value = -dealer_role
+        elif len(p.hand) >= 5 and child_sum <= TARGET:
+            # 5枚以上引いてバーストしていなければ優先勝ち
+            result_value = child_breakdown["total"]
+        elif is_special_role(p.hand):
+            result_value = child_breakdown["total"]
+        # バーストは即負け。親がバーストなら子が10.5以下なら勝ち
+        elif dealer_sum > TARGET and not is_tsumo(dealer.hand):
+            result_value = child_breakdown["total"]
+        elif child_sum > TARGET and not is_tsumo(p.hand):
+            result_value = -dealer_role
+        else:
+            if abs(TARGET - child_sum) < abs(TARGET - dealer_sum):
+                result_value = child_breakdown["total"]
+            elif abs(TARGET - child_sum) >= abs(TARGET - dealer_sum):
+                result_value = -dealer_role
+
+        bet = int(p.bet_points or 0)
+        delta = int(bet * result_value)
+        p.points = (p.points or 0) + delta
+        dealer_delta -= delta
+        results[p.seat_index] = {
+            "result": result_value,
+            "bet": bet,
+            "delta": delta,
+            "child_total": child_sum,
+            "dealer_total": dealer_sum,
+            "child_roles": child_breakdown["items"],
+            "child_role_total": child_breakdown["total"],
+            "dealer_roles": dealer_breakdown["items"],
+            "dealer_role_total": dealer_breakdown["total"],
+        }
+
+    if dealer:
+        dealer.points = (dealer.points or 0) + dealer_delta
+    # 次ラウンドで必ず再設定させる
+    for p in room.players():
+        if p.seat_index != st.dealer_seat:
+            p.bet_points = None
+    room.settlement_seq += 1
+    st.results = {
+        "id": room.settlement_seq,
+        "dealer_seat": current_dealer_seat,
+        "dealer_delta": dealer_delta,
+        "pairs": results,
+    }
+    # 親がバーストしたら次の着席者へ交代
+    if dealer_sum > TARGET and not is_tsumo(dealer.hand):
+        nxt = _next_seated_seat(room, current_dealer_seat)
+        if nxt is not None:
+            st.dealer_seat = nxt
+    st.phase = "ended"
+    st.turn_seat = None
+    # 清算後に必ず次ラウンド（配牌→betting）へ
+    room.outbox.append(RoundSettled(st.results))
+
+def _void_round_by_empty_wall(room: Room) -> None:
+    """山切れ時はラウンド無効。親が各子に100支払う。"""
+    st = room.state
+    st.cutin = None
+    st.dealer_first_hidden = False
+    current_dealer_seat = st.dealer_seat
+    dealer_sid = room.seat_to_sid.get(current_dealer_seat)
+    dealer = room.players_by_sid.get(dealer_sid) if dealer_sid else None
+    if not dealer:
+        st.phase = "ended"
+        st.turn_seat = None
+        return
+
+    results = {}
+    dealer_delta = 0
+    for p in room.players():
+        if p.seat_index == current_dealer_seat:
+            continue
+        delta = 100
+        p.points = (p.points or 0) + delta
+        dealer_delta -= delta
+        results[p.seat_index] = {
+            "result": 0,
+            "bet": int(p.bet_points or 0),
+            "delta": delta,
+            "child_total": hand_total(p.hand),
+            "dealer_total": hand_total(dealer.hand),
+            "child_roles": [],
+            "child_role_total": 0,
+            "dealer_roles": [],
+            "dealer_role_total": 0,
+        }
+
+    dealer.points = (dealer.points or 0) + dealer_delta
+    for p in room.players():
+        if p.seat_index != current_dealer_seat:
+            p.bet_points = None
+    room.settlement_seq += 1
+    st.results = {
+        "id": room.settlement_seq,
+        "dealer_seat": current_dealer_seat,
+        "dealer_delta": dealer_delta,
+        "pairs": results,
+        "reason": "wall_empty_void",
+    }
+    st.phase = "ended"
+    st.turn_seat = None
+    room.outbox.append(RoundSettled(st.results))
+
+def _maybe_finish_round(room: Room) -> None:
+    st = room.state
+    if st.phase != "playing":
+        return
+    # まだ誰かが playing 中なら続行
+    if any(p.status == "playing" for p in room.players()):
+        return
+
+    # 全員終了 → 親の伏せ札公開
+    st.dealer_first_hidden = False
+
+    # 清算（子 vs 親）
+    players_sorted = sorted(room.players(), key=lambda pl: pl.seat_index)
+    dealer = next((p for p in players_sorted if p.seat_index == st.dealer_seat), None)
+    if not dealer:
+        st.phase = "ended"; return
+
+    dealer_total = hand_total(dealer.hand)
+    dealer_bust = dealer_total > TARGET
+
+    results = []
+    dealer_delta = 0
+
+    for p in players_sorted:
+        if p.seat_index == st.dealer_seat:  # 親はスキップ
+            continue
+        bet = int(p.bet_points or 0)
+        if bet <= 0:
+            results.append({"child_seat": p.seat_index, "bet": 0, "outcome": "push"})
+            continue
+
+        child_total = hand_total(p.hand)
+        child_bust = child_total > TARGET
+
+        # 勝敗判定
+        if child_bust and dealer_bust:
+            outcome = "push"
+            delta = 0
+        elif child_bust:
+            outcome = "dealer_win"
+            delta = -bet
+        elif dealer_bust:
+            outcome = "child_win"
+            delta = +bet
+        else:
+            d_child = abs(TARGET - child_total)
+            d_deal  = abs(TARGET - dealer_total)
+            if d_child < d_deal:
+                outcome = "child_win"; delta = +bet
+            elif d_child > d_deal:
+                outcome = "dealer_win"; delta = -bet
+            else:
+                outcome = "push"; delta = 0
+
+        # 点数移動（子のdelta。親は反対符号）
+        p.points += delta
+        dealer_delta -= delta
+
+        results.append({
+            "child_seat": p.seat_index,
+            "child_total": child_total,
+            "dealer_total": dealer_total,
+            "bet": bet,
+            "outcome": outcome,
+            "delta_child": delta,
+        })
+
+    dealer.points += dealer_delta
+    st.results = {"dealer_seat": st.dealer_seat, "pairs": results, "dealer_delta": dealer_delta}
+    st.phase = "ended"
+
+# ---------------------- Commands ----------------------
+
+def _next_wall_seed(room: Room) -> int:
+    # 卓ごとの RNG から山の seed を引く（Wall.seed に残るので同じ山を再現できる）
+    if room.rng is None:
+        # os.urandom から seed するので重い。作るだけで遊ばれないルームもあるので遅らせる
+        room.rng = random.Random()
+    return room.rng.getrandbits(63)
+
+def _new_game_locked(room: Room, seed: Optional[int] = None) -> None:
+    """山を作り直し、持ち点を確定して親（東）のリセット確認から始める（seed は再生用。省略時は卓の RNG）"""
+    seed = _next_wall_seed(room) if seed is None else seed
+    _log(room, EV_NEW_GAME, arg=seed)
+    # 点数確定＆状態初期化（ラウンド開始時に掛け金は必ず再設定）
+    for p in room.players():
+        p.points = p.initial_points if (p.initial_points is not None) else 300
+        p.hand.clear()
+        p.discards = []
+        p.ready = False
+        p.status = "playing"
+        p.bet_points = None
+
+    # 親は東（seat_index=0）固定
+    room.state = GameState(
+        phase="reset_prompt",
+        wall=room.state.wall,   # バッファを使い回す
+        turn_seat=None,
+        dealer_seat=0,
+        dealer_first_hidden=True,
+        results={},
+        cutin=None,
+        wall_gen=room.state.wall_gen,
+    )
+    # 山生成（以後のラウンドでは固定）。先頭34枚はドラ表示牌（ゲーム影響なし／表示用）
+    room.state.shuffle_wall(seed)
+
+def _start_game_locked(room: Room, sid: str) -> Optional[str]:
+    if room.state.phase != "waiting":
+        return "Game already started"
+    if not (sid == room.host_sid):
+        return "Only host can start"
+    if room.seats_filled() < 2:
+        return "Need at least 2 players"
+    _new_game_locked(room)
+    return None
+
+def _dealer_reset_locked(room: Room, sid: str, reset: bool, seed: Optional[int] = None) -> Optional[str]:
+    """親が山のリセット可否を確定する（seed は再生用。省略時は卓の RNG）"""
+    st = room.state
+    if st.phase != "reset_prompt":
+        return "Not in reset prompt"
+    if st.dealer_seat is None:
+        return "Dealer not set"
+    if room.seat_to_sid.get(st.dealer_seat) != sid:
+        return "Only dealer can decide"
+
+    if reset:
+        seed = _next_wall_seed(room) if seed is None else seed
+        _log(room, EV_DEALER_RESET, st.dealer_seat, seed)
+        st.shuffle_wall(seed)
+    else:
+        required = INITIAL_HAND_SIZE * len(room.players())
+        if len(st.wall) < required:
+            return "Wall empty. Please reset."
+        _log(room, EV_DEALER_RESET, st.dealer_seat, -1)
+
+    _prepare_betting_phase(room)
+    return None
+
+def _set_bet_for_player(room: Room, p: Player, bet: int) -> Optional[str]:
+    """子のベット額を設定し、全員そろえば配牌済みのまま playing へ"""
+    if room.state.phase != "betting":
+        return "Not in betting phase"
+    # 親はベット不要（無視）
+    if p.seat_index == room.state.dealer_seat:
+        return "Dealer does not bet"
+    _log(room, EV_BET, p.seat_index, bet)
+    # 所持点（開始時持ち点を優先）を超えないようにクランプ
+    available = p.initial_points if p.initial_points is not None else (p.points if p.points is not None else 300)
+    p.bet_points = max(0, min(bet, available))
+    if room.state.phase == "betting" and _all_children_bet(room):
+        _start_playing_phase(room)
+    return None
+
+def _set_initial_points_for_player(room: Room, p: Player, pts: int) -> Optional[str]:
+    """待機中に持ち点（開始時に採用）を設定する"""
+    if room.state.phase != "waiting":
+        return "Game already started"
+    _log(room, EV_INITIAL_POINTS, p.seat_index, pts)
+    p.initial_points = pts
+    # 既にベット設定済みなら、持ち点に合わせてクランプ
+    if p.bet_points is not None and p.seat_index != room.state.dealer_seat:
+        p.bet_points = max(0, min(p.bet_points, pts))
+    return None
+
+def _add_points_for_player(room: Room, p: Player, add: int) -> Optional[str]:
+    """飛び（0以下）のときに点数を足す"""
+    if (p.points or 0) > 0:
+        return "Only available when points are 0 or less"
+    _log(room, EV_ADD_POINTS, p.seat_index, add)
+    p.points = (p.points or 0) + add
+    return None
+
+# ---------------------- Bots ----------------------
+
+def _bot_choose_bet(p: Player, dora_weights: List[int], wall_counts: Optional[List[int]] = None) -> int:
+    total = hand_total(p.hand)
+    if total > TARGET:
+        return 0
+    if is_special_role(p.hand):
+        return 10
+
+    # ドラ点数が高いほど高ベット
+    dora_total = count_dora(p.hand, dora_weights)
+
+    # 数字（合計）が低いほど高ベット、9以上は高め
+    low_bonus = {0.5: 5, 1: 4, 2: 2}.get(total, 0)
+    high_bonus = 4.5 if total >= 9.0 else 0.0
+
+    score = (dora_total / 2) + low_bonus + high_bonus
+    # 山の残りが分かれば、次の1枚で役が付く確率も加味する
+    if wall_counts is not None:
+        score += BOT_SPECIAL_BET_WEIGHT * draw_odds(p.hand, wall_counts, table=HAND_TABLE).special
+    bet = int(round(score))
+    bet = max(1, min(10, bet))
+    available = p.initial_points if p.initial_points is not None else (p.points if p.points is not None else 300)
+    return max(1, min(bet, available))
+
+def _bot_should_draw(p: Player, dora_weights: List[int], wall_counts: Optional[List[int]] = None) -> bool:
+    if is_special_role(p.hand):
+        return False
+    total = hand_total(p.hand)
+    if total == 10:
+        if count_dora(p.hand, dora_weights)<=5:
+            return True
+    if total >= 8:
+        return False
+    # 山の残りが偏っていて、次の1枚でほぼバーストするなら引かない
+    if wall_counts is not None and draw_odds(p.hand, wall_counts, table=HAND_TABLE).bust >= BOT_MAX_BUST_RISK:
+        return False
+    return total < TARGET
+
+def _bot_wall_counts(room: Room, p: Player) -> List[int]:
+    """BOT p から見える山の残り枚数。親の伏せ札は見えないので、親以外には山に戻して数える
+
+    山の本当の残り（wall.counts）から公開の手牌を引くと、伏せ札が何かが分かってしまう。
+    """
+    st = room.state
+    counts = st.wall.counts
+    if not st.dealer_first_hidden or p.seat_index == st.dealer_seat:
+        return counts
+    dealer = room.players_by_sid.get(room.seat_to_sid.get(st.dealer_seat) or "")
+    if dealer is None or not dealer.hand:
+        return counts
+    counts = list(counts)
+    counts[dealer.hand[0]] += 1
+    return counts
+
+def _bot_bet(room: Room, p: Player, policy: Optional[BotPolicy] = None) -> int:
+    st = room.state
+    policy = policy or BOT_POLICY
+    counts = _bot_wall_counts(room, p)
+    if policy is None or len(p.hand) != 1:
+        return _bot_choose_bet(p, st.dora_weights, counts if BOT_USE_ODDS else None)
+    available = p.initial_points if p.initial_points is not None else (p.points if p.points is not None else 300)
+    return max(0, min(policy.bet(p.hand[0], counts), available))
+
+def _bot_draws(room: Room, p: Player, policy: Optional[BotPolicy] = None) -> bool:
+    st = room.state
+    policy = policy or BOT_POLICY
+    counts = _bot_wall_counts(room, p)
+    if policy is not None and p.seat_index != st.dealer_seat:
+        dealer = room.players_by_sid.get(room.seat_to_sid.get(st.dealer_seat, ""))
+        if dealer is not None and dealer.hand:
+            decision = policy.should_draw(p.hand, dealer.hand, counts)
+            if decision is not None:
+                return decision
+    # 親の BOT と表の範囲外はヒューリスティック
+    return _bot_should_draw(p, st.dora_weights, counts if BOT_USE_ODDS else None)
+
+def _bot_step_locked(room: Room) -> bool:
+    st = room.state
+    # 0以下のBOTは自動で300点補充
+    for p in room.players():
+        if p.is_bot and (p.points or 0) <= 0:
+            _add_points_for_player(room, p, 300)
+
+    if st.phase == "reset_prompt":
+        dealer_sid = room.seat_to_sid.get(st.dealer_seat)
+        dealer = room.players_by_sid.get(dealer_sid) if dealer_sid else None
+        if dealer and dealer.is_bot:
+            required = INITIAL_HAND_SIZE * len(room.players())
+            need_reset = len(st.wall) < required or len(st.wall) <= 30
+            _dealer_reset_locked(room, dealer_sid, need_reset)
+            return True
+        return False
+
+    if st.phase == "betting":
+        acted = False
+        for p in room.players():
+            if not p.is_bot:
+                continue
+            if p.seat_index == st.dealer_seat:
+                continue
+            if p.bet_points is None:
+                # 全員そろえば _set_bet_for_player が playing へ進める
+                _set_bet_for_player(room, p, _bot_bet(room, p))
+                acted = True
+        return acted
+
+    if st.phase == "playing":
+        sid = room.seat_to_sid.get(st.turn_seat)
+        p = room.players_by_sid.get(sid) if sid else None
+        if p and p.is_bot and p.status == "playing":
+            if _bot_draws(room, p):
+                _draw_tile_for_player(room, p)
+            else:
+                _stay_for_player(room, p)
+            return True
+    return False
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+操作ログと再生
+--------------
+受け付けたコマンド（draw_tile / stay / set_bet_points / dealer_reset、BOT の行動も同じ関数を通る）と
+山の seed を、ルームごとの通し番号付きで追記専用のバイナリログに残し、任意の番号の時点の卓を作り直す。
+清算（_end_round）の問い合わせの調査や、ルール変更を本番の操作列で確かめるのに使う。
+
+- 記録: engine.py のコマンド関数が検証を通った時点で _log を呼び、RoomJournal がこの形式に詰めて
+  EventLog のバッファに積む。席の変化（EV_SEATS）とルーム丸ごと（EV_CHECKPOINT: 作成・復元時）も残す
+- 書き込み: server.py が TOPPAN_EVENT_LOG_FLUSH 秒ごとにバッファをまとめて書き、fsync は1回だけ
+  （スレッドで動く）。落ちたときに失うのは最後の1回分まで。書けなかったらバッファに戻し、途中まで書けた末尾を
+  切り詰めて次は新しいセグメントに書く（読むときに、書き直しで重なった記録は捨てる）
+- ファイル: セグメント（<dir>/<開始時刻>-w<ワーカー>-<pid>-<連番>.evlog）。ワーカーの起動ごとと
+  TOPPAN_EVENT_LOG_SEGMENT_MB を超えるごとに新しくし、そのワーカーのセグメントの合計が
+  TOPPAN_EVENT_LOG_RETAIN_MB を超えたら古い方から消す。大きさで移ったときは server.py が全ルームの
+  EV_CHECKPOINT を新しいセグメントの先頭に積むので、古いセグメントが消えても残りだけで再生できる。
+  レコードは crc32 + 固定長ヘッダ + room_id + payload で、書きかけの末尾は読むときに捨てる
+- 再生: 直前の EV_CHECKPOINT から同じコマンド関数を記録どおりの seed・引数で呼び直す（sleep も送信も無い）
+
+    python -m eventlog events/                          # ルームごとの記録数と番号の範囲
+    python -m eventlog events/ --room ABC123 [--seq N]  # 清算の一覧と N 番の時点の卓
+"""
+
+from __future__ import annotations
+import argparse
+import contextlib
+import itertools
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import snapshot
+from tiles import TILE_LABELS
+from engine import (
+    EV_ADD_POINTS, EV_BET, EV_CHECKPOINT, EV_DEALER_RESET, EV_DRAW, EV_INITIAL_POINTS, EV_NEW_GAME, EV_NEXT_ROUND,
+    EV_REBIND, EV_SEATS, EV_STAY, Effect, Player, Room, RoundSettled,
+    _add_points_for_player, _dealer_reset_locked, _draw_tile_for_player, _new_game_locked, _set_bet_for_player,
+    _set_initial_points_for_player, _start_next_round_locked, _stay_for_player, drain_effects,
+)
+
+LOG_MAGIC = b"TPEV"
+LOG_VERSION = 1
+SEGMENT_SUFFIX = ".evlog"
+_FILE_HEADER = struct.Struct("!4sB")
+_CRC = struct.Struct("<I")
+# room_id の長さ, payload の長さ, 通し番号, 時刻, 種類, 席(-1 は無し), 引数
+_BODY = struct.Struct("<BIIdBbq")
+_STR = struct.Struct("<H")
+SEGMENT_BYTES = int(float(os.environ.get("TOPPAN_EVENT_LOG_SEGMENT_MB", "64")) * 2 ** 20)   # これを超えたら次のセグメント
+RETAIN_BYTES = int(float(os.environ.get("TOPPAN_EVENT_LOG_RETAIN_MB", "1024")) * 2 ** 20)   # ワーカーごとに残す合計
+
+OP_NAMES = {
+    EV_CHECKPOINT: "checkpoint", EV_SEATS: "seats", EV_REBIND: "rebind", EV_NEW_GAME: "new_game",
+    EV_NEXT_ROUND: "next_round", EV_DEALER_RESET: "dealer_reset", EV_BET: "bet", EV_DRAW: "draw", EV_STAY: "stay",
+    EV_INITIAL_POINTS: "initial_points", EV_ADD_POINTS: "add_points",
+}
+
+
+class Event(NamedTuple):
+    room_id: str
+    seq: int
+    time: float
+    op: int
+    seat: int
+    arg: int
+    payload: bytes
+
+
+def encode_event(room_id: str, seq: int, t: float, op: int, seat: int, arg: int, payload: bytes = b"") -> bytes:
+    rid = room_id.encode()
+    body = _BODY.pack(len(rid), len(payload), seq, t, op, seat, arg) + rid + payload
+    return _CRC.pack(zlib.crc32(body)) + body
+
+
+def decode_events(blob: bytes, offset: int = 0) -> Iterator[Event]:
+    """レコードを順に読む。書きかけ・壊れたレコードに当たったらそこで終わる"""
+    head = _CRC.size + _BODY.size
+    end = len(blob)
+    while offset + head <= end:
+        (crc,) = _CRC.unpack_from(blob, offset)
+        rid_len, payload_len, seq, t, op, seat, arg = _BODY.unpack_from(blob, offset + _CRC.size)
+        stop = offset + head + rid_len + payload_len
+        if stop > end or zlib.crc32(blob[offset + _CRC.size:stop]) != crc:
+            return
+        rid = blob[offset + head:offset + head + rid_len].decode()
+        yield Event(rid, seq, t, op, seat, arg, bytes(blob[offset + head + rid_len:stop]))
+        offset = stop
+
+
+# ---------------------- Writer ----------------------
+
+def segment_name(worker: int = 0, part: int = 0) -> str:
+    """同じ秒に移っても連番で古い順に並ぶ"""
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-w{worker}-{os.getpid()}-{part:04d}{SEGMENT_SUFFIX}"
+
+
+class EventLog:
+    """ワーカーごとの追記専用ログ。append はバッファに積むだけ（ループ上）、write がまとめて書いて fsync する（スレッド）"""
+
+    def __init__(
+        self,
+        directory: str,
+        worker: int = 0,
+        name: Optional[str] = None,
+        segment_bytes: int = SEGMENT_BYTES,
+        retain_bytes: int = RETAIN_BYTES,
+    ) -> None:
+        self.directory = directory
+        self.worker = worker
+        self.parts = itertools.count()
+        self.path = os.path.join(directory, name or segment_name(worker, next(self.parts)))
+        self.segment_bytes = segment_bytes
+        self.retain_bytes = retain_bytes
+        self.buffer = bytearray()
+        self.file = None   # 最初に書くときに開く（記録が無ければファイルも作らない）
+        self.write_lock = threading.Lock()
+        self.rotated = False    # 大きさで次のセグメントに移った（server.py が全ルームの checkpoint を積む）
+        self.records = 0        # 積んだレコード数
+        self.written_bytes = 0  # 書き終えた（fsync 済みの）バイト数
+        self.flushes = 0
+        self.write_errors = 0
+        self.pruned = 0         # 保存量の上限で消したセグメント数
+
+    def journal(self) -> "RoomJournal":
+        return RoomJournal(self)
+
+    def append(self, room_id: str, seq: int, op: int, seat: int, arg: int, payload: bytes = b"") -> None:
+        self.buffer += encode_event(room_id, seq, time.time(), op, seat, arg, payload)
+        self.records += 1
+
+    def take(self) -> bytes:
+        """積んであるレコードを取り出す（ループ上で呼び、write に渡す）"""
+        data, self.buffer = bytes(self.buffer), bytearray()
+        return data
+
+    def put_back(self, data: bytes) -> None:
+        """書けなかったレコードをバッファの先頭に戻す（ループ上で呼ぶ。次の write で新しいセグメントに書く）"""
+        self.buffer[:0] = data
+
+    def write(self, data: bytes) -> None:
+        """data を書いて fsync する。失敗したら書きかけを切り詰めてセグメントを替え、例外はそのまま投げる"""
+        with self.write_lock:
+            start = None
+            try:
+                if self.file is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._prune()
+                    self.file = open(self.path, "ab")
+                    if self.file.tell() == 0:
+                        self.file.write(_FILE_HEADER.pack(LOG_MAGIC, LOG_VERSION))
+                start = self.file.tell()
+                self.file.write(data)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError:
+                self.write_errors += 1
+                self._abandon(start)
+                raise
+            self.written_bytes += len(data)
+            self.flushes += 1
+            if self.file.tell() >= self.segment_bytes:
+                self.file.close()
+                self._next_segment()
+                self.rotated = True
+
+    def _abandon(self, start: Optional[int]) -> None:
+        """書けなかったセグメントを閉じる。途中まで書けた末尾は切り詰める（残すと後ろの記録が読めない）"""
+        if self.file is not None:
+            with contextlib.suppress(OSError):
+                self.file.close()
+            if start is not None:
+                with contextlib.suppress(OSError):
+                    os.truncate(self.path, start)
+        self._next_segment()
+
+    def _next_segment(self) -> None:
+        self.file = None
+        self.path = os.path.join(self.directory, segment_name(self.worker, next(self.parts)))
+
+    def _prune(self) -> None:
+        """このワーカーの古いセグメントを、合計が retain_bytes に収まるまで消す（これから書く分は数えない）"""
+        mine = f"-w{self.worker}-"
+        segments = [p for p in segment_paths(self.directory) if mine in os.path.basename(p) and p != self.path]
+        sizes = [os.path.getsize(p) for p in segments]
+        total = sum(sizes)
+        for path, size in zip(segments, sizes):
+            if total <= self.retain_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+                self.pruned += 1
+            total -= size
+
+    def close(self) -> None:
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"records": self.records, "bytes": self.written_bytes, "pending_bytes": len(self.buffer),
+                "flushes": self.flushes, "write_errors": self.write_errors, "pruned_segments": self.pruned}
+
+
+def _seat_key(room: Room) -> tuple:
+    return (room.host_sid, *(room.seat_to_sid.get(i) for i in range(4)))
+
+
+def _pack_strs(strs: List[str]) -> bytes:
+    out = bytearray()
+    for s in strs:
+        b = s.encode()[:0xFFFF]
+        out += _STR.pack(len(b)) + b
+    return bytes(out)
+
+
+def _unpack_strs(payload: bytes) -> List[str]:
+    out, offset = [], 0
+    while offset < len(payload):
+        (n,) = _STR.unpack_from(payload, offset)
+        offset += _STR.size
+        out.append(payload[offset:offset + n].decode(errors="replace"))
+        offset += n
+    return out
+
+
+def _seats_payload(room: Room) -> bytes:
+    """host と席ごとの (sid, 名前, BOT か)。空席は sid が空"""
+    strs = [room.host_sid or ""]
+    for i in range(4):
+        sid = room.seat_to_sid.get(i)
+        p = room.players_by_sid.get(sid) if sid else None
+        strs += [sid, p.name, "1" if p.is_bot else ""] if p else ["", "", ""]
+    return _pack_strs(strs)
+
+
+class RoomJournal:
+    """ルームごとの記録係（Room.journal）。通し番号は Room.event_seq に持つのでスナップショットでも続く"""
+
+    __slots__ = ("log", "seated")
+
+    def __init__(self, log: EventLog) -> None:
+        self.log = log
+        self.seated: Optional[tuple] = None   # 最後に記録した席と host
+
+    def record(self, room: Room, op: int, seat: int = -1, arg: int = 0, payload: bytes = b"") -> None:
+        if op == EV_REBIND:
+            # 付け替えは席の変化ではない（呼ぶ側が付け替える前に seats で確定させてある）
+            self._append(room, op, seat, arg, payload)
+            self.seated = _seat_key(room)
+            return
+        self.seats(room)   # host だけの変更などは次のコマンドの前に残す
+        self._append(room, op, seat, arg, payload)
+
+    def seats(self, room: Room) -> None:
+        key = _seat_key(room)
+        if key != self.seated:
+            self.seated = key
+            self._append(room, EV_SEATS, -1, 0, _seats_payload(room))
+
+    def checkpoint(self, room: Room) -> None:
+        """ルーム丸ごと（snapshot.py の形）。再生はここから始まる"""
+        payload = pickle.dumps((snapshot._SCHEMA, snapshot.capture_room(room)), protocol=pickle.HIGHEST_PROTOCOL)
+        self.seated = _seat_key(room)
+        self._append(room, EV_CHECKPOINT, -1, 0, payload)
+
+    def _append(self, room: Room, op: int, seat: int, arg: int, payload: bytes) -> None:
+        room.event_seq += 1
+        self.log.append(room.room_id, room.event_seq, op, seat, arg, payload)
+
+
+# ---------------------- Reader ----------------------
+
+def segment_paths(path: str) -> List[str]:
+    """ディレクトリならセグメントを古い順に、ファイルならそれだけ"""
+    if os.path.isdir(path):
+        return sorted(e.path for e in os.scandir(path) if e.name.endswith(SEGMENT_SUFFIX))
+    return [path]
+
+
+def read_events(path: str) -> Iterator[Event]:
+    for seg in segment_paths(path):
+        with open(seg, "rb") as f:
+            blob = f.read()
+        if len(blob) < _FILE_HEADER.size:
+            continue
+        magic, version = _FILE_HEADER.unpack_from(blob)
+        if magic != LOG_MAGIC or version != LOG_VERSION:
+            raise ValueError(f"{seg}: not an event log (magic={magic!r}, version={version})")
+        yield from decode_events(blob, _FILE_HEADER.size)
+
+
+def load_history(events: Iterator[Event], room_id: Optional[str] = None) -> Dict[str, List[Event]]:
+    """ルームごとの記録（番号順）。EV_CHECKPOINT より後の番号の記録は捨てる
+    （スナップショットから復元したルームは、落ちる前に書けていたその先の記録とは別の歴史になる）。
+    それ以外で番号が戻った記録は、書けなかった分を次のセグメントに書き直したときの重なりなので捨てる
+    """
+    rooms: Dict[str, List[Event]] = {}
+    for e in events:
+        if room_id is not None and e.room_id != room_id:
+            continue
+        history = rooms.setdefault(e.room_id, [])
+        if e.op == EV_CHECKPOINT:
+            while history and history[-1].seq >= e.seq:
+                history.pop()
+        elif history and history[-1].seq >= e.seq:
+            continue
+        history.append(e)
+    return rooms
+
+
+# ---------------------- Replay ----------------------
+
+def _restore_checkpoint(e: Event) -> Room:
+    schema, data = pickle.loads(e.payload)
+    room = snapshot.restore_room(data, schema)
+    room.event_seq = e.seq
+    return room
+
+
+def _apply_seats(room: Room, payload: bytes) -> None:
+    host, *seats = _unpack_strs(payload)
+    seated: Dict[str, Player] = {}
+    for i in range(4):
+        sid, name, bot = seats[3 * i:3 * i + 3]
+        room.seat_to_sid[i] = sid or None
+        if sid:
+            p = room.players_by_sid.get(sid)
+            seated[sid] = p if p is not None and p.seat_index == i else Player(
+                sid=sid, name=name, seat_index=i, is_bot=bool(bot))
+    for sid in [sid for sid, p in room.players_by_sid.items() if seated.get(sid) is not p]:
+        del room.players_by_sid[sid]
+    for sid, p in seated.items():
+        room.players_by_sid.setdefault(sid, p)
+    room.host_sid = host or None
+
+
+def _apply_rebind(room: Room, seat: int, sid: str) -> None:
+    old = room.seat_to_sid.get(seat)
+    player = room.players_by_sid.pop(old)
+    player.sid = sid
+    room.players_by_sid[sid] = player
+    room.seat_to_sid[seat] = sid
+    if room.host_sid == old:
+        room.host_sid = sid
+
+
+_COMMANDS = {
+    EV_NEW_GAME: lambda room, p, e: _new_game_locked(room, e.arg),
+    EV_NEXT_ROUND: lambda room, p, e: _start_next_round_locked(room),
+    EV_DEALER_RESET: lambda room, p, e: _dealer_reset_locked(room, p.sid, e.arg >= 0, e.arg if e.arg >= 0 else None),
+    EV_BET: lambda room, p, e: _set_bet_for_player(room, p, e.arg),
+    EV_DRAW: lambda room, p, e: _draw_tile_for_player(room, p),
+    EV_STAY: lambda room, p, e: _stay_for_player(room, p),
+    EV_INITIAL_POINTS: lambda room, p, e: _set_initial_points_for_player(room, p, e.arg),
+    EV_ADD_POINTS: lambda room, p, e: _add_points_for_player(room, p, e.arg),
+}
+
+
+def apply_event(room: Room, e: Event) -> Optional[str]:
+    """記録を1つ当てる。コマンドが断られたらそのエラー（ルールを変えて再生したときの食い違い）"""
+    if e.op == EV_SEATS:
+        _apply_seats(room, e.payload)
+    elif e.op == EV_REBIND:
+        _apply_rebind(room, e.seat, e.payload.decode())
+    else:
+        command = _COMMANDS.get(e.op)
+        if command is None:
+            return f"unknown op {e.op}"
+        sid = room.seat_to_sid.get(e.seat) if e.seat >= 0 else None
+        p = room.players_by_sid.get(sid) if sid else None
+        if p is None and e.seat >= 0:
+            return f"no player at seat {e.seat}"
+        err = command(room, p, e)
+        if err:
+            return err
+    room.event_seq = e.seq
+    return None
+
+
+def replay_steps(history: List[Event], upto: Optional[int] = None) -> Iterator[Tuple[Event, Room, Optional[str], List[Effect]]]:
+    """upto 番（省略時は最後）まで再生し、1つ当てるごとに (記録, 卓, エラー, 積まれた副作用) を返す"""
+    start = None
+    for i, e in enumerate(history):
+        if upto is not None and e.seq > upto:
+            break
+        if e.op == EV_CHECKPOINT:
+            start = i
+    if start is None:
+        raise ValueError("no checkpoint at or before the requested sequence number")
+    room = _restore_checkpoint(history[start])
+    yield history[start], room, None, []
+    for e in history[start + 1:]:
+        if upto is not None and e.seq > upto:
+            return
+        err = apply_event(room, e)
+        yield e, room, err, drain_effects(room)
+
+
+def replay(history: List[Event], upto: Optional[int] = None) -> Room:
+    """upto 番の記録を当てた直後の卓"""
+    room = None
+    for _, room, _, _ in replay_steps(history, upto):
+        pass
+    return room
+
+
+# ---------------------- CLI ----------------------
+
+def _format_settlement(seq: int, results: dict) -> str:
+    pairs = " ".join(
+        f"{seat}:{r['bet']}x{r['result']:g}={r['delta']:+d}" for seat, r in sorted(results.get("pairs", {}).items())
+    )
+    return f"#{seq:<6} settlement {results.get('id')}: dealer {results.get('dealer_seat')} " \
+           f"{results.get('dealer_delta', 0):+d}  {pairs}"
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("path", help="ログのディレクトリかセグメント")
+    ap.add_argument("--room", help="再生するルーム")
+    ap.add_argument("--seq", type=int, help="この番号の記録を当てた直後で止める")
+    args = ap.parse_args()
+
+    rooms = load_history(read_events(args.path), args.room)
+    if not args.room:
+        for rid, history in sorted(rooms.items()):
+            plays = sum(1 for e in history if e.op in (EV_DRAW, EV_STAY))
+            print(f"{rid}  events {len(history):7d}  seq {history[0].seq}..{history[-1].seq}  plays {plays}")
+        return
+    history = rooms.get(args.room)
+    if not history:
+        raise SystemExit(f"no events for room {args.room}")
+
+    t0 = time.perf_counter()
+    n = 0
+    first = room = None
+    for e, room, err, effects in replay_steps(history, args.seq):
+        n += 1
+        first = first or e
+        if err:
+            print(f"#{e.seq:<6} {OP_NAMES.get(e.op, e.op)} seat {e.seat}: {err}")
+        for effect in effects:
+            if isinstance(effect, RoundSettled):
+                print(_format_settlement(e.seq, effect.results))
+    elapsed = time.perf_counter() - t0
+    span = e.time - first.time
+    st = room.state
+    print(f"replayed {n} events in {elapsed * 1e3:.1f} ms ({span:.0f} s of play)")
+    print(f"at #{room.event_seq}: phase {st.phase}, turn {st.turn_seat}, dealer {st.dealer_seat}, wall {len(st.wall)} "
+          f"(seed {st.wall.seed})")
+    for p in sorted(room.players(), key=lambda p: p.seat_index):
+        print(f"  seat {p.seat_index} {p.name}{' (BOT)' if p.is_bot else ''}: points {p.points}, bet {p.bet_points}, "
+              f"{p.status}, hand {' '.join(TILE_LABELS[t] for t in p.hand)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+役判定テーブル（オフライン生成 + mmap 読み込み）
+------------------------------------------------
+手牌の判定結果（合計・十半・ツモ・バースト・N枚引き・カットイン）は
+ドラを除けば次の「正規化シグネチャ」だけで決まる:
+
+    (ツモ種別, 枚数, 東の枚数, 点数合計×2)
+
+- ツモ種別: 2枚のときだけ 0 / 5（同じ数字）/ 10（同じ牌）
+- 東の +9.5 は「素点 + 9.5 <= 10.5」のときだけ付くので東の枚数で決まる
+
+これを枚数上限まで全列挙して固定長レコードの配列としてファイルに書き出し、
+サーバは起動時に mmap で読み込む（uvicorn の各ワーカーで同じページを共有）。
+表の範囲外の手（上限超えの枚数など）は evaluate_signature で直接計算する。
+
+表はソースの隣ではなくキャッシュディレクトリ（$XDG_CACHE_HOME/toppan、既定 ~/.cache/toppan）に置く。
+無ければ初回に書き、書けない（読み取り専用など）ならプロセス内で作ったものをそのまま使う。
+
+Generate:
+    python hand_table.py --max-len 24 [-o PATH]     # make hand-table
+"""
+
+from __future__ import annotations
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from tiles import EAST, TILE_HALF, TILE_RANK
+
+TARGET = 10.5
+TARGET_HALF = 21
+EAST_BONUS_HALF = 19          # 東の +9.5
+MAX_EAST = 4
+# 到達しうる素点の上限: 10.5 以下の手に 9 を1枚足したところで止まる
+MAX_BASE_HALF = TARGET_HALF + 18
+DEFAULT_MAX_LEN = 24
+TSUMO_KINDS = (0, 5, 10)
+
+TABLE_VERSION = 1
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "toppan")
+DEFAULT_PATH = os.path.join(CACHE_DIR, "hand_table.bin")
+
+# ファイル形式: ヘッダ + RECORD * (3 * (max_len+1) * 5 * (MAX_BASE_HALF+1))
+HEADER = struct.Struct("<4sHHH6x")      # magic, version, max_len, max_base_half
+MAGIC = b"TPHT"
+RECORD = struct.Struct("<BBBxH")        # total_half, flags, cutin, role
+
+# flags
+TOPPAN = 1
+TSUMO = 2
+TSUMO_PAIR = 4     # 同じ牌2枚（×10）
+OVER = 8           # 合計 > 10.5
+DEAD = 16          # バースト（ツモ以外で 10.5 超え）→ 役 0
+SPECIAL = 32       # is_special_role
+MANY = 64          # 5枚以上でバーストなし
+
+# cutin コード -> (label, sound)。5 は "N枚引き"
+CUTIN_NONE = 0
+CUTIN_MANY = 5
+CUTINS = {
+    1: ("十半", "special1"),
+    2: ("十半", "special2"),
+    3: ("十半", "normal"),
+    4: ("ツモ", "normal"),
+}
+
+
+class Outcome(NamedTuple):
+    total_half: int
+    flags: int
+    cutin: int
+    role: int     # ドラを除いた役の合計（バーストなら 0）
+
+
+def hand_signature(hand: Sequence[int]) -> Tuple[int, int, int, int]:
+    """手牌 -> (ツモ種別, 枚数, 東の枚数, 点数合計×2)"""
+    n = len(hand)
+    kind = 0
+    if n == 2:
+        a, b = hand
+        if a == b:
+            kind = 10
+        elif TILE_RANK[a] == TILE_RANK[b]:
+            kind = 5
+    base_half = 0
+    n_east = 0
+    for t in hand:
+        base_half += TILE_HALF[t]
+        if t == EAST:
+            n_east += 1
+    return kind, n, n_east, base_half
+
+
+class Hand(list):
+    """牌IDのリスト + 増分更新される集計。
+
+    append のたびに素点（×2）・東の枚数・先頭2枚の関係（ツモ種別）を
+    更新するので、シグネチャは手牌を走査せずに O(1) で得られる。
+    それ以外の変更（insert / pop / remove / 添字・スライス代入 / del / += / *=）は
+    変更後に手牌を走査し直して集計を合わせる。
+    """
+
+    __slots__ = ("base_half", "n_east", "pair_kind")
+
+    def __init__(self, tiles: Iterable[int] = ()) -> None:
+        super().__init__()
+        self.base_half = 0
+        self.n_east = 0
+        self.pair_kind = 0
+        for t in tiles:
+            self.append(t)
+
+    def append(self, tile: int) -> None:
+        if len(self) == 1:
+            first = self[0]
+            if first == tile:
+                self.pair_kind = 10
+            elif TILE_RANK[first] == TILE_RANK[tile]:
+                self.pair_kind = 5
+        self.base_half += TILE_HALF[tile]
+        if tile == EAST:
+            self.n_east += 1
+        super().append(tile)
+
+    def extend(self, tiles: Iterable[int]) -> None:
+        for t in tiles:
+            self.append(t)
+
+    def __iadd__(self, tiles: Iterable[int]) -> "Hand":
+        self.extend(tiles)
+        return self
+
+    def clear(self) -> None:
+        super().clear()
+        self.base_half = 0
+        self.n_east = 0
+        self.pair_kind = 0
+
+    def _rescan(self) -> None:
+        """手牌を走査し直して集計を合わせる"""
+        _, _, self.n_east, self.base_half = hand_signature(self)
+        self.pair_kind = hand_signature(self[:2])[0]   # 先頭2枚の関係（2枚でなければ 0）
+
+    def insert(self, index: int, tile: int) -> None:
+        super().insert(index, tile)
+        self._rescan()
+
+    def pop(self, index: int = -1) -> int:
+        tile = super().pop(index)
+        self._rescan()
+        return tile
+
+    def remove(self, tile: int) -> None:
+        super().remove(tile)
+        self._rescan()
+
+    def __setitem__(self, index, value) -> None:
+        super().__setitem__(index, value)
+        self._rescan()
+
+    def __delitem__(self, index) -> None:
+        super().__delitem__(index)
+        self._rescan()
+
+    def __imul__(self, n: int) -> "Hand":
+        super().__imul__(n)
+        self._rescan()
+        return self
+
+    def signature(self) -> Tuple[int, int, int, int]:
+        n = len(self)
+        return (self.pair_kind if n == 2 else 0), n, self.n_east, self.base_half
+
+    def __reduce__(self):
+        return (Hand, (list(self),))
+
+
+def evaluate_signature(kind: int, length: int, n_east: int, base_half: int) -> Outcome:
+    """シグネチャから判定結果を計算する（ルールの定義はここだけ）。"""
+    total_half = base_half
+    for _ in range(n_east):
+        if total_half + EAST_BONUS_HALF <= TARGET_HALF:
+            total_half += EAST_BONUS_HALF
+
+    toppan = total_half == TARGET_HALF
+    tsumo = kind > 0
+    over = total_half > TARGET_HALF
+    many = length >= 5 and not over
+    special = toppan or tsumo or many
+    dead = over and not tsumo
+
+    flags = 0
+    if toppan:
+        flags |= TOPPAN
+    if tsumo:
+        flags |= TSUMO
+    if kind == 10:
+        flags |= TSUMO_PAIR
+    if over:
+        flags |= OVER
+    if dead:
+        flags |= DEAD
+    if special:
+        flags |= SPECIAL
+    if many:
+        flags |= MANY
+
+    role = 0
+    if not dead:
+        role = 1 + kind + (10 if toppan else 0) + ((length - 4) * 5 if length >= 5 else 0)
+
+    cutin = CUTIN_NONE
+    if special:
+        if toppan and many:
+            cutin = 1
+        elif toppan and tsumo:
+            cutin = 2
+        elif toppan:
+            cutin = 3
+        elif tsumo:
+            cutin = 4
+        elif many:
+            cutin = CUTIN_MANY
+    return Outcome(total_half, flags, cutin, role)
+
+
+def cutin_for(outcome: Outcome, length: int) -> Optional[dict]:
+    if outcome.cutin == CUTIN_NONE:
+        return None
+    if outcome.cutin == CUTIN_MANY:
+        return {"label": f"{length}枚引き", "sound": "normal"}
+    label, sound = CUTINS[outcome.cutin]
+    return {"label": label, "sound": sound}
+
+
+def generate(max_len: int = DEFAULT_MAX_LEN) -> bytes:
+    """枚数 max_len までの全シグネチャを列挙してテーブルのバイト列を作る。"""
+    out = bytearray(HEADER.pack(MAGIC, TABLE_VERSION, max_len, MAX_BASE_HALF))
+    for kind in TSUMO_KINDS:
+        for length in range(max_len + 1):
+            for n_east in range(MAX_EAST + 1):
+                for base_half in range(MAX_BASE_HALF + 1):
+                    o = evaluate_signature(kind, length, n_east, base_half)
+                    out += RECORD.pack(o.total_half, o.flags, o.cutin, o.role)
+    return bytes(out)
+
+
+def write_table(path: str = DEFAULT_PATH, max_len: int = DEFAULT_MAX_LEN) -> None:
+    """一時ファイルに書いてから rename する（並行起動したワーカーが壊れた表を読まないように）"""
+    data = generate(max_len)
+    d = os.path.dirname(os.path.abspath(path))
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d, prefix=".hand_table.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class HandTable:
+    """mmap したテーブルを引く。表の範囲外は evaluate_signature にフォールバック。"""
+
+    def __init__(self, buf, max_len: int) -> None:
+        self._buf = buf
+        self.max_len = max_len
+        # デコード済みレコード。プロセスごとに実際に引いたものだけ持つ（本体は mmap 側）
+        self._decoded: List[Optional[Outcome]] = [None] * ((len(buf) - HEADER.size) // RECORD.size)
+
+    @classmethod
+    def open(cls, path: str = DEFAULT_PATH) -> "HandTable":
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, max_len, max_base_half = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != TABLE_VERSION or max_base_half != MAX_BASE_HALF:
+            mm.close()
+            raise ValueError(f"incompatible hand table: {path}")
+        expected = HEADER.size + RECORD.size * 3 * (max_len + 1) * (MAX_EAST + 1) * (MAX_BASE_HALF + 1)
+        if len(mm) != expected:
+            mm.close()
+            raise ValueError(f"truncated hand table: {path}")
+        return cls(mm, max_len)
+
+    def records(self) -> memoryview:
+        """ヘッダを除いたレコード領域（NumPy などからゼロコピーで読む用）"""
+        return memoryview(self._buf)[HEADER.size:]
+
+    def outcome(self, kind: int, length: int, n_east: int, base_half: int) -> Outcome:
+        if length > self.max_len or base_half > MAX_BASE_HALF or n_east > MAX_EAST:
+            return evaluate_signature(kind, length, n_east, base_half)
+        # TSUMO_KINDS = (0, 5, 10) なので kind // 5 が添字（generate の列挙順と同じ）
+        slot = ((kind // 5 * (self.max_len + 1) + length) * (MAX_EAST + 1) + n_east) * (MAX_BASE_HALF + 1) + base_half
+        o = self._decoded[slot]
+        if o is None:
+            o = self._decoded[slot] = Outcome._make(RECORD.unpack_from(self._buf, HEADER.size + RECORD.size * slot))
+        return o
+
+    def lookup(self, hand: Sequence[int]) -> Outcome:
+        if type(hand) is Hand:
+            return self.outcome(*hand.signature())
+        return self.outcome(*hand_signature(hand))
+
+
+def load_hand_table(path: str = DEFAULT_PATH, max_len: int = DEFAULT_MAX_LEN) -> HandTable:
+    """テーブルを mmap する。無い・形式が古い場合は生成して書いてから読み、書けなければメモリ上の表を使う。"""
+    try:
+        return HandTable.open(path)
+    except (OSError, ValueError):
+        pass
+    try:
+        write_table(path, max_len)
+        return HandTable.open(path)
+    except OSError:
+        return HandTable(generate(max_len), max_len)
+
+
+_shared: Optional[HandTable] = None
+
+
+def shared_table() -> HandTable:
+    """プロセス内で共有するテーブル（TOPPAN_HAND_TABLE でパスを変更可能）"""
+    global _shared
+    if _shared is None:
+        _shared = load_hand_table(os.environ.get("TOPPAN_HAND_TABLE", DEFAULT_PATH))
+    return _shared
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description="Generate the hand outcome table")
+    ap.add_argument("-o", "--output", default=DEFAULT_PATH)
+    ap.add_argument("--max-len", type=int, default=DEFAULT_MAX_LEN, help="largest hand size to enumerate")
+    args = ap.parse_args(argv)
+    write_table(args.output, args.max_len)
+    print(f"wrote {args.output} ({os.path.getsize(args.output)} bytes, max_len={args.max_len})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+フリーマッチの待ち合わせ
+------------------------
+人間の空き席があるフリールームを優先度付きキュー（heap）に入れておき、来た人を割り当てる。
+
+- 優先度は (人間が多い順, 空きができてから長く待っている順)。埋まりかけの卓から埋めるので
+  半端な卓が増えない。1人 + BOT の卓にも人間が入り、BOT はその人と入れ替わる。
+- 同じ周回に来た人はまとめて割り当て、卓ごとに1回だけロックを取って着席させる。
+- heap の要素は卓の人数が変わるたびに積み直し、古いものは取り出すときに捨てる（遅延削除）。
+  割り当ては O(log n)。
+- BOT と入れ替わるのはラウンドの外（BOT_SWAP_PHASES）だけ。ベット中・対局中の BOT は親や手番だったり
+  手牌とベットを持っていたりするので、空席の無い卓はその周回は飛ばして別の卓（無ければ新しい卓）に入れる。
+"""
+
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from engine import Player, Room, _new_game_locked, _sync_free_room_bots_locked, first_open_seat
+from reaper import RoomLimitError
+
+MAX_HUMANS = 4
+BOT_SWAP_PHASES = ("waiting", "reset_prompt", "ended")   # BOT をどかして人間を座らせてよいフェーズ
+
+
+def _capacity(room: Room) -> int:
+    """今この卓に座らせられる人間の数。ラウンド中は空席の分だけ"""
+    free = MAX_HUMANS - room.humans()
+    if room.state.phase in BOT_SWAP_PHASES:
+        return free
+    return min(free, sum(1 for sid in room.seat_to_sid.values() if sid is None))
+
+
+def _evict_bot_locked(room: Room) -> Optional[int]:
+    """人間が待っているので BOT を1体どかして席を空ける（ラウンドの外だけ。中なら None）"""
+    if room.state.phase not in BOT_SWAP_PHASES:
+        return None
+    for p in room.players():
+        if p.is_bot:
+            room.seat_to_sid[p.seat_index] = None
+            room.players_by_sid.pop(p.sid, None)
+            return p.seat_index
+    return None
+
+
+class MatchPool:
+    """人間の空きがあるフリールームの heap と、割り当て待ちの到着者"""
+
+    def __init__(self, manager: Any) -> None:
+        self.manager = manager      # server.RoomManager（rooms / new_room / add_player_locked）
+        self.heap: List[tuple] = []   # (-人間の数, 待ち始め, 通し番号, room_id, 人間の数)
+        self.offered: Dict[str, int] = {}   # room_id -> heap に積んである人間の数（同じ数では積み直さない）
+        self.arrivals: List[Tuple[str, str, asyncio.Future]] = []
+        self.assigner: Optional[asyncio.Task] = None
+        self.seq = itertools.count()
+
+    def offer(self, room: Room) -> None:
+        """卓の人数が変わったら呼ぶ。人間の空きがあれば候補に積む"""
+        humans = room.humans()
+        if not room.is_free_match or humans >= MAX_HUMANS or self.offered.get(room.room_id) == humans:
+            return
+        heapq.heappush(self.heap, (-humans, time.monotonic(), next(self.seq), room.room_id, humans))
+        self.offered[room.room_id] = humans
+        if len(self.heap) > 4 * max(len(self.manager.rooms), 16):
+            self._compact()
+
+    def _valid(self, entry: tuple) -> Optional[Room]:
+        room = self.manager.rooms.get(entry[3])
+        if room is None or not room.is_free_match or room.humans() != entry[4]:
+            return None
+        return room
+
+    def _compact(self) -> None:
+        self.heap = [e for e in self.heap if self._valid(e) is not None]
+        heapq.heapify(self.heap)
+        self.offered = {e[3]: e[4] for e in self.heap}
+
+    def pop_best(self) -> Optional[Room]:
+        """一番よい候補の卓を取り出す（古い要素は捨てる）。無ければ None"""
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            room = self._valid(entry)
+            if self.offered.get(entry[3]) == entry[4]:
+                del self.offered[entry[3]]
+            if room is not None:
+                return room
+        return None
+
+    async def join(self, sid: str, name: str) -> Room:
+        """フリーマッチに入る。同じ周回に来た人とまとめて着席させ、着いた卓を返す"""
+        fut = asyncio.get_running_loop().create_future()
+        self.arrivals.append((sid, name, fut))
+        if self.assigner is None:
+            self.assigner = asyncio.create_task(self._assign())
+        return await fut
+
+    async def _assign(self) -> None:
+        await asyncio.sleep(0)   # 同じ周回の到着を待つ
+        batch, self.arrivals = self.arrivals, []
+        self.assigner = None
+        groups: List[Tuple[Room, list]] = []
+        skipped: List[Room] = []
+        i = 0
+        while i < len(batch):
+            room = self.pop_best()
+            if room is not None and _capacity(room) == 0:
+                # BOT で埋まったままラウンド中。この周回は飛ばし、終わったら候補に戻す
+                skipped.append(room)
+                continue
+            if room is None:
+                try:
+                    room = self.manager.new_room(is_free_match=True)
+                except RoomLimitError as e:   # ルーム数の上限。残りの人には断る
+                    for _, _, fut in batch[i:]:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    break
+            take = _capacity(room)
+            groups.append((room, batch[i:i + take]))
+            i += take
+        for room in skipped:
+            self.offer(room)
+        await asyncio.gather(*(self._seat(room, group) for room, group in groups))
+
+    async def _seat(self, room: Room, group: list) -> None:
+        async with room.lock:
+            for item in group:
+                sid, name, fut = item
+                if fut.done():
+                    continue
+                seat = None
+                if self.manager.rooms.get(room.room_id) is room:
+                    seat = first_open_seat(room.seat_to_sid)
+                    if seat is None and room.humans() < MAX_HUMANS:
+                        seat = _evict_bot_locked(room)
+                if seat is None:
+                    # ロック待ちの間に埋まった・ラウンドが始まった・消えた卓。次の周回で割り当て直す
+                    self.arrivals.append(item)
+                    continue
+                self.manager.add_player_locked(room, Player(sid=sid, name=name, seat_index=seat))
+                if not room.host_sid or room.host_sid not in room.players_by_sid:
+                    room.host_sid = sid
+                fut.set_result(room)
+            _sync_free_room_bots_locked(room)
+            # Auto start for free match when at least 2 players (human/bot)
+            if room.seats_filled() >= 2 and room.state.phase == "waiting":
+                _new_game_locked(room)
+        self.offer(room)
+        if self.arrivals and self.assigner is None:
+            self.assigner = asyncio.create_task(self._assign())
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+次の1枚の確率計算
+-----------------
+山の残り枚数ベクトル（Wall.counts）から、手牌に次の1枚を足したときの
+バースト・十半・ツモ・役ありの確率と、役倍率（ドラ込み）の期待値を厳密に求める。
+牌種ごとに役判定テーブルを1回引くだけなので O(34)。
+
+    python odds.py 7萬 東            # 新しい山（手牌分を除く）に対する確率
+"""
+
+from __future__ import annotations
+import argparse
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from hand_table import DEAD, SPECIAL, TOPPAN, TSUMO, Hand, HandTable, Outcome, hand_signature, shared_table
+from tiles import COPIES_PER_TILE, EAST, NUM_TILE_TYPES, TILE_HALF, TILE_RANK, tiles_from_labels
+
+
+class DrawOdds(NamedTuple):
+    remaining: int
+    bust: float
+    toppan: float
+    tsumo: float
+    special: float
+    expected_role: float   # 引いた後の role_breakdown total の期待値（バーストは 0）
+
+
+NO_ODDS = DrawOdds(0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+
+# (テーブル, 先頭牌, 枚数, 東, 素点) -> 牌種ごとの「1枚足した結果」。手の状態の種類は少ないので覚えておく
+_next_cache: Dict[Tuple[int, int, int, int, int], List[Outcome]] = {}
+
+
+def _next_outcomes(table: HandTable, first: Optional[int], n: int, n_east: int, base_half: int) -> List[Outcome]:
+    key = (id(table), -1 if first is None else first, n, n_east, base_half)
+    nxt = _next_cache.get(key)
+    if nxt is None:
+        nxt = []
+        for t in range(NUM_TILE_TYPES):
+            kind = 0
+            if first is not None:
+                if first == t:
+                    kind = 10
+                elif TILE_RANK[first] == TILE_RANK[t]:
+                    kind = 5
+            nxt.append(table.outcome(kind, n + 1, n_east + (t == EAST), base_half + TILE_HALF[t]))
+        _next_cache[key] = nxt
+    return nxt
+
+
+def draw_odds(
+    hand: Sequence[int],
+    counts: Sequence[int],
+    dora_weights: Optional[Sequence[int]] = None,
+    table: Optional[HandTable] = None,
+) -> DrawOdds:
+    """残り枚数 counts の山から1枚引いたときの確率。山が空なら NO_ODDS。"""
+    remaining = sum(counts)
+    if remaining <= 0:
+        return NO_ODDS
+    table = table or shared_table()
+    if type(hand) is Hand:
+        _, n, n_east, base_half = hand.signature()
+    else:
+        _, n, n_east, base_half = hand_signature(hand)
+    nxt = _next_outcomes(table, hand[0] if n == 1 else None, n, n_east, base_half)
+    dora_now = sum(dora_weights[t] for t in hand) if dora_weights is not None else 0
+
+    bust = toppan = tsumo = special = 0
+    role_sum = 0
+    for t, c in enumerate(counts):
+        if not c:
+            continue
+        o = nxt[t]
+        flags = o.flags
+        if flags & DEAD:
+            bust += c
+            continue
+        if flags & TOPPAN:
+            toppan += c
+        if flags & TSUMO:
+            tsumo += c
+        if flags & SPECIAL:
+            special += c
+        dora = dora_now + (dora_weights[t] if dora_weights is not None else 0)
+        role_sum += c * (o.role + dora)
+
+    return DrawOdds(
+        remaining,
+        bust / remaining,
+        toppan / remaining,
+        tsumo / remaining,
+        special / remaining,
+        role_sum / remaining,
+    )
+
+
+def fresh_counts(exclude: Sequence[int] = ()) -> List[int]:
+    """新しい山の残り枚数（exclude の牌は見えているものとして除く）"""
+    counts = [COPIES_PER_TILE] * NUM_TILE_TYPES
+    for t in exclude:
+        counts[t] -= 1
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description="Next-draw odds for a hand against a fresh wall")
+    ap.add_argument("hand", nargs="*", help='tile labels, e.g. 7萬 東')
+    ap.add_argument("--seen", nargs="*", default=[], help="other visible tiles to remove from the wall")
+    args = ap.parse_args(argv)
+    hand = tiles_from_labels(args.hand)
+    odds = draw_odds(hand, fresh_counts(hand + tiles_from_labels(args.seen)))
+    for name, value in odds._asdict().items():
+        print(f"{name:>14}: {value:.4f}" if isinstance(value, float) else f"{name:>14}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+放置ルームの回収
+----------------
+ルームは人間が全員抜けたときにしか消えないので、/api/new で作ったまま誰も来ないルームや、
+BOT だけで回り続けるルーム、途中で止まったルームが山・ドラ・清算結果を抱えたまま残る。
+
+- RoomReaper.active: room_id -> 最後に人間の動きがあった時刻（古い順の OrderedDict = LRU）
+- TTL はフェーズごと（TOPPAN_ROOM_TTL_<PHASE> 秒）。人間がいないルームは TOPPAN_ROOM_TTL_EMPTY
+- ルーム数は TOPPAN_MAX_ROOMS まで。上限で作ろうとしたら一番長く放置されたルームを追い出し、
+  追い出せるものが無ければ RoomLimitError で断る（悪意のあるクライアントでもメモリは増え続けない）
+
+判定だけをここで行い、クライアントへの通知や表からの削除は server.py（RoomManager.close_room）が行う。
+"""
+
+from __future__ import annotations
+import dataclasses
+import itertools
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from engine import Room
+
+
+def _env_seconds(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+ROOM_TTLS: Dict[str, float] = {   # フェーズごとの放置時間の上限（秒）
+    phase: _env_seconds(f"TOPPAN_ROOM_TTL_{phase.upper()}", default)
+    for phase, default in (
+        ("waiting", 600.0), ("reset_prompt", 300.0), ("betting", 300.0), ("playing", 300.0), ("ended", 60.0),
+    )
+}
+EMPTY_ROOM_TTL = _env_seconds("TOPPAN_ROOM_TTL_EMPTY", 60.0)   # 人間が1人もいないルーム
+MAX_ROOMS = int(os.environ.get("TOPPAN_MAX_ROOMS", "10000"))
+REAP_INTERVAL = _env_seconds("TOPPAN_REAP_INTERVAL", 5.0)      # 見回りの間隔（秒）
+EVICT_MIN_IDLE = 30.0   # 上限で追い出してよいのは、人間がいればこれ以上放置されたルームだけ
+EVICT_SCAN = 8          # 上限で追い出すルームを古い方から何件まで探すか
+
+
+class RoomLimitError(RuntimeError):
+    """ルーム数が上限で、追い出せる放置ルームも無い"""
+
+
+@dataclass
+class ReaperStats:
+    reclaimed_rooms: int = 0   # TTL 切れで消した数
+    evicted_rooms: int = 0     # 上限で追い出した数
+    rejected_rooms: int = 0    # 上限で作成を断った数
+    reclaimed_bytes: int = 0   # 消したルームのおおよそのバイト数の合計
+
+    def as_dict(self) -> Dict[str, int]:
+        return dataclasses.asdict(self)
+
+
+_SKIP_FIELDS = ("lock", "broadcast")   # server.py の共有物。ルームを消しても残る・すぐ消える
+
+
+def room_footprint(room: Room) -> int:
+    """ルームが抱えているおおよそのバイト数（山・ドラ・清算結果・手牌・チャット履歴など）"""
+    seen = set()
+
+    def size(obj: Any) -> int:
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        n = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            n += sum(size(k) + size(v) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            n += sum(size(x) for x in obj)
+        elif dataclasses.is_dataclass(obj):
+            n += sum(size(getattr(obj, f.name)) for f in dataclasses.fields(obj))
+        elif hasattr(obj, "__slots__"):
+            n += sum(size(getattr(obj, s)) for s in obj.__slots__ if hasattr(obj, s))
+        return n
+
+    total = sys.getsizeof(room)
+    for f in dataclasses.fields(room):
+        if f.name not in _SKIP_FIELDS:
+            total += size(getattr(room, f.name))
+    return total
+
+
+class RoomReaper:
+    """最後に動きがあった順のルームと、回収・追い出しの判定"""
+
+    def __init__(
+        self,
+        ttls: Optional[Dict[str, float]] = None,
+        empty_ttl: float = EMPTY_ROOM_TTL,
+        max_rooms: int = MAX_ROOMS,
+        evict_min_idle: float = EVICT_MIN_IDLE,
+    ) -> None:
+        self.ttls = dict(ROOM_TTLS if ttls is None else ttls)
+        self.empty_ttl = empty_ttl
+        self.max_rooms = max_rooms
+        self.evict_min_idle = evict_min_idle
+        self.active: "OrderedDict[str, float]" = OrderedDict()
+        self.stats = ReaperStats()
+
+    def touch(self, room_id: str, now: Optional[float] = None) -> None:
+        self.active[room_id] = time.monotonic() if now is None else now
+        self.active.move_to_end(room_id)
+
+    def forget(self, room_id: str) -> None:
+        self.active.pop(room_id, None)
+
+    def full(self) -> bool:
+        return len(self.active) >= self.max_rooms
+
+    def ttl(self, room: Room) -> float:
+        if room.humans() == 0:
+            return self.empty_ttl
+        return self.ttls.get(room.state.phase, self.empty_ttl)
+
+    def expired(self, rooms: Any, now: Optional[float] = None) -> List[Room]:
+        """TTL を過ぎたルーム。古い方から見て、一番短い TTL より新しくなったら打ち切る"""
+        now = time.monotonic() if now is None else now
+        shortest = min([self.empty_ttl, *self.ttls.values()])
+        stale = []
+        for rid, last in self.active.items():
+            if now - last < shortest:
+                break
+            stale.append((rid, last))
+        out: List[Room] = []
+        for rid, last in stale:
+            room = rooms.get(rid)
+            if room is None:   # 別の経路で消えたルーム
+                self.forget(rid)
+            elif now - last >= self.ttl(room) and not room.lock.locked():
+                out.append(room)
+        return out
+
+    def evictable(self, rooms: Any, now: Optional[float] = None) -> Optional[Room]:
+        """上限のときに追い出すルーム（人間がいないか、EVICT_MIN_IDLE 以上放置）。無ければ None"""
+        now = time.monotonic() if now is None else now
+        for rid, last in list(itertools.islice(self.active.items(), EVICT_SCAN)):
+            room = rooms.get(rid)
+            if room is None:   # 別の経路で消えたルーム（これで枠が空く）
+                self.forget(rid)
+            elif not room.lock.locked() and (room.humans() == 0 or now - last >= self.evict_min_idle):
+                return room
+        return None
+
+    def record(self, room: Room, evicted: bool) -> None:
+        """消すルームを数える（消す前に呼ぶ）"""
+        if evicted:
+            self.stats.evicted_rooms += 1
+        else:
+            self.stats.reclaimed_rooms += 1
+        self.stats.reclaimed_bytes += room_footprint(room)
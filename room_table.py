@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+ルームの表とルームID
+--------------------
+- RoomIdAllocator: 連番を鍵付きの置換（乱数の掛け算と xorshift + cycle walking）で並べ替えて6文字のIDにする。
+  連番が重ならない限りIDも重ならないので、空きを探して引き直すループもロックも要らない。
+  鍵はプロセスごとに乱数で作るので、連番のように次のIDを見当づけることはできない。
+- ShardedRooms: room_id -> Room を複数の dict に分けて持つ。ルームが数万あっても
+  dict の作り直し（リサイズ）で止まるのは1シャード分だけになる。
+"""
+
+from __future__ import annotations
+import random
+import string
+from typing import Dict, Generic, Iterator, List, Optional, TypeVar
+
+ROOM_ID_ALPHABET = string.ascii_uppercase + string.digits
+ROOM_ID_LENGTH = 6
+NUM_SHARDS = 16
+
+V = TypeVar("V")
+
+
+class RoomIdAllocator:
+    """重ならないルームIDを連番から作る"""
+
+    __slots__ = ("length", "space", "bits", "mask", "mul1", "mul2", "xor1", "xor2", "counter")
+
+    def __init__(self, seed: Optional[int] = None, length: int = ROOM_ID_LENGTH) -> None:
+        rng = random.Random(seed) if seed is not None else random.SystemRandom()
+        self.length = length
+        self.space = len(ROOM_ID_ALPHABET) ** length
+        self.bits = max((self.space - 1).bit_length(), 2)
+        self.mask = (1 << self.bits) - 1
+        # 奇数の掛け算・xor・xorshift はどれも bits ビット上の全単射なので、組み合わせも置換になる
+        self.mul1 = rng.getrandbits(self.bits) | 1
+        self.mul2 = rng.getrandbits(self.bits) | 1
+        self.xor1 = rng.getrandbits(self.bits)
+        self.xor2 = rng.getrandbits(self.bits)
+        self.counter = 0
+
+    def permute(self, i: int) -> int:
+        """[0, space) 上の置換（bits ビットの置換で space 以上に出たらもう一度かける: cycle walking）"""
+        mask, half = self.mask, self.bits // 2
+        x = i
+        while True:
+            x = ((x ^ self.xor1) * self.mul1) & mask
+            x ^= x >> half
+            x = ((x ^ self.xor2) * self.mul2) & mask
+            x ^= x >> half
+            if x < self.space:
+                return x
+
+    def encode(self, x: int) -> str:
+        chars = []
+        for _ in range(self.length):
+            x, d = divmod(x, len(ROOM_ID_ALPHABET))
+            chars.append(ROOM_ID_ALPHABET[d])
+        return "".join(chars)
+
+    def next_id(self) -> str:
+        if self.counter >= self.space:
+            raise RuntimeError("room id space exhausted")
+        i = self.counter
+        self.counter += 1
+        return self.encode(self.permute(i))
+
+
+class ShardedRooms(Generic[V]):
+    """room_id -> Room。dict と同じ使い方（get / in / [] / del / len / values）"""
+
+    __slots__ = ("shards",)
+
+    def __init__(self, num_shards: int = NUM_SHARDS) -> None:
+        self.shards: List[Dict[str, V]] = [{} for _ in range(num_shards)]
+
+    def _shard(self, room_id: str) -> Dict[str, V]:
+        return self.shards[hash(room_id) % len(self.shards)]
+
+    def get(self, room_id: str, default: Optional[V] = None) -> Optional[V]:
+        return self._shard(room_id).get(room_id, default)
+
+    def __contains__(self, room_id: object) -> bool:
+        return isinstance(room_id, str) and room_id in self._shard(room_id)
+
+    def __getitem__(self, room_id: str) -> V:
+        return self._shard(room_id)[room_id]
+
+    def __setitem__(self, room_id: str, room: V) -> None:
+        self._shard(room_id)[room_id] = room
+
+    def __delitem__(self, room_id: str) -> None:
+        del self._shard(room_id)[room_id]
+
+    def pop(self, room_id: str, default: Optional[V] = None) -> Optional[V]:
+        return self._shard(room_id).pop(room_id, default)
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self.shards)
+
+    def __iter__(self) -> Iterator[str]:
+        for s in self.shards:
+            yield from list(s)
+
+    def values(self) -> Iterator[V]:
+        for s in self.shards:
+            yield from list(s.values())
+
+    def items(self) -> Iterator[tuple]:
+        for s in self.shards:
+            yield from list(s.items())
@@ -15,318 +15,398 @@ Then open http://localhost:8000 in multiple browsers to test.
 
 from __future__ import annotations
 import asyncio
-import random
-import string
-from dataclasses import dataclass, field, asdict
-from typing import Dict, List, Optional
+import logging
+import os
+from typing import Dict, Optional
 
 from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse, JSONResponse
 from starlette.staticfiles import StaticFiles
 import socketio  # python-socketio (ASGI)
 
-# ---------------------- Utilities & Models ----------------------
-
-SEATS = ["東", "南", "西", "北"]
-DEFAULT_BET = 1
-TARGET = 10.5
-HONORS = {"東","南","西","北","白","發","中"}
-INITIAL_HAND_SIZE = 1
+from tiles import EAST, TILE_LABELS, TILE_NUMBER, TILE_SUIT
+from chatlog import CHAT_MAX_LENGTH, ChatHistory, ChatRateLimiter
+from cluster import ClusterConfig, client_manager
+from eventlog import EventLog
+from matchmaking import MatchPool
+from reaper import REAP_INTERVAL, RoomLimitError, RoomReaper
+import snapshot
+from bot_scheduler import BOT_RETRY_DELAY, BotScheduler
+from room_table import RoomIdAllocator, ShardedRooms
+from sessions import Session, SessionTable
+from state_sync import ViewerSync
+from wire import resolve_serializer, server_options
+# ルールと状態遷移は engine.py（同期・副作用なし）。ここは Socket.IO との橋渡しと副作用の実行だけ
+from engine import (  # noqa: F401  (tests / 既存の import 元として再エクスポート)
+    BOT_POLICY, DEFAULT_BET, HAND_TABLE, INITIAL_HAND_SIZE, SEATS,
+    GameState, Player, Room, RoundSettled,
+    count_dora, count_role, drain_effects, first_open_seat, hand_total, is_special_role, is_toppan,
+    is_tsumo, make_standard_tiles, role_breakdown, special_role_cutin, tile_value,
+    EV_REBIND,
+    _add_points_for_player, _bot_bet, _bot_choose_bet, _bot_draws, _bot_should_draw, _bot_step_locked,
+    _dealer_reset_locked, _draw_tile_for_player, _end_round, _log, _log_seats, _new_game_locked,
+    _set_bet_for_player, _set_initial_points_for_player, _start_game_locked, _start_next_round_locked,
+    _stay_for_player, _sync_free_room_bots_locked, _void_round_by_empty_wall,
+)
 
-def gen_room_id(n: int = 6) -> str:
-    return "".join(random.choices(string.ascii_uppercase + string.digits, k=n))
+# ---------------------- Utilities ----------------------
 
-def make_standard_tiles() -> List[str]:
-    """Return a simple 136-tile mahjong-like set (no flowers). Labels are text-based."""
-    suits = [
-        ("m", "萬"),  # Characters / Manzu
-        ("p", "筒"),  # Dots / Pinzu
-        ("s", "索"),  # Bamboo / Souzu
-    ]
-    tiles = []
-    for code, kanji in suits:
-        for num in range(1, 10):
-            label = f"{num}{kanji}"
-            tiles.extend([label] * 4)
-    honors = ["東", "南", "西", "北", "白", "發", "中"]
-    for h in honors:
-        tiles.extend([h] * 4)
-    random.shuffle(tiles)
-    return tiles
-
-def tile_value(label: str) -> float:
-    s = (label or "").strip()
-    if not s:
-        return 0.0
-    # 数牌: "5萬" / "7筒" / "3索"
-    if len(s) >= 2 and s[0].isdigit() and s[1] in ("萬", "筒", "索"):
-        return float(int(s[0]))
-    # 字牌: 東南西北白發中 => 0.5
-    if s in ("東", "南", "西", "北", "白", "發", "中"):
-        return 0.5
-    return 0.0
-
-def hand_total(hand: List[str]) -> float:
-    total_point = sum(tile_value(t) for t in hand)
-    for card in hand:
-        if card == "東":
-            if total_point + 9.5 <= TARGET:
-                total_point += 9.5
-    return total_point
-
-def is_toppan(hand):
-    if hand_total(hand) == TARGET:
-        return True
-    return False
-
-def is_tsumo(hand):
-    if len(hand) == 2:
-        if hand[0] == hand[1]:
-            return True
-        if hand[0][0] == hand[1][0]:
-            return True
-    return False
-
-def count_role(hand: list[str], dora: list[str]) -> float:
-    """役のカウント"""
-    breakdown = role_breakdown(hand, dora)
-    return breakdown["total"]
-
-
-
-def count_dora(hand: list[str], dora: list[str]) -> int:
-    """ドラの合計を返す"""
-    dora_points = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0, 8: 0, 9: 0, "東南西北": 0, "白發中": 0}
-    for card in dora:
-        if len(card) == 2:
-            dora_points[(int(card[0]) % 9) + 1] += 1
-        if card in {"東", "南", "西", "北"}:
-            dora_points["東南西北"] += 1
-        if card in {"白", "發", "中"}:
-            dora_points["白發中"] += 1
-
-    dora_total = 0
-    for card in hand:
-        if len(card) == 2:
-            dora_total += dora_points[int(card[0])]
-        if card in {"東", "南", "西", "北"}:
-            dora_total += dora_points["東南西北"]
-        if card in {"白", "發", "中"}:
-            dora_total += dora_points["白發中"]
-
-    return dora_total
-
-
-def role_breakdown(hand: list[str], dora: list[str]) -> dict:
-    """役の内訳を返す: {total: int, items: [{name, points, multiplier}] }"""
-    items = []
-    total = 1
-    items.append({"name": "基本", "points": 1, "multiplier": 1})
-
-    if len(hand) == 2:
-        if hand[0] == hand[1]:
-            items.append({"name": "ツモ", "points": 10, "multiplier": 10})
-            total += 10
-        elif hand[0][0] == hand[1][0]:
-            items.append({"name": "ツモ", "points": 5, "multiplier": 5})
-            total += 5
-
-    dora_points = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0, 8: 0, 9: 0, "東南西北": 0, "白發中": 0}
-    for card in dora:
-        if len(card) == 2:
-            dora_points[(int(card[0]) % 9) + 1] += 1
-        if card in {"東", "南", "西", "北"}:
-            dora_points["東南西北"] += 1
-        if card in {"白", "發", "中"}:
-            dora_points["白發中"] += 1
-
-    dora_total = 0
-    for card in hand:
-        if len(card) == 2:
-            dora_total += dora_points[int(card[0])]
-        if card in {"東", "南", "西", "北"}:
-            dora_total += dora_points["東南西北"]
-        if card in {"白", "發", "中"}:
-            dora_total += dora_points["白發中"]
-    if dora_total:
-        items.append({"name": "ドラ", "points": dora_total, "multiplier": dora_total})
-        total += dora_total
-
-    if is_toppan(hand):
-        items.append({"name": "十半", "points": 10, "multiplier": 10})
-        total += 10
-
-    if hand_total(hand) > TARGET and not is_tsumo(hand):
-        return {"total": 0, "items": []}
-
-    if len(hand) >= 5:
-        extra = (len(hand) - 4) * 5
-        items.append({"name": f"{len(hand)}枚引き", "points": extra, "multiplier": extra})
-        total += extra
-
-    return {"total": total, "items": items}
-
-
-def is_special_role(hand) -> bool:
-    if is_toppan(hand):
-        return True
-    if is_tsumo(hand):
-        return True
-    if hand_total(hand) > TARGET:
-        return False
-    if len(hand) >= 5:
-        return True
-    return False
+logger = logging.getLogger(__name__)
 
-def special_role_cutin(hand: List[str]) -> Optional[dict]:
-    if not is_special_role(hand):
-        return None
-    toppan = is_toppan(hand)
-    tsumo = is_tsumo(hand)
-    many = len(hand) >= 5 and hand_total(hand) <= TARGET
-
-    if toppan and many:
-        return {"label": "十半", "sound": "special1"}
-    if toppan and tsumo:
-        return {"label": "十半", "sound": "special2"}
-    if toppan:
-        return {"label": "十半", "sound": "normal"}
-    if tsumo:
-        return {"label": "ツモ", "sound": "normal"}
-    if many:
-        return {"label": f"{len(hand)}枚引き", "sound": "normal"}
-    return None
-
-
-@dataclass
-class Player:
-    sid: str
-    name: str
-    seat_index: int
-    hand: List[str] = field(default_factory=list)
-    discards: List[str] = field(default_factory=list)  # ← 未使用だが互換で残す
-    ready: bool = False
-    status: str = "playing"  # "playing" | "stay" | "bust"
-    points: int = 300
-    initial_points: Optional[int] = None  # ← 開始前に入力した持ち点（未入力は None）
-    bet_points: Optional[int] = None   # ← このラウンドのベット（子のみ）
-    is_bot: bool = False
-
-@dataclass
-class GameState:
-    phase: str = "waiting"    # "waiting" | "reset_prompt" | "betting" | "playing" | "ended"
-    wall: List[str] = field(default_factory=list)
-    turn_seat: Optional[int] = None
-    # 十半用
-    dealer_seat: int = 0                # 親（東固定）
-    dealer_first_hidden: bool = True    # 親の1枚目を伏せる
-    dora_displays: List[str] = field(default_factory=list)  # 参考表示用
-    results: Dict[int, str] = field(default_factory=dict)   # seat_index -> "win"/"lose"/"push"
-    cutin: Optional[dict] = None
-
-@dataclass
-class Room:
-    room_id: str
-    host_sid: Optional[str] = None
-    players_by_sid: Dict[str, Player] = field(default_factory=dict)
-    seat_to_sid: Dict[int, Optional[str]] = field(default_factory=lambda: {0: None, 1: None, 2: None, 3: None})
-    state: GameState = field(default_factory=GameState)
-    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
-    bot_running: bool = False
-    is_free_match: bool = False
-
-    def seats_filled(self) -> int:
-        return sum(1 for s in self.seat_to_sid.values() if s)
-
-    def player_sids(self) -> List[str]:
-        return [sid for sid in self.seat_to_sid.values() if sid]
-
-    def players(self) -> List[Player]:
-        return [self.players_by_sid[sid] for sid in self.player_sids()]
+HIDDEN_TILE = "🀫"
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 
 # ---------------------- In-memory Room Manager ----------------------
 
 class RoomManager:
-    def __init__(self) -> None:
-        self.rooms: Dict[str, Room] = {}
-        self._global_lock = asyncio.Lock()
-        self.free_room_id: Optional[str] = None
+    """ルームの表（room_table.py）と sid -> ルームの索引
+
+    ルームの作成・検索は await を挟まないので、イベントループ上ではロック無しで不可分に行える。
+    """
+
+    def __init__(
+        self,
+        id_seed: Optional[int] = None,
+        cluster: Optional[ClusterConfig] = None,
+        events: Optional[EventLog] = None,
+    ) -> None:
+        self.rooms: ShardedRooms[Room] = ShardedRooms()
+        self.ids = RoomIdAllocator(id_seed)
+        self.cluster = cluster or ClusterConfig()   # 複数ワーカーなら自分の持ち分のIDだけ使う（cluster.py）
+        self.events = events                 # 操作ログ（eventlog.py）。None なら記録しない
+        self.pool = MatchPool(self)          # フリーマッチの待ち合わせ（matchmaking.py）
+        self.reaper = RoomReaper()           # 放置ルームの回収とルーム数の上限（reaper.py）
+        self.sessions = SessionTable()       # 再接続用の token と切断中の席（sessions.py）
+        self.sid_room: Dict[str, str] = {}   # sid -> room_id（人間のみ。参加・退室で更新する）
+
+    def new_room(self, **kwargs) -> Room:
+        if self.reaper.full():
+            victim = self.reaper.evictable(self.rooms)
+            if victim is not None:
+                self.close_room(victim, "evicted")
+            elif self.reaper.full():
+                self.reaper.stats.rejected_rooms += 1
+                raise RoomLimitError("Too many rooms")
+        rid = self.ids.next_id()
+        # 復元したルームなど、別の採番のIDとだけぶつかり得る。他のワーカーの持ち分のIDは飛ばす
+        while rid in self.rooms or not self.cluster.owns(rid):
+            rid = self.ids.next_id()
+        room = Room(room_id=rid, lock=asyncio.Lock(), **kwargs)
+        self._start_journal(room)
+        self.rooms[rid] = room
+        self.reaper.touch(rid)
+        return room
+
+    def _start_journal(self, room: Room) -> None:
+        """操作ログを付け、再生の起点になるルーム丸ごとを記録する"""
+        if self.events is not None:
+            room.journal = self.events.journal()
+            room.journal.checkpoint(room)
+
+    def touch(self, room: Room) -> None:
+        """人間の操作があった（放置の判定と追い出しの順番に使う）"""
+        if room.room_id in self.reaper.active:
+            self.reaper.touch(room.room_id)
+
+    def close_room(self, room: Room, reason: str) -> None:
+        """ルームを表と索引から消す（放置・上限での追い出し）。中の人間への通知は _room_closed"""
+        if self.rooms.get(room.room_id) is not room:
+            return
+        self.reaper.record(room, evicted=(reason == "evicted"))
+        del self.rooms[room.room_id]
+        self.reaper.forget(room.room_id)
+        humans = [p.sid for p in room.players() if not p.is_bot]
+        for sid in humans:
+            self.sessions.drop(sid)
+            if self.sid_room.get(sid) == room.room_id:
+                del self.sid_room[sid]
+        _room_closed(room, humans, reason)
 
     async def create_room(self) -> Room:
-        async with self._global_lock:
-            while True:
-                rid = gen_room_id()
-                if rid not in self.rooms:
-                    room = Room(room_id=rid)
-                    self.rooms[rid] = room
-                    return room
-
-    async def get_free_room(self) -> Room:
-        async with self._global_lock:
-            room = self.rooms.get(self.free_room_id) if self.free_room_id else None
-            if room and room.seats_filled() < 4:
-                return room
-            # create new free room
-            while True:
-                rid = gen_room_id()
-                if rid not in self.rooms:
-                    room = Room(room_id=rid, is_free_match=True)
-                    self.rooms[rid] = room
-                    self.free_room_id = rid
-                    return room
+        return self.new_room()
 
     def get_room(self, room_id: str) -> Optional[Room]:
         return self.rooms.get(room_id)
 
-    async def remove_player(self, sid: str) -> Optional[Room]:
-        # Remove a player from any room they are in; if room empties, delete it
-        for rid, room in list(self.rooms.items()):
-            if sid in room.players_by_sid:
-                async with room.lock:
-                    player = room.players_by_sid.pop(sid)
-                    # free their seat
-                    if room.seat_to_sid.get(player.seat_index) == sid:
-                        room.seat_to_sid[player.seat_index] = None
-                    # If host left, choose a new host
-                    if room.host_sid == sid:
-                        sids = room.player_sids()
-                        room.host_sid = sids[0] if sids else None
-                    if room.is_free_match:
-                        _sync_free_room_bots_locked(room)
-                    # If empty, delete room
-                    if not room.players_by_sid:
-                        if room.is_free_match and self.free_room_id == rid:
-                            self.free_room_id = None
-                        del self.rooms[rid]
-                        return None
-                return room
-        return None
+    def room_of(self, sid: str) -> Optional[Room]:
+        """sid が今いるルーム（索引を引くだけ）"""
+        rid = self.sid_room.get(sid)
+        return self.rooms.get(rid) if rid else None
+
+    def adopt(self, room: Room, tokens: Optional[Dict[str, str]] = None) -> bool:
+        """スナップショットから読み戻したルームを表に入れる
+
+        人間の席は保存しておいた再接続の token（sid -> token）で預かり直し、resume でだけ戻れる
+        （繋ぎ直されるまで索引には載らない）。token の無い席は空け、誰もいなくなったルームは入れない（False）。
+        """
+        tokens = tokens or {}
+        for p in room.players():
+            if not p.is_bot and p.sid not in tokens:
+                del room.players_by_sid[p.sid]
+                room.seat_to_sid[p.seat_index] = None
+        if not room.players_by_sid:
+            return False
+        if room.host_sid not in room.players_by_sid:
+            room.host_sid = room.player_sids()[0]
+        if room.is_free_match:
+            _sync_free_room_bots_locked(room)
+        room.lock = asyncio.Lock()
+        self._start_journal(room)
+        self.rooms[room.room_id] = room
+        self.reaper.touch(room.room_id)
+        for p in room.players():
+            if not p.is_bot:
+                self.sessions.restore(tokens[p.sid], room.room_id, p.sid, _session_expired)
+        self.pool.offer(room)
+        return True
 
-manager = RoomManager()
+    def rebind_locked(self, room: Room, player: Player, sid: str) -> None:
+        """席はそのままで新しい sid に付け替える（room.lock を持って呼ぶ）"""
+        _log_seats(room)   # 付け替える前の席を確定させておく
+        old = player.sid
+        room.players_by_sid.pop(old, None)
+        player.sid = sid
+        room.players_by_sid[sid] = player
+        room.seat_to_sid[player.seat_index] = sid
+        if room.host_sid == old:
+            room.host_sid = sid
+        if self.sid_room.get(old) == room.room_id:
+            del self.sid_room[old]   # 古い接続の切断はもう何もしない
+        self.sid_room[sid] = room.room_id
+        self.sessions.rebind(old, sid)
+        _log(room, EV_REBIND, player.seat_index, payload=sid.encode())
+
+    def add_player_locked(self, room: Room, player: Player) -> None:
+        """席に着かせて索引に載せる（room.lock を持って呼ぶ）"""
+        room.players_by_sid[player.sid] = player
+        room.seat_to_sid[player.seat_index] = player.sid
+        if not player.is_bot:
+            self.sid_room[player.sid] = room.room_id
+        _log_seats(room)
+
+    def hold_player(self, sid: str, sync: Optional[ViewerSync]) -> bool:
+        """切断された人の席を預かる（sessions.py）。預かったら True（remove_player はしない）"""
+        if self.room_of(sid) is None:
+            return False
+        return self.sessions.hold(sid, sync, _session_expired) is not None
+
+    async def remove_player(self, sid: str, room_id: Optional[str] = None) -> Optional[Room]:
+        # Remove a player from the room they are in; if room empties, delete it
+        # room_id を渡すとそのルームから抜く（別のルームに着いた後で前のルームを抜けるとき。索引は新しい方のまま）
+        self.sessions.drop(sid)
+        if room_id is None or self.sid_room.get(sid) == room_id:
+            rid = self.sid_room.pop(sid, None)
+        else:
+            rid = room_id
+        room = self.rooms.get(rid) if rid else None
+        if room is None:
+            return None
+        async with room.lock:
+            player = room.players_by_sid.pop(sid, None)
+            if player is None:
+                return room
+            # free their seat
+            if room.seat_to_sid.get(player.seat_index) == sid:
+                room.seat_to_sid[player.seat_index] = None
+            # If host left, choose a new host
+            if room.host_sid == sid:
+                sids = room.player_sids()
+                room.host_sid = sids[0] if sids else None
+            if room.is_free_match:
+                _sync_free_room_bots_locked(room)
+            _log_seats(room)
+            # If empty, delete room
+            if not room.players_by_sid:
+                del self.rooms[rid]
+                self.reaper.forget(rid)
+                return None
+        self.pool.offer(room)   # 空いた席をフリーマッチの候補に戻す
+        return room
+
+CLUSTER = ClusterConfig.from_env()   # TOPPAN_WORKER_URLS / TOPPAN_WORKER_INDEX（cluster.py）
+# 操作ログの置き場所。設定したときだけ記録する（既定は無効）。セグメントの大きさと保存量の上限は eventlog.py
+EVENT_LOG_DIR = os.environ.get("TOPPAN_EVENT_LOG_DIR", "")
+EVENT_LOG_FLUSH_INTERVAL = float(os.environ.get("TOPPAN_EVENT_LOG_FLUSH", "1.0"))
+EVENT_LOG = EventLog(EVENT_LOG_DIR, worker=CLUSTER.index) if EVENT_LOG_DIR else None
+manager = RoomManager(cluster=CLUSTER, events=EVENT_LOG)
 
 # ---------------------- Socket.IO Setup ----------------------
 
+SIO_SERIALIZER = resolve_serializer()  # TOPPAN_SIO_SERIALIZER（wire.py）
+
 sio = socketio.AsyncServer(
     async_mode="asgi",
     cors_allowed_origins="*",
     ping_interval=25,
     ping_timeout=60,
+    client_manager=client_manager(),   # TOPPAN_SIO_MESSAGE_QUEUE（cluster.py）
+    **server_options(SIO_SERIALIZER),
 )
 fastapi_app = FastAPI()
 
-# Serve static files (frontend)
-fastapi_app.mount("/", StaticFiles(directory="static", html=True), name="static")
+@fastapi_app.get("/api/wire", response_class=JSONResponse)
+async def api_wire():
+    """client.js が接続前に読む: msgpack ならバイナリ用のパーサを使う"""
+    return {"serializer": "msgpack" if SIO_SERIALIZER == "msgpack" else "json"}
 
-app = socketio.ASGIApp(sio, other_asgi_app=fastapi_app)
+@fastapi_app.get("/api/stats", response_class=JSONResponse)
+async def api_stats():
+    """ルーム数と放置ルームの回収の数（reaper.py）、操作ログの書き込み（eventlog.py）、再接続（sessions.py）、
+    BOT の手番の遅れ（bot_scheduler.py）"""
+    return {"worker": CLUSTER.index, "rooms": len(manager.reaper.active), "max_rooms": manager.reaper.max_rooms,
+            **manager.reaper.stats.as_dict(), "event_log": EVENT_LOG.stats() if EVENT_LOG else None,
+            "sessions": {"held_now": manager.sessions.held(), **manager.sessions.stats.as_dict()},
+            "bots": {"scheduled_rooms": len(bots), **bots.stats.as_dict()}}
 
 # ---------------------- Helper: Broadcast State ----------------------
 
+# sid -> 差分同期の状態（state_sync.py）。参加・退室・再同期要求で捨てて次はスナップショット
+viewer_syncs: Dict[str, ViewerSync] = {}
+
+def _reset_viewer_sync(sid: str) -> None:
+    viewer_syncs.pop(sid, None)
+
+def _viewer_sync(sid: str) -> ViewerSync:
+    sync = viewer_syncs.get(sid)
+    if sync is None:
+        sync = viewer_syncs[sid] = ViewerSync()
+    return sync
+
+def _viewer_variant(public: dict, payload: dict):
+    """閲覧者ごとの重ね方: 普通は席番号、親本人の伏せ札入りなら ("hidden", 席番号)"""
+    if payload["players"] is public["players"]:
+        return payload["you_seat"]
+    return ("hidden", payload["you_seat"])
+
+# 変更をまとめて送る待ち時間。0 ならイベントループ1周分（同じ周回の変更だけまとめる）
+BROADCAST_WINDOW = float(os.environ.get("TOPPAN_BROADCAST_WINDOW_MS", "0")) / 1000.0
+
+class RoomBroadcaster:
+    """ルームの state 送信をまとめる: dirty フラグと、BROADCAST_WINDOW 後に1回だけ送る flusher
+
+    カットインの出現とラウンド終了（清算結果）は、次の変更で消される前にその場で送る。
+    清算結果（settlement イベント）はそれを参照する state より先に同じ送信で送る。
+    送るパケットは作った順に1つずつ送り出す（クライアントにバージョンが逆順で届かない）。
+    """
+
+    __slots__ = ("dirty", "timer", "marks", "send_lock", "settlement")
+
+    def __init__(self) -> None:
+        self.dirty = False
+        self.timer: Optional[asyncio.Task] = None
+        self.marks: tuple = (None, False)   # 最後に送った (カットインの sig, 終了済みか)
+        self.send_lock = asyncio.Lock()
+        self.settlement: Optional[dict] = None   # 次の送信で state より先に送る清算結果
+
+def _broadcaster(room: Room) -> RoomBroadcaster:
+    if room.broadcast is None:
+        room.broadcast = RoomBroadcaster()
+    return room.broadcast
+
+def _broadcast_marks(room: Room) -> tuple:
+    st = room.state
+    return ((st.cutin or {}).get("sig"), st.phase == "ended")
+
+def _mark_dirty(room: Room) -> RoomBroadcaster:
+    b = _broadcaster(room)
+    b.dirty = True
+    if b.timer is None:
+        b.timer = asyncio.create_task(_flush_later(room))
+    return b
+
 async def emit_room_state(room: Room) -> None:
-    """Broadcast tailored state to each player (your hand vs. others' counts)."""
+    """state が変わったことを知らせる。送信は flush_room_state でまとめて行う"""
+    if room.humans():   # BOT だけで回っているルームは放置扱いのまま
+        manager.touch(room)
+    b = _mark_dirty(room)
+    marks = _broadcast_marks(room)
+    if marks != b.marks and (marks[0] is not None or marks[1]):
+        await flush_room_state(room)
+
+def _queue_settlement(room: Room, results: dict) -> None:
+    """清算結果を次の送信に載せる。state には results_id だけを載せ、取り損ねたら get_settlement で取り直す"""
+    _mark_dirty(room).settlement = settlement_payload(results)
+
+async def _flush_later(room: Room) -> None:
+    b = _broadcaster(room)
+    try:
+        await asyncio.sleep(BROADCAST_WINDOW)
+    finally:
+        b.timer = None
+    await flush_room_state(room)
+
+async def flush_room_state(room: Room) -> None:
+    """未送信の変更があれば今の state を全員に送る"""
+    b = _broadcaster(room)
+    if not b.dirty:
+        return
+    b.dirty = False
+    b.marks = _broadcast_marks(room)
+    settlement, b.settlement = b.settlement, None
+    sends = _room_state_packets(room)
+    async with b.send_lock:
+        if settlement is not None:
+            await sio.emit("settlement", settlement, room=room.room_id)
+        await asyncio.gather(*(sio.emit(event, data, to=to) for event, data, to in sends))
+
+def _room_state_packets(room: Room) -> list:
+    """Tailored state for each player (your hand vs. others' counts): [(event, data, to)]
+
+    共通部分は1回だけ作り、各人には you_seat と（親本人なら）伏せ札の差分だけ重ねる。
+    state にはバージョンを振り、ack 済みのバージョンからのパッチで送る（state_sync.py）。
+    同じ基点からの同じパッチになる人はまとめて1回の emit にし、エンコードも1回で済ませる。
+    """
+    public = build_state_payload(room)
+    room.state_version += 1
+    version = room.state_version
+    shared: Dict[int, tuple] = {}  # 基点バージョン -> (event, data, [sid, ...])
+    single = []
     for sid, p in room.players_by_sid.items():
-        if p.is_bot:
+        if p.is_bot or manager.sessions.holds(sid):   # 切断中の人には戻ったときに追いつかせる
             continue
-        await emit_state_to_sid(room, sid)
+        payload = _viewer_payload(room, public, sid)
+        variant = _viewer_variant(public, payload)
+        sync = _viewer_sync(sid)
+        key = sync.share_key(variant) if type(variant) is not tuple else None
+        group = shared.get(key) if key is not None else None
+        if group is not None:
+            sync.remember(version, payload, variant)
+            group[2].append(sid)
+            continue
+        event, data = sync.packet(version, payload, variant)
+        if key is not None and event == "state_patch":
+            shared[key] = (event, data, [sid])
+        else:
+            single.append((event, data, sid))
+    return [(event, data, sids if len(sids) > 1 else sids[0]) for event, data, sids in shared.values()] + single
+
+# ---------------------- Helper: Chat ----------------------
+
+# sid -> チャットの送信制限（chatlog.py）
+chat_limits: Dict[str, ChatRateLimiter] = {}
+
+def _chat_history(room: Room) -> ChatHistory:
+    if room.chat_log is None:
+        room.chat_log = ChatHistory()
+    return room.chat_log
+
+async def emit_chat(room: Room, payload: dict) -> None:
+    """チャットを履歴に残してルームへ送る"""
+    await sio.emit("chat", _chat_history(room).append(payload), room=room.room_id)
+
+async def emit_system_chat(room: Room, message: str) -> None:
+    await emit_chat(room, {"system": True, "message": message})
+
+async def replay_chat(room: Room, sid: str, after: Optional[int] = None) -> None:
+    """参加したクライアントに直近のチャットをまとめて送る。after があればそれより新しいものだけ（再接続）"""
+    messages = _chat_history(room).recent()
+    if after is None:
+        if messages:
+            await sio.emit("chat_history", {"messages": messages}, to=sid)
+        return
+    missed = [m for m in messages if m["id"] > after]
+    if missed:
+        await sio.emit("chat_history", {"messages": missed, "after": after}, to=sid)   # 足りない分だけ追記させる
 
 async def emit_player_list_to_chat(room: Room) -> None:
     """Send current player list to room chat."""
@@ -336,10 +416,35 @@ async def emit_player_list_to_chat(room: Room) -> None:
         seat = SEATS[p.seat_index] if p.seat_index is not None else ""
         names.append(f"{p.name}{seat and f'({seat})'}")
     msg = "参加者: " + (", ".join(names) if names else "なし")
-    await sio.emit("chat", {"system": True, "message": msg}, room=room.room_id)
+    await emit_system_chat(room, msg)
+
+def settlement_payload(results: dict) -> dict:
+    """清算結果のクライアント向けの形（役の内訳は [名前, 点] の組）"""
+    def roles(items: list) -> list:
+        return [[item["name"], item["points"]] for item in items]
+
+    return {
+        "id": results.get("id"),
+        "dealer_seat": results.get("dealer_seat"),
+        "dealer_delta": results.get("dealer_delta", 0),
+        "reason": results.get("reason"),
+        "pairs": [
+            {
+                "seat": seat,
+                "result": r["result"],
+                "bet": r["bet"],
+                "delta": r["delta"],
+                "child_total": r["child_total"],
+                "dealer_total": r["dealer_total"],
+                "child_roles": roles(r["child_roles"]),
+                "dealer_roles": roles(r["dealer_roles"]),
+            }
+            for seat, r in results.get("pairs", {}).items()
+        ],
+    }
 
 async def emit_settlement_to_chat(room: Room, results: dict) -> None:
-    """清算結果をチャットに表示する。"""
+    """清算結果をチャットに表示する（1回の清算で1メッセージ）。"""
     dealer_seat = results.get("dealer_seat", room.state.dealer_seat)
     dealer_sid = room.seat_to_sid.get(dealer_seat)
     dealer = room.players_by_sid.get(dealer_sid) if dealer_sid else None
@@ -347,6 +452,7 @@ async def emit_settlement_to_chat(room: Room, results: dict) -> None:
 
     pairs = results.get("pairs", {})
     is_void = results.get("reason") == "wall_empty_void"
+    lines = []
     for seat, r in pairs.items():
         child_sid = room.seat_to_sid.get(seat)
         child = room.players_by_sid.get(child_sid) if child_sid else None
@@ -356,16 +462,14 @@ async def emit_settlement_to_chat(room: Room, results: dict) -> None:
         amount = abs(delta)
         # delta > 0 は子の得点増（親->子の支払い）
         if delta > 0:
-            line1 = f"{dealer_name}->{child_name}: {amount}"
+            lines.append(f"{dealer_name}->{child_name}: {amount}")
         elif delta < 0:
-            line1 = f"{child_name}->{dealer_name}: {amount}"
+            lines.append(f"{child_name}->{dealer_name}: {amount}")
         else:
-            line1 = f"{child_name}->{dealer_name}: 0"
+            lines.append(f"{child_name}->{dealer_name}: 0")
 
-        lines = [line1]
         if is_void:
             lines.append("流局（山切れ）: 親が子へ100支払い")
-            await sio.emit("chat", {"system": True, "message": "\n".join(lines)}, room=room.room_id)
             continue
 
         lines.append(f"bet額: {int(r.get('bet', 0))}")
@@ -379,7 +483,8 @@ async def emit_settlement_to_chat(room: Room, results: dict) -> None:
         for item in role_items:
             lines.append(f"{item.get('name')}: {int(item.get('points', 0))}")
 
-        await sio.emit("chat", {"system": True, "message": "\n".join(lines)}, room=room.room_id)
+    if lines:
+        await emit_system_chat(room, "\n".join(lines))
 
 async def _force_leave_player(room_id: str, sid: str, reason: str) -> None:
     room = manager.get_room(room_id)
@@ -387,15 +492,12 @@ async def _force_leave_player(room_id: str, sid: str, reason: str) -> None:
         return
     p = room.players_by_sid.get(sid)
     name = p.name if p else sid[:4]
-    await sio.emit("chat", {"system": True, "message": f"{name}は点数0以下のため退室しました"}, room=room_id)
+    await emit_system_chat(room, f"{name}は点数0以下のため退室しました")
     try:
         await sio.leave_room(sid, room_id)
     except Exception:
         pass
-    try:
-        await sio.save_session(sid, {"room_id": None})
-    except Exception:
-        pass
+    _reset_viewer_sync(sid)
     room = await manager.remove_player(sid)
     if room:
         await emit_room_state(room)
@@ -409,10 +511,11 @@ async def _kick_broke_players(room_id: str) -> None:
         await _force_leave_player(room_id, sid, "points_zero")
 
 def minimal_player_view(p: Player, is_you: bool, state: GameState) -> dict:
-    hand_view = list(p.hand)
+    # 牌IDはここで初めて表示ラベルに変換する
+    hand_view = [TILE_LABELS[t] for t in p.hand]
     # あなた以外に見せるとき、親の1枚目だけ伏せる
     if not is_you and p.seat_index == state.dealer_seat and state.dealer_first_hidden and hand_view:
-        hand_view = ["🀫"] + hand_view[1:]
+        hand_view[0] = HIDDEN_TILE
     return {
         "seat": p.seat_index,
         "seat_label": SEATS[p.seat_index],
@@ -420,363 +523,85 @@ def minimal_player_view(p: Player, is_you: bool, state: GameState) -> dict:
         "ready": p.ready,
         "hand": hand_view,               # ← 他家も公開（ただし親1枚目のみ伏せ）
         "hand_count": len(p.hand),
-        "discards": p.discards,          # 未使用
+        "discards": [TILE_LABELS[t] for t in p.discards],  # 未使用
         "status": p.status,              # UI用
         "points": p.points,                 # ← 追加
         "initial_points": p.initial_points, # ← 参考（UIで未入力か判断したい時）
         "bet": p.bet_points,
     }
 
-def _sync_free_room_bots_locked(room: Room) -> None:
-    if not room.is_free_match:
-        return
-    humans = [p for p in room.players() if not p.is_bot]
-    bots = [p for p in room.players() if p.is_bot]
-    if len(humans) == 0 and len(bots) > 0:
-        for b in list(bots):
-            if room.seat_to_sid.get(b.seat_index) == b.sid:
-                room.seat_to_sid[b.seat_index] = None
-            room.players_by_sid.pop(b.sid, None)
-        return
-    if len(humans) == 1 and len(bots) == 0:
-        seat = first_open_seat(room.seat_to_sid)
-        if seat is None:
-            return
-        bot_sid = f"BOT-FREE-{room.room_id}-{seat}"
-        bot = Player(sid=bot_sid, name="BOT", seat_index=seat, is_bot=True)
-        room.players_by_sid[bot_sid] = bot
-        room.seat_to_sid[seat] = bot_sid
-    elif len(humans) >= 2 and len(bots) > 0:
-        for b in list(bots):
-            if room.seat_to_sid.get(b.seat_index) == b.sid:
-                room.seat_to_sid[b.seat_index] = None
-            room.players_by_sid.pop(b.sid, None)
-        if room.host_sid and room.host_sid not in room.players_by_sid:
-            sids = room.player_sids()
-            room.host_sid = sids[0] if sids else None
-
-def _bot_choose_bet(p: Player, dora: List[str]) -> int:
-    total = hand_total(p.hand)
-    if total > TARGET:
-        return 0
-    if is_special_role(p.hand):
-        return 10
-
-    # ドラ点数が高いほど高ベット
-    breakdown = role_breakdown(p.hand, dora or [])
-    dora_total = 0
-    for item in breakdown.get("items", []):
-        if item.get("name") == "ドラ":
-            dora_total = int(item.get("points", 0))
-            break
-
-    # 数字（合計）が低いほど高ベット、9以上は高め
-    low_bonus = {0.5: 5, 1: 4, 2: 2}.get(total, 0)
-    high_bonus = 4.5 if total >= 9.0 else 0.0
-
-    score = (dora_total / 2) + low_bonus + high_bonus
-    bet = int(round(score))
-    bet = max(1, min(10, bet))
-    available = p.initial_points if p.initial_points is not None else (p.points if p.points is not None else 300)
-    return max(1, min(bet, available))
-
-def _bot_should_draw(p: Player, dora: list[str]) -> bool:
-    if is_special_role(p.hand):
-        return False
-    total = hand_total(p.hand)
-    if total == 10:
-        if count_dora(p.hand, dora)<=5:
-            return True
-    if total >= 8:
-        return False
-    return total < TARGET
-
-def _draw_tile_for_player(room: Room, p: Player) -> Optional[str]:
-    st = room.state
-    if st.phase != "playing":
-        return "Not in playing phase"
-    if p.seat_index != st.turn_seat:
-        return "Not your turn"
-    if p.status != "playing":
-        return "You are not in playing state"
-    if not st.wall:
-        _void_round_by_empty_wall(room)
-        return "Wall empty. Round ended."
-    tile = st.wall.pop()
-    p.hand.append(tile)
-    cutin = special_role_cutin(p.hand)
-    if cutin:
-        label = cutin["label"]
-        sound = cutin.get("sound", "normal")
-        st.cutin = {"seat": p.seat_index, "label": label, "sound": sound, "sig": f"{p.seat_index}:{len(p.hand)}:{label}:{sound}"}
-    else:
-        st.cutin = None
-    if hand_total(p.hand) > TARGET and not is_special_role(p.hand):
-        p.status = "bust"
-        if p.seat_index == st.dealer_seat:
-            _end_round(room)
-        else:
-            nxt = _next_active_seat(room, st.turn_seat)
-            if nxt is None:
-                _end_round(room)
-            else:
-                st.turn_seat = nxt
-    return None
-
-def _stay_for_player(room: Room, p: Player) -> Optional[str]:
-    st = room.state
-    if st.phase != "playing":
-        return "Not in playing phase"
-    if p.seat_index != st.turn_seat:
-        return "Not your turn"
-    if p.status != "playing":
-        return "You are not in playing state"
-    p.status = "stay"
-    if p.seat_index == st.dealer_seat and is_special_role(p.hand):
-        _end_round(room)
+async def _bot_turn(room_id: str) -> Optional[float]:
+    """BOT を1手進めて送る（bot_scheduler.py が期限の来たルームごとに呼ぶ）。次の手までの秒数か、BOT の番でなければ None"""
+    room = manager.get_room(room_id)
+    if not room:
         return None
-    nxt = _next_active_seat(room, st.turn_seat)
-    if nxt is None:
-        _end_round(room)
-    else:
-        st.turn_seat = nxt
-    return None
-
-async def _bot_step_locked(room: Room) -> bool:
-    st = room.state
-    # 0以下のBOTは自動で300点補充
-    for p in room.players():
-        if p.is_bot and (p.points or 0) <= 0:
-            p.points = (p.points or 0) + 300
-
-    if st.phase == "reset_prompt":
-        dealer_sid = room.seat_to_sid.get(st.dealer_seat)
-        dealer = room.players_by_sid.get(dealer_sid) if dealer_sid else None
-        if dealer and dealer.is_bot:
-            required = INITIAL_HAND_SIZE * len(room.players())
-            need_reset = len(st.wall) < required or len(st.wall) <= 30
-            if need_reset:
-                wall = make_standard_tiles()
-                random.shuffle(wall)
-                dora = wall[: min(34, len(wall))]
-                st.wall = wall[min(34, len(wall)):]
-                st.dora_displays = dora
-            _prepare_betting_phase(room)
-            return True
-        return False
-
-    if st.phase == "betting":
-        acted = False
-        for p in room.players():
-            if not p.is_bot:
-                continue
-            if p.seat_index == st.dealer_seat:
-                continue
-            if p.bet_points is None:
-                p.bet_points = _bot_choose_bet(p, st.dora_displays)
-                acted = True
-        if acted and _all_children_bet(room):
-            _start_playing_phase(room)
-        return acted
-
-    if st.phase == "playing":
-        sid = room.seat_to_sid.get(st.turn_seat)
-        p = room.players_by_sid.get(sid) if sid else None
-        if p and p.is_bot and p.status == "playing":
-            if _bot_should_draw(p, st.dora_displays):
-                _draw_tile_for_player(room, p)
-            else:
-                _stay_for_player(room, p)
-            return True
-    return False
-
-async def _run_bots(room_id: str) -> None:
-    try:
-        while True:
-            room = manager.get_room(room_id)
-            if not room:
-                return
-            acted = False
-            async with room.lock:
-                acted = await _bot_step_locked(room)
-            if not acted:
-                return
-            await emit_room_state(room)
-            await asyncio.sleep(0.35)
-    finally:
-        room = manager.get_room(room_id)
-        if room:
-            room.bot_running = False
+    if room.lock.locked():   # 人の操作の途中。待つと同じ起床の他のルームまで止まるので後で試し直す
+        return BOT_RETRY_DELAY
+    async with room.lock:
+        acted = _bot_step_locked(room)
+    _run_effects(room)
+    if not acted:
+        return None
+    await emit_room_state(room)
+    return bots.interval
 
-def _schedule_bots(room: Room) -> None:
-    if room.bot_running:
-        return
-    room.bot_running = True
-    asyncio.create_task(_run_bots(room.room_id))
+# 全ルームの BOT の手番を1つのヒープとタイマーで回す（TOPPAN_BOT_INTERVAL / TOPPAN_BOT_BATCH）
+bots = BotScheduler(_bot_turn)
 
-async def emit_state_to_sid(room: Room, sid: str) -> None:
-    you_p = room.players_by_sid.get(sid)
-    you_seat = you_p.seat_index if you_p else None
+def _run_effects(room: Room) -> None:
+    """engine が積んだ副作用を実行する（ロックの外で呼ぶ）"""
+    for effect in drain_effects(room):
+        if isinstance(effect, RoundSettled):
+            # 清算後に必ず次ラウンド（配牌→betting）へ
+            asyncio.create_task(auto_next_round(room.room_id))
+            _queue_settlement(room, effect.results)
+            asyncio.create_task(emit_settlement_to_chat(room, effect.results))
+            asyncio.create_task(_kick_broke_players(room.room_id))
+
+def _schedule_bots(room: Room) -> None:
+    bots.schedule(room.room_id)
 
+def build_state_payload(room: Room) -> dict:
+    """全員に共通の state（親の1枚目は伏せたまま、you_seat は None）"""
     players_sorted = sorted(room.players(), key=lambda pl: pl.seat_index)
     st = room.state
-    payload = {
+    return {
         "room_id": room.room_id,
         "host": room.host_sid,
         "phase": st.phase,
         "turn_seat": st.turn_seat,
         "wall_count": len(st.wall),
-        "players": [minimal_player_view(p, is_you=(p.sid == sid), state=st) for p in players_sorted],
+        "players": [minimal_player_view(p, is_you=False, state=st) for p in players_sorted],
         "seats": SEATS,
-        "dora_displays": getattr(st, "dora_displays", []),
-        "results": getattr(st, "results", {}),
+        "dora_displays": [TILE_LABELS[t] for t in getattr(st, "dora_displays", [])],
+        "results_id": st.results.get("id"),   # 中身は settlement イベント / get_settlement
         "dealer_seat": st.dealer_seat,
         "dealer_first_hidden": st.dealer_first_hidden,
         "cutin": getattr(st, "cutin", None),
-        "you_seat": you_seat,
+        "you_seat": None,
     }
-    await sio.emit("state", payload, to=sid)
-
-def seat_label(i: int) -> str:
-    return SEATS[i]
-
-def first_open_seat(seat_to_sid: Dict[int, Optional[str]]) -> Optional[int]:
-    for i in range(4):
-        if not seat_to_sid[i]:
-            return i
-    return None
-
-
-def _advance_turn(room: Room) -> None:
-    st = room.state
-    if st.turn_seat is None:
-        return
-    for step in range(1, 5):
-        nxt = (st.turn_seat + step) % 4
-        sid = room.seat_to_sid.get(nxt)
-        if not sid:
-            continue
-        p = room.players_by_sid.get(sid)
-        if p and p.status == "playing":
-            st.turn_seat = nxt
-            return
-    # playing が誰もいない
-    st.turn_seat = None
-
-def _all_children_bet(room: Room) -> bool:
-    st = room.state
-    for p in room.players():
-        if p.seat_index == st.dealer_seat:
-            continue
-        if p.bet_points is None:
-            return False
-    return True
-
-def _deal_initial_tiles(room: Room, count: int = INITIAL_HAND_SIZE) -> None:
-    st = room.state
-    if count <= 0:
-        return
-    for p in room.players():
-        while len(p.hand) < count and st.wall:
-            p.hand.append(st.wall.pop())
-
-def _clear_for_next_round(room: Room) -> None:
-    for p in room.players():
-        p.hand = []
-        p.discards = []
-        p.status = "playing"
-        if p.seat_index != room.state.dealer_seat:
-            p.bet_points = None
-        else:
-            p.bet_points = None
 
-def _start_playing_phase(room: Room) -> None:
-    st = room.state
-    # betting時に配られていない場合の保険
-    _deal_initial_tiles(room, INITIAL_HAND_SIZE)
-    st.phase = "playing"
-    st.turn_seat = st.dealer_seat
-
-def _prepare_betting_phase(room: Room) -> None:
-    st = room.state
-    _clear_for_next_round(room)
-    _deal_initial_tiles(room, INITIAL_HAND_SIZE)
-    st.phase = "betting"
-    st.turn_seat = None
-    st.dealer_first_hidden = True
-    st.results = {}
-    st.cutin = None
-
-def _maybe_finish_round(room: Room) -> None:
+def _viewer_payload(room: Room, public: dict, sid: str) -> dict:
+    """共通の state に閲覧者ごとの差分を重ねる（浅いコピーなので共通部分は共有）"""
+    you_p = room.players_by_sid.get(sid)
+    payload = dict(public)
+    payload["you_seat"] = you_p.seat_index if you_p else None
     st = room.state
-    if st.phase != "playing":
-        return
-    # まだ誰かが playing 中なら続行
-    if any(p.status == "playing" for p in room.players()):
-        return
-
-    # 全員終了 → 親の伏せ札公開
-    st.dealer_first_hidden = False
-
-    # 清算（子 vs 親）
-    players_sorted = sorted(room.players(), key=lambda pl: pl.seat_index)
-    dealer = next((p for p in players_sorted if p.seat_index == st.dealer_seat), None)
-    if not dealer:
-        st.phase = "ended"; return
-
-    dealer_total = hand_total(dealer.hand)
-    dealer_bust = dealer_total > TARGET
-
-    results = []
-    dealer_delta = 0
-
-    for p in players_sorted:
-        if p.seat_index == st.dealer_seat:  # 親はスキップ
-            continue
-        bet = int(p.bet_points or 0)
-        if bet <= 0:
-            results.append({"child_seat": p.seat_index, "bet": 0, "outcome": "push"})
-            continue
+    if you_p and you_p.seat_index == st.dealer_seat and st.dealer_first_hidden and you_p.hand:
+        # 親本人にだけ伏せ札を見せる
+        payload["players"] = [
+            minimal_player_view(you_p, is_you=True, state=st) if v["seat"] == you_p.seat_index else v
+            for v in public["players"]
+        ]
+    return payload
 
-        child_total = hand_total(p.hand)
-        child_bust = child_total > TARGET
-
-        # 勝敗判定
-        if child_bust and dealer_bust:
-            outcome = "push"
-            delta = 0
-        elif child_bust:
-            outcome = "dealer_win"
-            delta = -bet
-        elif dealer_bust:
-            outcome = "child_win"
-            delta = +bet
-        else:
-            d_child = abs(TARGET - child_total)
-            d_deal  = abs(TARGET - dealer_total)
-            if d_child < d_deal:
-                outcome = "child_win"; delta = +bet
-            elif d_child > d_deal:
-                outcome = "dealer_win"; delta = -bet
-            else:
-                outcome = "push"; delta = 0
-
-        # 点数移動（子のdelta。親は反対符号）
-        p.points += delta
-        dealer_delta -= delta
-
-        results.append({
-            "child_seat": p.seat_index,
-            "child_total": child_total,
-            "dealer_total": dealer_total,
-            "bet": bet,
-            "outcome": outcome,
-            "delta_child": delta,
-        })
-
-    dealer.points += dealer_delta
-    st.results = {"dealer_seat": st.dealer_seat, "pairs": results, "dealer_delta": dealer_delta}
-    st.phase = "ended"
+async def emit_state_to_sid(room: Room, sid: str) -> None:
+    room.state_version += 1
+    public = build_state_payload(room)
+    payload = _viewer_payload(room, public, sid)
+    event, data = _viewer_sync(sid).packet(room.state_version, payload, _viewer_variant(public, payload))
+    async with _broadcaster(room).send_lock:
+        await sio.emit(event, data, to=sid)
 
 async def auto_next_round(room_id: str):
     await asyncio.sleep(3.0)  # 清算表示の小休止
@@ -790,23 +615,24 @@ async def auto_next_round(room_id: str):
     await emit_room_state(room)
     _schedule_bots(room)
 
-def _start_next_round_locked(room: Room) -> None:
-    st = room.state
-    _clear_for_next_round(room)
-    # 山・ドラは原則固定。次ラウンド開始前に親へリセット確認
-    room.state = GameState(
-        phase="reset_prompt",
-        wall=st.wall,
-        turn_seat=None,
-        dealer_seat=st.dealer_seat,
-        dealer_first_hidden=True,
-        dora_displays=getattr(st, "dora_displays", []),
-        results={},
-        cutin=None
-    )
-
 # ---------------------- Socket.IO Event Handlers ----------------------
 
+@sio.event
+async def state_ack(sid, data):
+    """クライアントが適用した state のバージョン。data: {"version": int}"""
+    version = (data or {}).get("version")
+    sync = viewer_syncs.get(sid)
+    if sync is not None and isinstance(version, int):
+        sync.ack(version)
+
+@sio.event
+async def state_resync(sid, data):
+    """パッチの基点を持っていないクライアントにスナップショットを送り直す"""
+    _reset_viewer_sync(sid)
+    room = manager.room_of(sid)
+    if room and sid in room.players_by_sid:
+        await emit_state_to_sid(room, sid)
+
 @sio.event
 async def connect(sid, environ, auth):
     # Nothing here; wait for join/create
@@ -814,10 +640,50 @@ async def connect(sid, environ, auth):
 
 @sio.event
 async def disconnect(sid):
+    sync = viewer_syncs.pop(sid, None)
+    chat_limits.pop(sid, None)
+    if manager.hold_player(sid, sync):
+        return   # RECONNECT_GRACE 秒は席をそのまま。resume で戻れば誰にも何も送らない
     room = await manager.remove_player(sid)
     if room:
         await emit_room_state(room)
 
+@sio.event
+async def resume(sid, data):
+    """
+    切断から戻る: 参加時の token で同じ席に付け替える。
+    data: { "token": "...", "version": <手元の最新の state のバージョン>, "chat_id": <最後に受け取ったチャットの id> }
+    state は ack 済みのバージョンからのパッチ（手元に state が無ければスナップショット）1回で追いつく
+    """
+    session = manager.sessions.claim((data or {}).get("token"))
+    room = manager.get_room(session.room_id) if session else None
+    if room is None:
+        return {"ok": False, "error": "Session expired"}
+    current = manager.room_of(sid)
+    if current is not None and current is not room:
+        await _leave_current_room(sid)
+    old = session.sid
+    async with room.lock:
+        player = room.players_by_sid.get(old)
+        if player is None or manager.sessions.by_sid.get(old) is not session:
+            return {"ok": False, "error": "Session expired"}   # ロック待ちの間に退室になった
+        sync = session.sync or viewer_syncs.pop(old, None)
+        if old != sid:
+            manager.rebind_locked(room, player, sid)
+        if sync is None or not isinstance((data or {}).get("version"), int):
+            sync = ViewerSync()   # ページを読み込み直した: パッチの基点を持っていない
+        viewer_syncs[sid] = sync
+        await sio.enter_room(sid, room.room_id)
+    if old != sid and sio.manager.is_connected(old, "/"):
+        # 古い接続がまだ切れていない（切断に気づく前に繋ぎ直した）。こちらに乗り換える
+        await sio.leave_room(old, room.room_id)
+        await sio.disconnect(old)
+    manager.touch(room)
+    await emit_state_to_sid(room, sid)
+    chat_id = (data or {}).get("chat_id")
+    await replay_chat(room, sid, chat_id if isinstance(chat_id, int) else None)
+    return {"ok": True, "room_id": room.room_id, "token": session.token}
+
 @sio.event
 async def create_room(sid, data):
     """
@@ -825,21 +691,25 @@ async def create_room(sid, data):
     data: { "name": "<player name>" }
     """
     name = (data or {}).get("name") or f"Player-{sid[:4]}"
-    room = await manager.create_room()
+    previous = manager.sid_room.get(sid)
+    try:
+        room = await manager.create_room()
+    except RoomLimitError as e:
+        return {"ok": False, "error": str(e)}
     async with room.lock:
         seat = first_open_seat(room.seat_to_sid)
         if seat is None:
             return {"ok": False, "error": "Room is full"}
-        player = Player(sid=sid, name=name, seat_index=seat)
-        room.players_by_sid[sid] = player
-        room.seat_to_sid[seat] = sid
+        manager.add_player_locked(room, Player(sid=sid, name=name, seat_index=seat))
         room.host_sid = sid
-        await sio.save_session(sid, {"room_id": room.room_id})
+        _reset_viewer_sync(sid)
         await sio.enter_room(sid, room.room_id)
+    if previous is not None:   # 作れて座れてから前のルームを抜ける
+        await _leave_room(sid, previous)
     await emit_room_state(room)
     await emit_player_list_to_chat(room)
     _schedule_bots(room)
-    return {"ok": True, "room_id": room.room_id}
+    return {"ok": True, "room_id": room.room_id, "token": manager.sessions.issue(room.room_id, sid)}
 
 @sio.event
 async def join_room(sid, data):
@@ -850,26 +720,34 @@ async def join_room(sid, data):
     if not data or "room_id" not in data:
         return {"ok": False, "error": "room_id required"}
     name = data.get("name") or f"Player-{sid[:4]}"
+    if not manager.cluster.owns(data["room_id"]):
+        # 他のワーカーのルーム。client.js が持ち主のワーカーへ移って参加し直す
+        return {"ok": False, "error": "Room is on another server", "redirect": manager.cluster.url_for(data["room_id"])}
     room = manager.get_room(data["room_id"])
     if not room:
         return {"ok": False, "error": "Room not found"}
+    if sid in room.players_by_sid:
+        return {"ok": True, "room_id": room.room_id, "token": manager.sessions.issue(room.room_id, sid)}
+    if room.seats_filled() >= 4:
+        return {"ok": False, "error": "Room is full"}
+    previous = manager.sid_room.get(sid)
     async with room.lock:
         if room.seats_filled() >= 4:
             return {"ok": False, "error": "Room is full"}
-        if sid in room.players_by_sid:
-            return {"ok": True, "room_id": room.room_id}
         seat = first_open_seat(room.seat_to_sid)
-        player = Player(sid=sid, name=name, seat_index=seat)
-        room.players_by_sid[sid] = player
-        room.seat_to_sid[seat] = sid
-        await sio.save_session(sid, {"room_id": room.room_id})
+        manager.add_player_locked(room, Player(sid=sid, name=name, seat_index=seat))
+        _reset_viewer_sync(sid)
         await sio.enter_room(sid, room.room_id)
         if room.is_free_match:
             _sync_free_room_bots_locked(room)
+    if previous is not None:   # 席が取れてから前のルームを抜ける（満席で断られたら元の席のまま）
+        await _leave_room(sid, previous)
+    manager.pool.offer(room)
     await emit_room_state(room)
+    await replay_chat(room, sid)
     await emit_player_list_to_chat(room)
     _schedule_bots(room)
-    return {"ok": True, "room_id": room.room_id}
+    return {"ok": True, "room_id": room.room_id, "token": manager.sessions.issue(room.room_id, sid)}
 
 @sio.event
 async def free_match(sid, data):
@@ -877,57 +755,27 @@ async def free_match(sid, data):
     Quick match into a shared room.
     data: { "name": "<player name>" }
     """
-    session = await sio.get_session(sid)
-    if session and session.get("room_id"):
-        return {"ok": True, "room_id": session.get("room_id")}
+    current = manager.room_of(sid)
+    if current:
+        return {"ok": True, "room_id": current.room_id, "token": manager.sessions.issue(current.room_id, sid)}
     name = (data or {}).get("name") or f"Player-{sid[:4]}"
-    room = await manager.get_free_room()
-    async with room.lock:
-        if room.seats_filled() >= 4:
-            return {"ok": False, "error": "Room is full"}
-        seat = first_open_seat(room.seat_to_sid)
-        if seat is None:
-            return {"ok": False, "error": "Room is full"}
-        player = Player(sid=sid, name=name, seat_index=seat)
-        room.players_by_sid[sid] = player
-        room.seat_to_sid[seat] = sid
-        if not room.host_sid:
-            room.host_sid = sid
-        await sio.save_session(sid, {"room_id": room.room_id})
-        await sio.enter_room(sid, room.room_id)
-        _sync_free_room_bots_locked(room)
-        # Auto start for free match when at least 2 players (human/bot)
-        if room.seats_filled() >= 2 and room.state.phase == "waiting":
-            wall = make_standard_tiles()
-            dora = wall[:min(34, len(wall))]
-            wall = wall[min(34, len(wall)):]
-            for p in room.players():
-                p.points = p.initial_points if (p.initial_points is not None) else 300
-                p.hand = []
-                p.discards = []
-                p.ready = False
-                p.status = "playing"
-                p.bet_points = None
-            room.state = GameState(
-                phase="reset_prompt",
-                wall=wall,
-                turn_seat=None,
-                dealer_seat=0,
-                dealer_first_hidden=True,
-                dora_displays=dora,
-                results={},
-                cutin=None
-            )
+    # 同じ周回に来た人とまとめて、人間が多く長く待っている卓から着席させる（BOT とも入れ替わる）
+    try:
+        room = await manager.pool.join(sid, name)
+    except RoomLimitError as e:
+        return {"ok": False, "error": str(e)}
+    _reset_viewer_sync(sid)
+    await sio.enter_room(sid, room.room_id)
     await emit_room_state(room)
+    await replay_chat(room, sid)
     await emit_player_list_to_chat(room)
     _schedule_bots(room)
-    return {"ok": True, "room_id": room.room_id}
+    return {"ok": True, "room_id": room.room_id, "token": manager.sessions.issue(room.room_id, sid)}
 
 @sio.event
 async def add_bot(sid, data):
     """Add a bot player to the room. data: {"name": "BOT"}"""
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
     async with room.lock:
@@ -940,9 +788,7 @@ async def add_bot(sid, data):
             return {"ok": False, "error": "Room is full"}
         name = (data or {}).get("name") or f"BOT-{seat+1}"
         bot_sid = f"BOT-{room.room_id}-{seat}"
-        player = Player(sid=bot_sid, name=name, seat_index=seat, is_bot=True)
-        room.players_by_sid[bot_sid] = player
-        room.seat_to_sid[seat] = bot_sid
+        manager.add_player_locked(room, Player(sid=bot_sid, name=name, seat_index=seat, is_bot=True))
     await emit_room_state(room)
     await emit_player_list_to_chat(room)
     _schedule_bots(room)
@@ -951,8 +797,7 @@ async def add_bot(sid, data):
 @sio.event
 async def set_ready(sid, data):
     """Mark yourself ready/unready. data: {"ready": bool}"""
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
     async with room.lock:
@@ -975,20 +820,16 @@ async def set_initial_points(sid, data):
     if pts < 0 or pts > 1000000:
         return {"ok": False, "error": "points out of range"}
 
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
     async with room.lock:
         p = room.players_by_sid.get(sid)
         if not p:
             return {"ok": False, "error": "Player not found"}
-        if room.state.phase != "waiting":
-            return {"ok": False, "error": "Game already started"}
-        p.initial_points = pts
-        # 既にベット設定済みなら、持ち点に合わせてクランプ
-        if p.bet_points is not None and p.seat_index != room.state.dealer_seat:
-            p.bet_points = max(0, min(p.bet_points, pts))
+        err = _set_initial_points_for_player(room, p, pts)
+        if err:
+            return {"ok": False, "error": err}
     await emit_room_state(room)
     return {"ok": True}
 
@@ -1004,8 +845,7 @@ async def add_points(sid, data):
     if add <= 0 or add > 1_000_000:
         return {"ok": False, "error": "points out of range"}
 
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
 
@@ -1013,74 +853,28 @@ async def add_points(sid, data):
         p = room.players_by_sid.get(sid)
         if not p:
             return {"ok": False, "error": "Player not found"}
-        if (p.points or 0) > 0:
-            return {"ok": False, "error": "Only available when points are 0 or less"}
-        p.points = (p.points or 0) + add
+        err = _add_points_for_player(room, p, add)
+        if err:
+            return {"ok": False, "error": err}
     await emit_room_state(room)
     return {"ok": True, "points": p.points}
 
 
-def _tile_sort_key(label: str) -> tuple:
-    # "1萬"/"5筒"/"7索"/"東南西北白發中" 前提
-    suit_order = {"萬":0, "筒":1, "索":2}
-    honor_order = {"東":0, "南":1, "西":2, "北":3, "白":4, "發":5, "中":6}
-    s = label.strip()
-    # 数牌
-    if len(s) >= 2 and s[0].isdigit():
-        num = int(s[0])
-        suit = s[1]
-        return (0, num, suit_order.get(suit, 9))
-    # 字牌
-    if s in honor_order:
-        return (1, honor_order[s])
-    return (9, 9, 99)
+def _tile_sort_key(tile: int) -> tuple:
+    # 数牌は数字→スート順、字牌は東南西北白發中の順
+    if TILE_NUMBER[tile]:
+        return (0, TILE_NUMBER[tile], TILE_SUIT[tile])
+    return (1, tile - EAST)
 
 @sio.event
 async def start_game(sid, data):
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
     async with room.lock:
-        if room.state.phase != "waiting":
-            return {"ok": False, "error": "Game already started"}
-        if not (sid == room.host_sid):
-            return {"ok": False, "error": "Only host can start"}
-        n_players = room.seats_filled()
-        if n_players < 2:
-            return {"ok": False, "error": "Need at least 2 players"}
-        # 山生成（以後のラウンドでは固定）
-        wall = make_standard_tiles()
-
-        # ドラ表示牌（ゲーム影響なし／表示用）34枚
-        # 毎ラウンド固定にするため、壁からは取り除かない
-        dora = wall[:min(34, len(wall))]
-        wall = wall[min(34, len(wall)):]
-
-        # 点数確定＆状態初期化
-        for p in room.players():
-            p.points = p.initial_points if (p.initial_points is not None) else 300
-            p.hand = []
-            p.discards = []
-            p.ready = False
-            p.status = "playing"
-            # ラウンド開始時に掛け金は必ず再設定
-            if p.seat_index != room.state.dealer_seat:
-                p.bet_points = None
-            else:
-                p.bet_points = None
-
-        # 親は東（seat_index=0）固定
-        room.state = GameState(
-            phase="reset_prompt",
-            wall=wall,
-            turn_seat=None,
-            dealer_seat=0,
-            dealer_first_hidden=True,
-            dora_displays=dora,
-            results={},
-            cutin=None
-        )
+        err = _start_game_locked(room, sid)
+        if err:
+            return {"ok": False, "error": err}
     await emit_room_state(room)
     _schedule_bots(room)
     return {"ok": True}
@@ -1097,25 +891,17 @@ async def set_bet_points(sid, data):
     if bet < 0 or bet > 10:
         return {"ok": False, "error": "bet out of range"}
 
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
 
     async with room.lock:
-        if room.state.phase != "betting":
-            return {"ok": False, "error": "Not in betting phase"}
         p = room.players_by_sid.get(sid)
         if not p:
             return {"ok": False, "error": "Player not found"}
-        # 親はベット不要（無視）
-        if p.seat_index == room.state.dealer_seat:
-            return {"ok": False, "error": "Dealer does not bet"}
-        # 所持点（開始時持ち点を優先）を超えないようにクランプ
-        available = p.initial_points if p.initial_points is not None else (p.points if p.points is not None else 300)
-        p.bet_points = max(0, min(bet, available))
-        if room.state.phase == "betting" and _all_children_bet(room):
-            _start_playing_phase(room)
+        err = _set_bet_for_player(room, p, bet)
+        if err:
+            return {"ok": False, "error": err}
     await emit_room_state(room)
     _schedule_bots(room)
     return {"ok": True}
@@ -1125,209 +911,38 @@ async def set_bet_points(sid, data):
 async def dealer_reset(sid, data):
     """親が山のリセット可否を確定する。data: {"reset": bool}"""
     reset = bool((data or {}).get("reset", False))
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
     async with room.lock:
-        st = room.state
-        if st.phase != "reset_prompt":
-            return {"ok": False, "error": "Not in reset prompt"}
-        if st.dealer_seat is None:
-            return {"ok": False, "error": "Dealer not set"}
-        if room.seat_to_sid.get(st.dealer_seat) != sid:
-            return {"ok": False, "error": "Only dealer can decide"}
-
-        if reset:
-            wall = make_standard_tiles()
-            random.shuffle(wall)
-            dora = wall[: min(34, len(wall))]
-            st.wall = wall[min(34, len(wall)):]
-            st.dora_displays = dora
-        else:
-            required = INITIAL_HAND_SIZE * len(room.players())
-            if len(st.wall) < required:
-                return {"ok": False, "error": "Wall empty. Please reset."}
-
-        _prepare_betting_phase(room)
+        err = _dealer_reset_locked(room, sid, reset)
+        if err:
+            return {"ok": False, "error": err}
     await emit_room_state(room)
     _schedule_bots(room)
     return {"ok": True}
 
 
-def _next_active_seat(room: Room, from_seat: int) -> Optional[int]:
-    # 次の "playing" 状態の着席者へ
-    for step in range(1, 5):
-        nxt = (from_seat + step) % 4
-        sid = room.seat_to_sid.get(nxt)
-        if not sid:
-            continue
-        p = room.players_by_sid[sid]
-        if p.status == "playing":
-            return nxt
-    return None
-
-def _next_seated_seat(room: Room, from_seat: int) -> Optional[int]:
-    # 次の着席者（東→南→西→北の順）
-    for step in range(1, 5):
-        nxt = (from_seat + step) % 4
-        if room.seat_to_sid.get(nxt):
-            return nxt
-    return None
-
-def _all_done(room: Room) -> bool:
-    return all(p.status != "playing" for p in room.players())
-
-def _void_round_by_empty_wall(room: Room) -> None:
-    """山切れ時はラウンド無効。親が各子に100支払う。"""
-    st = room.state
-    st.cutin = None
-    st.dealer_first_hidden = False
-    current_dealer_seat = st.dealer_seat
-    dealer_sid = room.seat_to_sid.get(current_dealer_seat)
-    dealer = room.players_by_sid.get(dealer_sid) if dealer_sid else None
-    if not dealer:
-        st.phase = "ended"
-        st.turn_seat = None
-        return
-
-    results = {}
-    dealer_delta = 0
-    for p in room.players():
-        if p.seat_index == current_dealer_seat:
-            continue
-        delta = 100
-        p.points = (p.points or 0) + delta
-        dealer_delta -= delta
-        results[p.seat_index] = {
-            "result": 0,
-            "bet": int(p.bet_points or 0),
-            "delta": delta,
-            "child_total": hand_total(p.hand),
-            "dealer_total": hand_total(dealer.hand),
-            "child_roles": [],
-            "child_role_total": 0,
-            "dealer_roles": [],
-            "dealer_role_total": 0,
-        }
-
-    dealer.points = (dealer.points or 0) + dealer_delta
-    for p in room.players():
-        if p.seat_index != current_dealer_seat:
-            p.bet_points = None
-    st.results = {
-        "dealer_seat": current_dealer_seat,
-        "dealer_delta": dealer_delta,
-        "pairs": results,
-        "reason": "wall_empty_void",
-    }
-    st.phase = "ended"
-    st.turn_seat = None
-    asyncio.create_task(auto_next_round(room.room_id))
-    asyncio.create_task(emit_settlement_to_chat(room, st.results))
-    asyncio.create_task(_kick_broke_players(room.room_id))
-
-def _end_round(room: Room) -> None:
-    st = room.state
-    st.cutin = None
-    st.dealer_first_hidden = False  # 親の伏せ札を公開
-    # 親・子それぞれの合計
-    current_dealer_seat = st.dealer_seat
-    dealer_sid = room.seat_to_sid.get(current_dealer_seat)
-    dealer = room.players_by_sid[dealer_sid] if dealer_sid else None
-    dealer_sum = hand_total(dealer.hand) if dealer else 0.0
-    dealer_breakdown = role_breakdown(dealer.hand, room.state.dora_displays) if dealer else {"total": 0, "items": []}
-    dealer_role = dealer_breakdown["total"]
-
-    results = {}
-    dealer_delta = 0
-    for p in room.players():
-        if p.seat_index == st.dealer_seat:
-            continue
-        child_sum = hand_total(p.hand)
-        child_breakdown = role_breakdown(p.hand, room.state.dora_displays)
-        if is_special_role(dealer.hand):
-            result_value = -dealer_role
-        elif len(dealer.hand) >= 5 and dealer_sum <= TARGET:
-            result_value = -dealer_role
-        elif len(p.hand) >= 5 and child_sum <= TARGET:
-            # 5枚以上引いてバーストしていなければ優先勝ち
-            result_value = child_breakdown["total"]
-        elif is_special_role(p.hand):
-            result_value = child_breakdown["total"]
-        # バーストは即負け。親がバーストなら子が10.5以下なら勝ち
-        elif dealer_sum > TARGET and not is_tsumo(dealer.hand):
-            result_value = child_breakdown["total"]
-        elif child_sum > TARGET and not is_tsumo(p.hand):
-            result_value = -dealer_role
-        else:
-            if abs(TARGET - child_sum) < abs(TARGET - dealer_sum):
-                result_value = child_breakdown["total"]
-            elif abs(TARGET - child_sum) >= abs(TARGET - dealer_sum):
-                result_value = -dealer_role
-
-        bet = int(p.bet_points or 0)
-        delta = int(bet * result_value)
-        p.points = (p.points or 0) + delta
-        dealer_delta -= delta
-        results[p.seat_index] = {
-            "result": result_value,
-            "bet": bet,
-            "delta": delta,
-            "child_total": child_sum,
-            "dealer_total": dealer_sum,
-            "child_roles": child_breakdown["items"],
-            "child_role_total": child_breakdown["total"],
-            "dealer_roles": dealer_breakdown["items"],
-            "dealer_role_total": dealer_breakdown["total"],
-        }
-
-    if dealer:
-        dealer.points = (dealer.points or 0) + dealer_delta
-    # 次ラウンドで必ず再設定させる
-    for p in room.players():
-        if p.seat_index != st.dealer_seat:
-            p.bet_points = None
-    st.results = {
-        "dealer_seat": current_dealer_seat,
-        "dealer_delta": dealer_delta,
-        "pairs": results,
-    }
-    # 親がバーストしたら次の着席者へ交代
-    if dealer_sum > TARGET and not is_tsumo(dealer.hand):
-        nxt = _next_seated_seat(room, current_dealer_seat)
-        if nxt is not None:
-            st.dealer_seat = nxt
-    st.phase = "ended"
-    st.turn_seat = None
-    # 清算後に必ず次ラウンド（配牌→betting）へ
-    asyncio.create_task(auto_next_round(room.room_id))
-    asyncio.create_task(emit_settlement_to_chat(room, st.results))
-    asyncio.create_task(_kick_broke_players(room.room_id))
-
 @sio.event
 async def draw_tile(sid, data):
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
     async with room.lock:
-        st = room.state
         p = room.players_by_sid.get(sid)
         if not p:
             return {"ok": False, "error": "Player not found"}
         err = _draw_tile_for_player(room, p)
-        if err:
-            await emit_room_state(room)
-            return {"ok": False, "error": err}
+    _run_effects(room)
     await emit_room_state(room)
+    if err:
+        return {"ok": False, "error": err}
     _schedule_bots(room)
     return {"ok": True}
 
 @sio.event
 async def stay(sid, data):
-    session = await sio.get_session(sid)
-    room = manager.get_room(session.get("room_id", "")) if session else None
+    room = manager.room_of(sid)
     if not room:
         return {"ok": False, "error": "Not in a room"}
     async with room.lock:
@@ -1335,31 +950,47 @@ async def stay(sid, data):
         if not p:
             return {"ok": False, "error": "Player not found"}
         err = _stay_for_player(room, p)
-        if err:
-            await emit_room_state(room)
-            return {"ok": False, "error": err}
+    _run_effects(room)
     await emit_room_state(room)
+    if err:
+        return {"ok": False, "error": err}
     _schedule_bots(room)
     return {"ok": True}
 
 
+@sio.event
+async def get_settlement(sid, data):
+    """直近の清算結果を取り直す（再接続・取り損ね用）。data: {"id": int}（省略時は今のもの）"""
+    room = manager.room_of(sid)
+    if not room:
+        return {"ok": False, "error": "Not in a room"}
+    results = room.state.results
+    want = (data or {}).get("id")
+    if results.get("id") is None or (want is not None and want != results["id"]):
+        return {"ok": False, "error": "No such settlement"}
+    return {"ok": True, "settlement": settlement_payload(results)}
+
+
 @sio.event
 async def chat(sid, data):
     """Simple room chat broadcast."""
-    msg = ((data or {}).get("message") or "").strip()
+    msg = ((data or {}).get("message") or "").strip()[:CHAT_MAX_LENGTH]
     if not msg:
         return {"ok": False, "error": "empty message"}
+    limit = chat_limits.get(sid)
+    if limit is None:
+        limit = chat_limits[sid] = ChatRateLimiter()
+    if not limit.allow():
+        return {"ok": False, "error": "チャットの送信が多すぎます"}
 
-    session = await sio.get_session(sid)
-    room_id = session.get("room_id") if session else None
-    if not room_id:
+    room = manager.room_of(sid)
+    if not room:
         return {"ok": False, "error": "no room"}
 
-    room = manager.get_room(room_id)
     name = None
     seat = None
     seat_label = None
-    if room and sid in room.players_by_sid:
+    if sid in room.players_by_sid:
         p = room.players_by_sid[sid]
         name = p.name
         seat = p.seat_index
@@ -1373,37 +1004,179 @@ async def chat(sid, data):
         "seat_label": seat_label,  # 例: "東"
         "message": msg
     }
-    await sio.emit("chat", payload, room=room_id)
+    manager.touch(room)
+    await emit_chat(room, payload)
     return {"ok": True}
 
 
-@sio.event
-async def leave_room(sid, data):
-    """Leave current room explicitly."""
-    session = await sio.get_session(sid)
-    room_id = session.get("room_id") if session else None
-    room = await manager.remove_player(sid)
-    if room_id:
-        try:
-            await sio.leave_room(sid, room_id)
-        except Exception:
-            pass
+def _session_expired(session: Session) -> None:
+    """預かっていた席の期限が来た: 普通の切断と同じく退室させる"""
+    asyncio.create_task(_remove_expired(session.sid, session.room_id))
+
+async def _remove_expired(sid: str, room_id: str) -> None:
+    room = await manager.remove_player(sid, room_id)   # 読み戻した席は索引に無いのでルームを指定する
+    if room:
+        await emit_room_state(room)
+
+async def _leave_current_room(sid: str) -> None:
+    """今いるルームから抜ける（退室・別ルームへの参加）"""
+    _reset_viewer_sync(sid)
+    room_id = manager.sid_room.get(sid)
+    if room_id is not None:
+        await _leave_room(sid, room_id)
+
+async def _leave_room(sid: str, room_id: str) -> None:
+    """sid をルーム room_id から抜く（別のルームに着いた後なら前のルームだけ）"""
+    room = await manager.remove_player(sid, room_id)   # フリーマッチの BOT 補充もここで
     try:
-        await sio.save_session(sid, {"room_id": None})
+        await sio.leave_room(sid, room_id)
     except Exception:
         pass
     if room:
-        if room.is_free_match:
-            async with room.lock:
-                _sync_free_room_bots_locked(room)
         await emit_room_state(room)
+
+@sio.event
+async def leave_room(sid, data):
+    """Leave current room explicitly."""
+    await _leave_current_room(sid)
     return {"ok": True}
 
 # -------------- Minimal REST helper (optional create-room) --------------
 
 @fastapi_app.get("/api/new", response_class=JSONResponse)
 async def api_new():
-    room = await manager.create_room()
+    try:
+        room = await manager.create_room()
+    except RoomLimitError as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
     return {"room_id": room.room_id}
 
+# ---------------------- Idle room reaper ----------------------
+
+def _room_closed(room: Room, humans: list, reason: str) -> None:
+    """RoomManager.close_room の後始末: 送信待ちを止め、中の人間に room_closed を送ってロビーへ戻す"""
+    b = room.broadcast
+    if b is not None and b.timer is not None:
+        b.timer.cancel()
+    bots.cancel(room.room_id)
+    for sid in humans:
+        _reset_viewer_sync(sid)
+    asyncio.create_task(_notify_room_closed(room.room_id, reason))
+
+async def _notify_room_closed(room_id: str, reason: str) -> None:
+    await sio.emit("room_closed", {"room_id": room_id, "reason": reason}, room=room_id)
+    await sio.close_room(room_id)
+
+async def reap_idle_rooms() -> None:
+    """REAP_INTERVAL ごとに TTL を過ぎたルームを消す"""
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        for room in manager.reaper.expired(manager.rooms):
+            manager.close_room(room, "idle")
+
+# ---------------------- Snapshots ----------------------
+
+# 保存先。設定したときだけ保存・復元する（既定は無効。再接続の token も入るので置き場所は明示してもらう）。
+# 複数ワーカーならワーカーごとに別ファイル
+SNAPSHOT_PATH = os.environ.get("TOPPAN_SNAPSHOT_PATH", "")
+if SNAPSHOT_PATH and CLUSTER.workers > 1:
+    SNAPSHOT_PATH = f"{SNAPSHOT_PATH}.{CLUSTER.index}"
+SNAPSHOT_INTERVAL = float(os.environ.get("TOPPAN_SNAPSHOT_INTERVAL", "30"))
+_snapshot_lock = asyncio.Lock()
+
+async def save_snapshot() -> int:
+    """全ルームを保存する。写すのは CAPTURE_CHUNK 件ずつループ上で、エンコードと書き込みはスレッドで"""
+    async with _snapshot_lock:
+        rooms = list(manager.rooms.values())
+        sessions = manager.sessions.saved()   # 読み戻した席に戻れるのはこの token だけ
+        captured: list = []
+        for i in range(0, len(rooms), snapshot.CAPTURE_CHUNK):
+            captured += snapshot.capture(rooms[i:i + snapshot.CAPTURE_CHUNK])
+            await asyncio.sleep(0)
+        return await asyncio.to_thread(snapshot.save, SNAPSHOT_PATH, captured, sessions)
+
+async def restore_snapshot() -> int:
+    """起動時に保存したルームを読み戻す。清算待ちのルームは次ラウンドへ、BOT は動かし直す"""
+    try:
+        rooms, sessions = await asyncio.to_thread(snapshot.load, SNAPSHOT_PATH) or ([], [])
+    except Exception:
+        logger.exception("failed to restore rooms from %s", SNAPSHOT_PATH)
+        return 0
+    tokens: Dict[str, Dict[str, str]] = {}   # room_id -> sid -> token
+    for token, room_id, sid in sessions:
+        tokens.setdefault(room_id, {})[sid] = token
+    restored = [
+        r for r in rooms if manager.cluster.owns(r.room_id) and r.room_id not in manager.rooms
+        and manager.adopt(r, tokens.get(r.room_id))
+    ]
+    for room in restored:
+        if room.state.phase == "ended":
+            asyncio.create_task(auto_next_round(room.room_id))
+        _schedule_bots(room)
+    logger.info("restored %d rooms from %s", len(restored), SNAPSHOT_PATH)
+    return len(restored)
+
+async def save_snapshots() -> None:
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await save_snapshot()
+        except Exception:
+            logger.exception("failed to save rooms to %s", SNAPSHOT_PATH)
+
+# ---------------------- Event log ----------------------
+
+_event_log_lock = asyncio.Lock()   # 取り出した順に書く
+
+async def flush_event_log() -> None:
+    """積んである操作ログをまとめて書いて fsync する（スレッドで）。書けなければバッファに戻して次の回に"""
+    async with _event_log_lock:
+        data = EVENT_LOG.take()
+        if data:
+            try:
+                await asyncio.to_thread(EVENT_LOG.write, data)
+            except OSError:
+                EVENT_LOG.put_back(data)
+                raise
+        if EVENT_LOG.rotated:
+            EVENT_LOG.rotated = False
+            await _checkpoint_rooms()
+
+async def _checkpoint_rooms() -> None:
+    """新しいセグメントの先頭に全ルームの checkpoint を積む（古いセグメントが消えても再生できるように）"""
+    rooms = list(manager.rooms.values())
+    for i, room in enumerate(rooms):
+        if i and i % snapshot.CAPTURE_CHUNK == 0:
+            await asyncio.sleep(0)
+        if room.journal is not None and manager.rooms.get(room.room_id) is room:
+            room.journal.checkpoint(room)
+
+async def flush_event_logs() -> None:
+    while True:
+        await asyncio.sleep(EVENT_LOG_FLUSH_INTERVAL)
+        try:
+            await flush_event_log()
+        except Exception:
+            logger.exception("failed to write the event log to %s", EVENT_LOG.directory)
+
+async def _on_startup() -> None:
+    if SNAPSHOT_PATH:
+        await restore_snapshot()
+        asyncio.create_task(save_snapshots())
+    if EVENT_LOG:
+        asyncio.create_task(flush_event_logs())
+    asyncio.create_task(reap_idle_rooms())
+
+async def _on_shutdown() -> None:
+    if SNAPSHOT_PATH:
+        await save_snapshot()
+    if EVENT_LOG:
+        await flush_event_log()
+        EVENT_LOG.close()
+
+# Serve static files (frontend)。/api/* より後に mount する（"/" は全パスに当たる）
+fastapi_app.mount("/", StaticFiles(directory=STATIC_DIR, html=True), name="static")
+
+app = socketio.ASGIApp(sio, other_asgi_app=fastapi_app, on_startup=_on_startup, on_shutdown=_on_shutdown)
+
 # ---------------------- End server.py ----------------------
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+再接続できるセッション
+----------------------
+回線が一瞬切れただけで席を空けると、host の付け替え・フリーマッチの BOT 補充・全員への送信が起き、
+本人も最初から参加し直しになる。そこで参加時に再接続用の token を渡し、切断されても
+TOPPAN_RECONNECT_GRACE 秒は席をそのまま預かる（0 なら従来どおりすぐ退室）。
+
+- issue: 席に着いた sid に token を渡す（同じルームにいる間は同じ token）
+- hold: 切断された sid の席を預かる。差分同期の状態（ViewerSync）も一緒に預かり、期限が来たら on_expire
+- claim / rebind: resume で token が届いたら期限を止め、席を新しい sid に付け替える。
+  まだ切断に気づいていない古い接続からの乗り換えもここを通る
+
+- saved / restore: スナップショット（snapshot.py）に token を保存し、読み戻した席を token ごと預かり直す。
+  再起動の後も、席に戻れるのは token を持った resume だけ
+
+席の付け替えと退室は server.py（RoomManager.rebind_locked / remove_player）が行う。
+"""
+
+from __future__ import annotations
+import asyncio
+import dataclasses
+import os
+import secrets
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+RECONNECT_GRACE = float(os.environ.get("TOPPAN_RECONNECT_GRACE", "30"))   # 席を預かる秒数
+
+
+@dataclass
+class SessionStats:
+    issued: int = 0    # 渡した token の数
+    held: int = 0      # 切断で席を預かった回数
+    resumed: int = 0   # token で戻った回数
+    expired: int = 0   # 戻らずに退室になった回数
+
+    def as_dict(self) -> Dict[str, int]:
+        return dataclasses.asdict(self)
+
+
+class Session:
+    __slots__ = ("token", "room_id", "sid", "timer", "sync")
+
+    def __init__(self, token: str, room_id: str, sid: str) -> None:
+        self.token = token
+        self.room_id = room_id
+        self.sid = sid
+        self.timer: Optional[asyncio.TimerHandle] = None   # 預かっている間だけ
+        self.sync: Any = None   # 切断時の ViewerSync（戻ったらそのまま使い、ack 済みの state からのパッチで追いつく）
+
+
+class SessionTable:
+    """token -> セッションと sid -> セッション"""
+
+    def __init__(self, grace: float = RECONNECT_GRACE) -> None:
+        self.grace = grace
+        self.by_token: Dict[str, Session] = {}
+        self.by_sid: Dict[str, Session] = {}
+        self.stats = SessionStats()
+
+    def issue(self, room_id: str, sid: str) -> str:
+        session = self.by_sid.get(sid)
+        if session is not None and session.room_id == room_id:
+            return session.token
+        self.drop(sid)
+        session = Session(secrets.token_urlsafe(16), room_id, sid)
+        self.by_token[session.token] = self.by_sid[sid] = session
+        self.stats.issued += 1
+        return session.token
+
+    def holds(self, sid: str) -> bool:
+        """切断されて席を預かっている sid か（state を送らない）"""
+        session = self.by_sid.get(sid)
+        return session is not None and session.timer is not None
+
+    def held(self) -> int:
+        return sum(1 for s in self.by_sid.values() if s.timer is not None)
+
+    def hold(self, sid: str, sync: Any, on_expire: Callable[[Session], None]) -> Optional[Session]:
+        """席を grace 秒預かる。token を渡していない sid・grace が 0 なら None（すぐ退室させる）"""
+        session = self.by_sid.get(sid)
+        if session is None or self.grace <= 0:
+            return None
+        if session.timer is not None:
+            session.timer.cancel()
+        session.sync = sync
+        session.timer = asyncio.get_running_loop().call_later(self.grace, self._expire, session, on_expire)
+        self.stats.held += 1
+        return session
+
+    def _expire(self, session: Session, on_expire: Callable[[Session], None]) -> None:
+        # 先に表から消しておく（退室までの間に届いた resume は期限切れとして断る）
+        session.timer = None
+        self.drop(session.sid)
+        self.stats.expired += 1
+        on_expire(session)
+
+    def saved(self) -> List[Tuple[str, str, str]]:
+        """スナップショットに保存する (token, room_id, sid)"""
+        return [(s.token, s.room_id, s.sid) for s in self.by_token.values()]
+
+    def restore(self, token: str, room_id: str, sid: str, on_expire: Callable[[Session], None]) -> Session:
+        """読み戻した席の token を登録して、繋ぎ直されるまで預かる（grace が 0 ならルームが消えるまで）"""
+        self.drop(sid)
+        session = Session(token, room_id, sid)
+        self.by_token[token] = self.by_sid[sid] = session
+        self.hold(sid, None, on_expire)
+        return session
+
+    def claim(self, token: Any) -> Optional[Session]:
+        """resume で届いた token のセッション。預かり中なら期限を止める"""
+        session = self.by_token.get(token) if isinstance(token, str) else None
+        if session is not None and session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        return session
+
+    def rebind(self, old: str, sid: str) -> None:
+        """セッションを新しい sid に付け替える（RoomManager.rebind_locked から）"""
+        session = self.by_sid.pop(old, None)
+        if session is None:
+            return
+        session.sid = sid
+        session.sync = None
+        self.by_sid[sid] = session
+        self.stats.resumed += 1
+
+    def drop(self, sid: str) -> None:
+        """退室・ルームの消滅で token を無効にする"""
+        session = self.by_sid.pop(sid, None)
+        if session is None:
+            return
+        self.by_token.pop(session.token, None)
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+ヘッドレス・モンテカルロシミュレーション
+----------------------------------------
+Socket.IO・sleep・asyncio なしで、engine.py の本物のルール関数
+（_draw_tile_for_player / _stay_for_player / _end_round）と BOT の方針
+（_bot_should_draw / _bot_choose_bet）を使ってラウンドを回し、席ごと・方針ごとの
+点数の流れを集計する。ラウンドはチャンクに分けて ProcessPoolExecutor で並列に回し、
+チャンクごとに seed から作った卓の RNG で山の seed を引くので結果は再現できる。
+
+Run:
+    python simulate.py --rounds 1000000 --policies bot,bot,threshold:7,stay --jobs 8 --seed 1
+
+方針:
+    bot          サーバの BOT（山の残り枚数も使う）
+    bot-blind    サーバの BOT（山の残り枚数を使わない）
+    table:NAME   方針表（bot_policy.py の難易度名かファイルパス）。親のときはサーバの BOT
+    threshold:N  合計 N 未満なら引く、ベットは固定 5
+    stay         引かない、ベットは固定 5
+"""
+
+from __future__ import annotations
+import argparse
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from bot_policy import load_policy
+from engine import (
+    INITIAL_HAND_SIZE, GameState, Player, Room, TARGET,
+    _bot_bet, _bot_choose_bet, _bot_draws, _bot_should_draw, _draw_tile_for_player, _prepare_betting_phase,
+    _next_wall_seed, _start_next_round_locked, _start_playing_phase, _stay_for_player, drain_effects, hand_total,
+    is_special_role,
+)
+
+DEFAULT_CHUNK = 20_000
+RESET_WALL_AT = 30   # BOT の親と同じ: 山が 30 枚以下ならリセット
+
+
+class Policy(NamedTuple):
+    should_draw: Callable[[Room, Player], bool]
+    choose_bet: Callable[[Room, Player], int]
+
+
+def _fixed_bet(room: Room, p: Player) -> int:
+    return 5
+
+
+def make_policy(spec: str) -> Policy:
+    name, _, arg = spec.partition(":")
+    if name == "bot":
+        return Policy(
+            lambda room, p: _bot_should_draw(p, room.state.dora_weights, room.state.wall.counts),
+            lambda room, p: _bot_choose_bet(p, room.state.dora_weights, room.state.wall.counts),
+        )
+    if name == "bot-blind":
+        return Policy(
+            lambda room, p: _bot_should_draw(p, room.state.dora_weights),
+            lambda room, p: _bot_choose_bet(p, room.state.dora_weights),
+        )
+    if name == "table":
+        table = load_policy(arg or "normal")
+        return Policy(lambda room, p: _bot_draws(room, p, table), lambda room, p: _bot_bet(room, p, table))
+    if name == "threshold":
+        limit = float(arg or 8)
+        return Policy(lambda room, p: not is_special_role(p.hand) and hand_total(p.hand) < limit, _fixed_bet)
+    if name == "stay":
+        return Policy(lambda room, p: False, _fixed_bet)
+    raise ValueError(f"unknown policy: {spec}")
+
+
+@dataclass
+class SeatStats:
+    rounds: int = 0
+    delta: int = 0
+    delta_sq: int = 0
+    dealer_rounds: int = 0
+    dealer_delta: int = 0
+    child_rounds: int = 0
+    child_delta: int = 0
+    busts: int = 0
+    specials: int = 0
+
+    def merge(self, other: "SeatStats") -> None:
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+    @property
+    def mean(self) -> float:
+        return self.delta / self.rounds if self.rounds else 0.0
+
+    @property
+    def stdev(self) -> float:
+        if self.rounds < 2:
+            return 0.0
+        var = (self.delta_sq - self.delta * self.delta / self.rounds) / (self.rounds - 1)
+        return math.sqrt(max(var, 0.0))
+
+
+@dataclass
+class SimulationResult:
+    policies: List[str]
+    rounds: int = 0
+    void_rounds: int = 0
+    wall_resets: int = 0
+    seats: List[SeatStats] = field(default_factory=list)
+
+    def merge(self, other: "SimulationResult") -> None:
+        self.rounds += other.rounds
+        self.void_rounds += other.void_rounds
+        self.wall_resets += other.wall_resets
+        for mine, theirs in zip(self.seats, other.seats):
+            mine.merge(theirs)
+
+    def by_policy(self) -> Dict[str, SeatStats]:
+        out: Dict[str, SeatStats] = {}
+        for spec, s in zip(self.policies, self.seats):
+            out.setdefault(spec, SeatStats()).merge(s)
+        return out
+
+
+def _new_room(n_players: int) -> Room:
+    room = Room(room_id="SIM")
+    for seat in range(n_players):
+        sid = f"SIM-{seat}"
+        room.players_by_sid[sid] = Player(sid=sid, name=f"SIM{seat}", seat_index=seat, is_bot=True)
+        room.seat_to_sid[seat] = sid
+    room.state = GameState(phase="reset_prompt", dealer_seat=0)
+    return room
+
+
+def _play_round(room: Room, policies: List[Policy], result: SimulationResult) -> None:
+    st = room.state
+    required = INITIAL_HAND_SIZE * len(room.players())
+    if len(st.wall) < required or len(st.wall) <= RESET_WALL_AT:
+        st.shuffle_wall(_next_wall_seed(room))
+        result.wall_resets += 1
+    _prepare_betting_phase(room)
+
+    for p in room.players():
+        if p.seat_index != st.dealer_seat:
+            p.bet_points = policies[p.seat_index].choose_bet(room, p)
+    _start_playing_phase(room)
+
+    while st.phase == "playing":
+        p = room.players_by_sid[room.seat_to_sid[st.turn_seat]]
+        if policies[p.seat_index].should_draw(room, p):
+            _draw_tile_for_player(room, p)
+        else:
+            _stay_for_player(room, p)
+
+    results = st.results
+    dealer_seat = results["dealer_seat"]
+    result.rounds += 1
+    if results.get("reason") == "wall_empty_void":
+        result.void_rounds += 1
+    for p in room.players():
+        s = result.seats[p.seat_index]
+        if p.seat_index == dealer_seat:
+            delta = results["dealer_delta"]
+            s.dealer_rounds += 1
+            s.dealer_delta += delta
+        else:
+            delta = results["pairs"][p.seat_index]["delta"]
+            s.child_rounds += 1
+            s.child_delta += delta
+        s.rounds += 1
+        s.delta += delta
+        s.delta_sq += delta * delta
+        if hand_total(p.hand) > TARGET and not is_special_role(p.hand):
+            s.busts += 1
+        elif is_special_role(p.hand):
+            s.specials += 1
+
+    # 清算チャットや次ラウンドへの自動進行はサーバの仕事なので、副作用は読み捨てる
+    drain_effects(room)
+    _start_next_round_locked(room)
+
+
+def run_chunk(specs: List[str], rounds: int, seed: int) -> SimulationResult:
+    """1プロセス分。seed から作った RNG だけを使うので同じ引数なら同じ結果になる。"""
+    policies = [make_policy(s) for s in specs]
+    room = _new_room(len(specs))
+    room.rng = random.Random(seed)
+    result = SimulationResult(list(specs), seats=[SeatStats() for _ in specs])
+    for _ in range(rounds):
+        _play_round(room, policies, result)
+    return result
+
+
+def simulate(
+    specs: List[str],
+    rounds: int,
+    seed: int = 0,
+    jobs: Optional[int] = None,
+    chunk: int = DEFAULT_CHUNK,
+) -> SimulationResult:
+    if not 2 <= len(specs) <= 4:
+        raise ValueError("2-4 players required")
+    for s in specs:
+        make_policy(s)  # 不正な指定はワーカーに渡す前に弾く
+    sizes = [chunk] * (rounds // chunk) + ([rounds % chunk] if rounds % chunk else [])
+    total = SimulationResult(list(specs), seats=[SeatStats() for _ in specs])
+    if jobs == 1:
+        for i, n in enumerate(sizes):
+            total.merge(run_chunk(specs, n, seed + i))
+        return total
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_chunk, specs, n, seed + i) for i, n in enumerate(sizes)]
+        for fut in futures:
+            total.merge(fut.result())
+    return total
+
+
+def format_result(result: SimulationResult, elapsed: Optional[float] = None) -> str:
+    lines = [f"rounds={result.rounds} void={result.void_rounds} wall_resets={result.wall_resets}"]
+    if elapsed:
+        lines[0] += f" elapsed={elapsed:.1f}s ({result.rounds / elapsed:,.0f} rounds/s)"
+    header = f"{'':>14} {'rounds':>9} {'mean':>8} {'stdev':>8} {'as dealer':>10} {'as child':>10} {'bust%':>6} {'role%':>6}"
+
+    def row(label: str, s: SeatStats) -> str:
+        dealer = s.dealer_delta / s.dealer_rounds if s.dealer_rounds else 0.0
+        child = s.child_delta / s.child_rounds if s.child_rounds else 0.0
+        bust = 100 * s.busts / s.rounds if s.rounds else 0.0
+        special = 100 * s.specials / s.rounds if s.rounds else 0.0
+        return f"{label:>14} {s.rounds:>9} {s.mean:>8.3f} {s.stdev:>8.2f} {dealer:>10.3f} {child:>10.3f} {bust:>6.1f} {special:>6.1f}"
+
+    lines.append("per seat:")
+    lines.append(header)
+    for i, (spec, s) in enumerate(zip(result.policies, result.seats)):
+        lines.append(row(f"{i}:{spec}", s))
+    lines.append("per policy:")
+    lines.append(header)
+    for spec, s in result.by_policy().items():
+        lines.append(row(spec, s))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description="Headless Monte Carlo simulation of toppan rounds")
+    ap.add_argument("--rounds", type=int, default=100_000)
+    ap.add_argument("--policies", default="bot,bot,bot,bot", help="comma separated, one per seat (2-4)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--jobs", type=int, default=None, help="worker processes (default: CPU count)")
+    ap.add_argument("--chunk", type=int, default=DEFAULT_CHUNK, help="rounds per worker task")
+    args = ap.parse_args(argv)
+    specs = [s.strip() for s in args.policies.split(",") if s.strip()]
+    t0 = time.perf_counter()
+    result = simulate(specs, args.rounds, seed=args.seed, jobs=args.jobs, chunk=args.chunk)
+    print(format_result(result, time.perf_counter() - t0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+ルームのスナップショット
+------------------------
+再起動・デプロイでも卓が消えないように、ルーム（Room / Player / GameState。山とドラも）をファイルに保存して
+起動時に読み戻す。TOPPAN_SNAPSHOT_PATH を設定したときだけ（server.py。既定は無効）。
+
+- capture: ルームを tuple / bytes などの値だけに写す。ルームごとに await を挟まず写すので、各ルームは一貫した状態になる
+  （ルームどうしは独立なので、server.py は CAPTURE_CHUNK 件ごとにイベントループへ戻しながら写す）。
+  手牌・山のバッファ・席など後から書き換わるものはここでコピーし、清算結果・カットイン・チャットのように
+  丸ごと差し替わるだけのものは参照のまま持つ
+- encode / write_atomic: pickle（クラスは入れないのでコードが変わっても読める）して、
+  一時ファイル → fsync → os.replace で書く。どちらもスレッドで動かす（server.py が asyncio.to_thread で呼ぶ）
+- restore_room: 保存した値から Room を作り直す。知らないフィールドは捨て、無いフィールドは既定値のまま
+
+乱数（Room.rng）と送信まわり（lock / broadcast / outbox）は保存しない。読み戻した後に作り直される。
+人間の席には再接続の token（sessions.py）を (token, room_id, sid) で一緒に保存する。読み戻した席に戻れるのは
+その token を持った resume だけ（名前が同じというだけでは戻れない）。
+bench/snapshot.py で 10k ルームの保存・復元の時間を測れる。
+"""
+
+from __future__ import annotations
+import contextlib
+import dataclasses
+import gc
+import operator
+import os
+import pickle
+import struct
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from chatlog import ChatHistory
+from engine import GameState, Player, Room
+from tiles import Wall
+
+SNAPSHOT_MAGIC = b"TPSN"
+SNAPSHOT_VERSION = 1
+CAPTURE_CHUNK = 500   # 1回にループを止めて写すルーム数
+_HEADER = struct.Struct("!4sB")
+
+# 保存する属性。ファイルにも名前を書いておき、読むときに今のフィールドと違えば名前で合わせる
+_PLAYER_FIELDS = tuple(f.name for f in dataclasses.fields(Player) if f.name not in ("hand", "discards"))
+_STATE_FIELDS = tuple(f.name for f in dataclasses.fields(GameState) if f.name != "wall")
+_ROOM_FIELDS = ("room_id", "host_sid", "is_free_match", "settlement_seq", "state_version", "event_seq")
+_SCHEMA = {"player": _PLAYER_FIELDS, "state": _STATE_FIELDS, "room": _ROOM_FIELDS}
+# 保存時と同じフィールドなら位置引数で作る（速い）。そのときに差し込む位置
+_WALL_AT = [f.name for f in dataclasses.fields(GameState)].index("wall")
+_HAND_AT = [f.name for f in dataclasses.fields(Player)].index("hand")   # hand, discards の順
+
+_player_attrs = operator.attrgetter(*_PLAYER_FIELDS)
+_state_attrs = operator.attrgetter(*_STATE_FIELDS)
+_room_attrs = operator.attrgetter(*_ROOM_FIELDS)
+
+
+def capture_room(room: Room) -> tuple:
+    """ルームを保存用の値に写す（イベントループ上で呼ぶ）
+
+    dora_displays / dora_weights / results / cutin は書き換えずに丸ごと差し替わるので参照のまま持つ。
+    """
+    st = room.state
+    w = st.wall
+    chat = room.chat_log
+    return (
+        _room_attrs(room),
+        tuple(room.seat_to_sid.items()),
+        [_player_attrs(p) + (bytes(p.hand), bytes(p.discards)) for p in room.players_by_sid.values()],
+        _state_attrs(st),
+        (w.buf.tobytes(), w.start, w.cursor, w.seed, list(w.counts)),
+        None if chat is None else (chat.seq, tuple(chat.messages)),
+    )
+
+
+def _by_name(saved: tuple, current: tuple, values: tuple) -> Dict[str, Any]:
+    """保存時と今でフィールドが違うとき: 今もあるフィールドだけを名前で渡す"""
+    return {k: v for k, v in zip(saved, values) if k in current}
+
+
+def restore_room(data: tuple, schema: Optional[Dict[str, tuple]] = None) -> Room:
+    """capture_room の値から Room を作り直す（lock は呼ぶ側が入れる）"""
+    schema = schema or _SCHEMA
+    room_values, seats, players, state_values, wall, chat = data
+    wall = Wall.restore(*wall)
+    if schema["state"] == _STATE_FIELDS:
+        st = GameState(*state_values[:_WALL_AT], wall, *state_values[_WALL_AT:])
+    else:
+        st = GameState(wall=wall, **_by_name(schema["state"], _STATE_FIELDS, state_values))
+    if schema["room"] == _ROOM_FIELDS:
+        room = Room(**dict(zip(_ROOM_FIELDS, room_values)), state=st)
+    else:
+        room = Room(**_by_name(schema["room"], _ROOM_FIELDS, room_values), state=st)
+    room.seat_to_sid = dict(seats)
+    same_player = schema["player"] == _PLAYER_FIELDS
+    for values in players:
+        *attrs, hand, discards = values
+        if same_player:
+            p = Player(*attrs[:_HAND_AT], hand, list(discards), *attrs[_HAND_AT:])
+        else:
+            p = Player(hand=hand, discards=list(discards), **_by_name(schema["player"], _PLAYER_FIELDS, attrs))
+        room.players_by_sid[p.sid] = p
+    if chat is not None:
+        room.chat_log = ChatHistory()
+        room.chat_log.seq = chat[0]
+        room.chat_log.messages.extend(chat[1])
+    return room
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """小さな tuple・オブジェクトを大量に作る間は GC を止める（途中で全世代の GC が走ると数倍かかる）"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def capture(rooms: Iterable[Room]) -> List[tuple]:
+    with _gc_paused():
+        return [capture_room(room) for room in rooms]
+
+
+Sessions = List[Tuple[str, str, str]]   # (token, room_id, sid)
+
+
+def encode(captured: List[tuple], sessions: Sequence[Tuple[str, str, str]] = ()) -> bytes:
+    body = pickle.dumps((_SCHEMA, captured, list(sessions)), protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + body
+
+
+def decode(blob: bytes) -> Tuple[List[Room], Sessions]:
+    """ルームと再接続の token。token を持たない古いファイルなら token は空"""
+    magic, version = _HEADER.unpack_from(blob)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"not a room snapshot (magic={magic!r}, version={version})")
+    with _gc_paused():
+        schema, captured, *rest = pickle.loads(blob[_HEADER.size:])
+        return [restore_room(d, schema) for d in captured], (rest[0] if rest else [])
+
+
+def write_atomic(path: str, blob: bytes) -> None:
+    """一時ファイルに書いて fsync してから置き換える（書きかけのファイルが残らない）"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def save(path: str, captured: List[tuple], sessions: Sequence[Tuple[str, str, str]] = ()) -> int:
+    """エンコードして書く。書いたバイト数を返す（スレッドで呼ぶ）"""
+    blob = encode(captured, sessions)
+    write_atomic(path, blob)
+    return len(blob)
+
+
+def load(path: str) -> Optional[Tuple[List[Room], Sessions]]:
+    """保存したルームと token を読む。ファイルが無ければ None（スレッドで呼ぶ）"""
+    try:
+        with open(path, "rb") as f:
+            blob = f.read()
+    except FileNotFoundError:
+        return None
+    return decode(blob)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+state の差分同期
+----------------
+ルームの state にバージョンを振り、各クライアントには「最後に ack されたバージョン」からの
+差分（パッチ）だけを送る。全量（スナップショット）を送るのは、初回（参加・再接続）、
+クライアントが基点を持っていないとき（state_resync）、差分の方が大きいときだけ。
+
+パッチは操作のリスト:
+
+    [path, value]   path の位置に value を置く（path はキー/添字の配列）
+    [path]          path の位置のキーを消す
+
+長さの同じリストは要素ごとに比べ、長さが変わったリストは丸ごと置き換える。
+static/client.js の applyStatePatch が同じ規則で適用する。
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+MAX_PATCH_OPS = 24       # これより多く変わったらスナップショットを送る
+MAX_UNACKED = 16         # ack 待ちで覚えておく送信済みバージョンの数（client.js の履歴と同じ）
+
+Op = List[Any]
+
+
+def diff_state(old: Any, new: Any, path: Tuple[Any, ...] = (), ops: Optional[List[Op]] = None) -> List[Op]:
+    """old -> new のパッチ。同一オブジェクト（共有している行など）は中を見ない。"""
+    if ops is None:
+        ops = []
+    if old is new:
+        return ops
+    if type(old) is dict and type(new) is dict:
+        # JSON ではキーが文字列になる（results.pairs の席番号など）ので、パスも文字列にそろえる
+        for k, v in new.items():
+            key = k if type(k) is str else str(k)
+            if k in old:
+                diff_state(old[k], v, (*path, key), ops)
+            else:
+                ops.append([[*path, key], v])
+        for k in old:
+            if k not in new:
+                ops.append([[*path, k if type(k) is str else str(k)]])
+    elif type(old) is list and type(new) is list and len(old) == len(new):
+        sub: List[Op] = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            diff_state(a, b, (*path, i), sub)
+        # 要素の大半が置き換わった値のリスト（山リセット後のドラ表示など）は丸ごと送る方が小さい
+        if len(sub) > len(new) // 2 and all(len(op[0]) == len(path) + 1 for op in sub):
+            ops.append([list(path), new])
+        else:
+            ops.extend(sub)
+    elif type(old) is not type(new) or old != new:
+        ops.append([list(path), new])
+    return ops
+
+
+def apply_patch(state: Any, ops: List[Op]) -> Any:
+    """パッチを当てる（state を書き換える）。client.js の applyStatePatch と同じ。
+
+    state は JSON から読んだもの（dict のキーは文字列）を想定する。
+    """
+    for op in ops:
+        path = op[0]
+        if not path:
+            state = op[1]
+            continue
+        obj = state
+        for key in path[:-1]:
+            obj = obj[key]
+        if len(op) > 1:
+            obj[path[-1]] = op[1]
+        else:
+            del obj[path[-1]]
+    return state
+
+
+class ViewerSync:
+    """1クライアント分の同期状態: ack 済みの (バージョン, state) と ack 待ちの送信済み state
+
+    variant は共通の state への閲覧者ごとの重ね方（you_seat、親本人の伏せ札）を表す値。
+    重ね方が変わっていない閲覧者のパッチは共通部分の差分だけになるので、基点のバージョンが
+    同じなら中身も同じ。server.py はそれを1回だけエンコードして使い回す（share_key）。
+    """
+
+    __slots__ = ("acked_version", "acked", "acked_variant", "sent")
+
+    def __init__(self) -> None:
+        self.acked_version: Optional[int] = None
+        self.acked: Optional[dict] = None
+        self.acked_variant: Any = None
+        self.sent: "OrderedDict[int, Tuple[dict, Any]]" = OrderedDict()
+
+    def share_key(self, variant: Any = None) -> Optional[int]:
+        """重ね方が ack 済みのときと変わっていなければ基点のバージョン、変わっていれば None"""
+        if self.acked is None or self.acked_variant != variant:
+            return None
+        return self.acked_version
+
+    def remember(self, version: int, payload: dict, variant: Any = None) -> None:
+        """送った state を ack 待ちとして覚える"""
+        self.sent[version] = (payload, variant)
+        while len(self.sent) > MAX_UNACKED:
+            self.sent.popitem(last=False)
+
+    def packet(self, version: int, payload: dict, variant: Any = None) -> Tuple[str, dict]:
+        """送るイベント名とデータ。("state", スナップショット) か ("state_patch", パッチ)"""
+        self.remember(version, payload, variant)
+        if self.acked is not None:
+            ops = diff_state(self.acked, payload)
+            if len(ops) <= MAX_PATCH_OPS:
+                return "state_patch", {"base": self.acked_version, "version": version, "ops": ops}
+        return "state", {**payload, "version": version}
+
+    def ack(self, version: int) -> None:
+        entry = self.sent.get(version)
+        if entry is None:
+            return
+        self.acked_version = version
+        self.acked, self.acked_variant = entry
+        for v in list(self.sent):
+            if v > version:
+                break
+            del self.sent[v]
@@ -23,6 +23,31 @@
   let lastPhaseForSe = null;
   let mySeat = null;
   let seats = ["東", "南", "西", "北"];
+  let lastChatId = null;  // 再接続（resume）で足りない分だけ送ってもらう
+
+  // versioned state sync（server の state_sync.py と対）
+  // version -> state。サーバの ack 待ちの間に届くパッチの基点になるので少しだけ覚えておく
+  const STATE_HISTORY = new Map();
+  const STATE_HISTORY_MAX = 16;
+  function rememberState(version, state) {
+    STATE_HISTORY.set(version, state);
+    while (STATE_HISTORY.size > STATE_HISTORY_MAX) {
+      STATE_HISTORY.delete(STATE_HISTORY.keys().next().value);
+    }
+  }
+  // ops: [path, value] は代入、[path] は削除（path はキー/添字の配列）
+  function applyStatePatch(state, ops) {
+    for (const op of ops) {
+      const path = op[0];
+      if (!path.length) { state = op[1]; continue; }
+      let obj = state;
+      for (let i = 0; i < path.length - 1; i++) obj = obj[path[i]];
+      const key = path[path.length - 1];
+      if (op.length > 1) obj[key] = op[1];
+      else delete obj[key];
+    }
+    return state;
+  }
   let inFreeMatch = false;
 
   // UI cache
@@ -315,13 +340,92 @@
     }
 
     // Init socket
-    socket = io("/", { path: "/socket.io", transports: ["websocket", "polling"] });
-    socket.on("connect", () => console.log("[socket] connected", socket.id));
+    // サーバの直列化方式（wire.py）。msgpack ならバイナリ用のパーサを使う
+    const socketOpts = { path: "/socket.io", transports: ["websocket", "polling"] };
+    try {
+      const wire = await (await fetch("/api/wire")).json();
+      if (wire?.serializer === "msgpack") {
+        const { Encoder, Decoder } = await import("./msgpack_parser.js");
+        socketOpts.parser = { Encoder, Decoder };
+      }
+    } catch (e) {
+      console.warn("[socket] failed to read wire config", e);
+    }
+    socket = io("/", socketOpts);
+    socket.on("connect", () => {
+      console.log("[socket] connected", socket.id);
+      resumeSavedRoom();
+    });
+
+    // 今いるルーム（サーバの再起動・ページの再読み込みの後は token の resume で同じ席に戻る。sessions.py / snapshot.py）
+    const ROOM_KEY = "toppan.room";
+    function savedRoom() {
+      try {
+        return JSON.parse(sessionStorage.getItem(ROOM_KEY) || "null");
+      } catch (e) {
+        return null;
+      }
+    }
+    function rememberRoom(room, name, mode, token) {
+      sessionStorage.setItem(ROOM_KEY, JSON.stringify({ room, name, mode, token }));
+    }
+    function forgetRoom() {
+      sessionStorage.removeItem(ROOM_KEY);
+    }
+    // 切断から戻る: token で同じ席へ（sessions.py）。手元の state からのパッチ1回で追いつく。
+    // 席の預かり期限が切れていたら（サーバの再起動も）名前で参加し直す
+    function resumeSavedRoom() {
+      const saved = savedRoom();
+      if (!saved?.token) {
+        STATE_HISTORY.clear();  // 新しい接続ではサーバもスナップショットから送り直す
+        rejoinSavedRoom();
+        return;
+      }
+      const version = STATE_HISTORY.size ? Math.max(...STATE_HISTORY.keys()) : null;
+      socket.emit("resume", { token: saved.token, version, chat_id: lastChatId }, (ack) => {
+        if (!ack?.ok) {
+          rememberRoom(saved.room, saved.name, saved.mode);
+          STATE_HISTORY.clear();
+          rejoinSavedRoom();
+          return;
+        }
+        UI.tableEl?.classList.remove("hidden");
+        UI.btnAddBot?.classList.remove("hidden");
+        setLobbyMode(saved.mode || "normal");
+      });
+    }
+    function rejoinSavedRoom() {
+      const saved = savedRoom();
+      if (!saved?.room || !UI.btnJoin) return;
+      if (UI.roomId) UI.roomId.value = saved.room;
+      if (UI.playerName && saved.name) UI.playerName.value = saved.name;
+      UI.btnJoin.onclick();
+    }
     socket.on("connect_error", (e) => console.error("[socket] connect_error", e));
     socket.on("error", (e) => console.error("[socket] error", e));
 
+    // State sync: スナップショット（state）かパッチ（state_patch）を受け取り、適用したバージョンを ack する
+    socket.on("state", (snapshot) => acceptState(snapshot.version, snapshot));
+    socket.on("state_patch", (patch) => {
+      const base = STATE_HISTORY.get(patch.base);
+      if (!base) {
+        // 基点を持っていない（取りこぼし・履歴切れ）→ スナップショットを要求
+        socket.emit("state_resync", {});
+        return;
+      }
+      acceptState(patch.version, applyStatePatch(structuredClone(base), patch.ops));
+    });
+
+    function acceptState(version, state) {
+      if (typeof version === "number") {
+        rememberState(version, state);
+        socket.emit("state_ack", { version });
+      }
+      handleState(state);
+    }
+
     // State flow: render now if UI ready, otherwise queue
-    socket.on("state", (state) => {
+    function handleState(state) {
       lastState = state;
       seats = state.seats || seats;
       const doraSig = JSON.stringify(state.dora_displays || []);
@@ -381,13 +485,23 @@
       lastWallCountForSe = (typeof state.wall_count === "number") ? state.wall_count : lastWallCountForSe;
       lastDoraSigForSe = doraSig;
       lastPhaseForSe = state.phase;
-    });
+    }
 
-    socket.on("chat", (p) => {
+    function formatChat(p) {
       const who = p.name || (p.sid ? p.sid.slice(0, 4) : "");
       const wind = p.seat_label || (lastState?.seats?.[p.seat] ?? "");
       const prefix = who ? `${who}${wind ? `（${wind}）` : ""}: ` : "";
-      appendChat(`${prefix}${p.message}`);
+      return `${prefix}${p.message}`;
+    }
+    function receiveChat(p) {
+      if (typeof p.id === "number") lastChatId = p.id;
+      appendChat(formatChat(p));
+    }
+    socket.on("chat", receiveChat);
+    // 参加時にサーバが直近のチャットをまとめて送ってくる（after 付きは再接続中に取りこぼした分だけ）
+    socket.on("chat_history", ({ messages, after }) => {
+      if (after == null && UI.chatLog) UI.chatLog.innerHTML = "";
+      (messages || []).forEach(receiveChat);
     });
 
     // Wire buttons
@@ -396,6 +510,7 @@
       socket.emit("create_room", { name }, (ack) => {
         console.log("[create_room ack]", ack);
         if (!ack?.ok) return info(ack?.error || "エラー");
+        rememberRoom(ack.room_id, name, "normal", ack.token);
         UI.tableEl?.classList.remove("hidden");
         UI.btnAddBot?.classList.remove("hidden");
         if (UI.roomId) UI.roomId.value = ack.room_id;
@@ -407,6 +522,7 @@
       const name = (UI.playerName?.value || "Player");
       socket.emit("free_match", { name }, (ack) => {
         if (!ack?.ok) return info(ack?.error || "フリーマッチエラー");
+        rememberRoom(ack.room_id, name, "free", ack.token);
         UI.tableEl?.classList.remove("hidden");
         UI.btnAddBot?.classList.remove("hidden");
         if (UI.roomId) UI.roomId.value = "";
@@ -421,36 +537,67 @@
       if (!rid) return info("ルームIDを入力してください");
       socket.emit("join_room", { room_id: rid, name }, (ack) => {
         console.log("[join_room ack]", ack);
-        if (!ack?.ok) return info(ack?.error || "エラー");
+        if (ack?.redirect) {
+          // ルームは別のワーカーにある（cluster.py）: そちらで開き直して参加する
+          location.href = `${ack.redirect}/?room=${encodeURIComponent(rid)}&name=${encodeURIComponent(name)}`;
+          return;
+        }
+        const saved = savedRoom();
+        if (!ack?.ok) {
+          if (saved?.room === rid) forgetRoom();  // 参加し直せなかった（ルームが無い・満席）
+          return info(ack?.error || "エラー");
+        }
+        const mode = saved?.room === rid ? saved.mode || "normal" : "normal";
+        rememberRoom(rid, name, mode, ack.token);
         UI.tableEl?.classList.remove("hidden");
         UI.btnAddBot?.classList.remove("hidden");
-        setLobbyMode("normal");
+        setLobbyMode(mode);
         info(`ルーム参加: ${rid}`);
       });
     };
 
+    // join_room の redirect で移ってきた: 接続したらそのまま参加する（connect で rejoinSavedRoom）
+    const joinParams = new URLSearchParams(location.search);
+    if (joinParams.get("room")) {
+      rememberRoom(joinParams.get("room"), joinParams.get("name") || "Player", "normal");
+      history.replaceState(null, "", location.pathname);
+      if (socket.connected) rejoinSavedRoom();
+    }
+
     if (UI.btnAddBot) UI.btnAddBot.onclick = () => {
       socket.emit("add_bot", { name: "BOT" }, (ack) => {
         if (!ack?.ok) info(ack?.error || "BOT追加エラー");
       });
     };
 
+    function backToLobby(message) {
+      forgetRoom();
+      UI.tableEl?.classList.add("hidden");
+      UI.btnAddBot?.classList.add("hidden");
+      if (UI.roomId) UI.roomId.value = "";
+      mySeat = null;
+      lastState = null;
+      lastChatId = null;
+      STATE_HISTORY.clear();
+      lastWallCountForSe = null;
+      lastDoraSigForSe = null;
+      lastPhaseForSe = null;
+      info(message);
+      setLobbyMode("normal");
+    }
+
     if (UI.btnLeave) UI.btnLeave.onclick = () => {
       socket.emit("leave_room", {}, (ack) => {
         if (!ack?.ok) return info(ack?.error || "退出エラー");
-        UI.tableEl?.classList.add("hidden");
-        UI.btnAddBot?.classList.add("hidden");
-        if (UI.roomId) UI.roomId.value = "";
-        mySeat = null;
-        lastState = null;
-        lastWallCountForSe = null;
-        lastDoraSigForSe = null;
-        lastPhaseForSe = null;
-        info("ルームから退出しました");
-        setLobbyMode("normal");
+        backToLobby("ルームから退出しました");
       });
     };
 
+    // 放置・ルーム数の上限でサーバがルームを閉じた
+    socket.on("room_closed", ({ reason }) => {
+      backToLobby(reason === "idle" ? "しばらく操作が無かったためルームを閉じました" : "ルームが閉じられました");
+    });
+
     if (UI.btnReady) UI.btnReady.onclick = () =>
       socket.emit("set_ready", { ready: true }, (ack) => {
         if (!ack?.ok) info(ack?.error || "準備エラー");
@@ -0,0 +1,194 @@
+// Socket.IO の msgpack パーサ（サーバの TOPPAN_SIO_SERIALIZER=msgpack 用）
+// python-socketio の MsgPackPacket と同じく、パケット {type, nsp, data, id} を丸ごと
+// 1つの msgpack マップにする。client.js が io(..., { parser: { Encoder, Decoder } }) で使う。
+
+const utf8Encoder = new TextEncoder();
+const utf8Decoder = new TextDecoder();
+
+// ---------------------- encode ----------------------
+
+class Writer {
+  constructor() {
+    this.buf = new Uint8Array(256);
+    this.view = new DataView(this.buf.buffer);
+    this.pos = 0;
+  }
+  reserve(n) {
+    if (this.pos + n <= this.buf.length) return;
+    let size = this.buf.length * 2;
+    while (size < this.pos + n) size *= 2;
+    const next = new Uint8Array(size);
+    next.set(this.buf.subarray(0, this.pos));
+    this.buf = next;
+    this.view = new DataView(next.buffer);
+  }
+  u8(v) { this.reserve(1); this.buf[this.pos++] = v; }
+  u16(v) { this.reserve(2); this.view.setUint16(this.pos, v); this.pos += 2; }
+  u32(v) { this.reserve(4); this.view.setUint32(this.pos, v); this.pos += 4; }
+  bytes(b) { this.reserve(b.length); this.buf.set(b, this.pos); this.pos += b.length; }
+}
+
+function writeHeader(w, len, fix, fixMax, c16, c32) {
+  if (fix !== null && len <= fixMax) w.u8(fix | len);
+  else if (len < 0x10000) { w.u8(c16); w.u16(len); }
+  else { w.u8(c32); w.u32(len); }
+}
+
+function writeValue(w, v) {
+  if (v === null || v === undefined) { w.u8(0xc0); return; }
+  if (v === false) { w.u8(0xc2); return; }
+  if (v === true) { w.u8(0xc3); return; }
+  if (typeof v === "number") {
+    if (Number.isInteger(v) && v >= -0x80000000 && v <= 0xffffffff) {
+      if (v >= 0 && v < 0x80) w.u8(v);
+      else if (v < 0 && v >= -0x20) w.u8(v & 0xff);
+      else if (v >= 0) { w.u8(0xce); w.u32(v); }
+      else { w.u8(0xd2); w.reserve(4); w.view.setInt32(w.pos, v); w.pos += 4; }
+    } else {
+      w.u8(0xcb); w.reserve(8); w.view.setFloat64(w.pos, v); w.pos += 8;
+    }
+    return;
+  }
+  if (typeof v === "string") {
+    const b = utf8Encoder.encode(v);
+    if (b.length < 0x20) w.u8(0xa0 | b.length);
+    else if (b.length < 0x100) { w.u8(0xd9); w.u8(b.length); }
+    else writeHeader(w, b.length, null, 0, 0xda, 0xdb);
+    w.bytes(b);
+    return;
+  }
+  if (v instanceof ArrayBuffer || ArrayBuffer.isView(v)) {
+    const b = v instanceof ArrayBuffer ? new Uint8Array(v) : new Uint8Array(v.buffer, v.byteOffset, v.byteLength);
+    if (b.length < 0x100) { w.u8(0xc4); w.u8(b.length); }
+    else writeHeader(w, b.length, null, 0, 0xc5, 0xc6);
+    w.bytes(b);
+    return;
+  }
+  if (Array.isArray(v)) {
+    writeHeader(w, v.length, 0x90, 0x0f, 0xdc, 0xdd);
+    for (const x of v) writeValue(w, x);
+    return;
+  }
+  // 値が undefined のキー（ack の無いパケットの id など）は送らない
+  const keys = Object.keys(v).filter((k) => v[k] !== undefined);
+  writeHeader(w, keys.length, 0x80, 0x0f, 0xde, 0xdf);
+  for (const k of keys) {
+    writeValue(w, k);
+    writeValue(w, v[k]);
+  }
+}
+
+export function encode(value) {
+  const w = new Writer();
+  writeValue(w, value);
+  return w.buf.slice(0, w.pos);
+}
+
+// ---------------------- decode ----------------------
+
+class Reader {
+  constructor(bytes) {
+    this.buf = bytes;
+    this.view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    this.pos = 0;
+  }
+  take(n) {
+    if (this.pos + n > this.buf.length) throw new Error("msgpack: truncated");
+    const p = this.pos;
+    this.pos += n;
+    return p;
+  }
+  str(n) { const p = this.take(n); return utf8Decoder.decode(this.buf.subarray(p, p + n)); }
+  bin(n) { const p = this.take(n); return this.buf.slice(p, p + n); }
+  array(n) { const a = new Array(n); for (let i = 0; i < n; i++) a[i] = this.value(); return a; }
+  map(n) {
+    const o = {};
+    for (let i = 0; i < n; i++) {
+      const k = this.value();
+      o[k] = this.value();
+    }
+    return o;
+  }
+  value() {
+    const c = this.buf[this.take(1)];
+    if (c < 0x80) return c;
+    if (c < 0x90) return this.map(c & 0x0f);
+    if (c < 0xa0) return this.array(c & 0x0f);
+    if (c < 0xc0) return this.str(c & 0x1f);
+    if (c >= 0xe0) return c - 0x100;
+    const v = this.view;
+    switch (c) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: return this.bin(v.getUint8(this.take(1)));
+      case 0xc5: return this.bin(v.getUint16(this.take(2)));
+      case 0xc6: return this.bin(v.getUint32(this.take(4)));
+      case 0xca: return v.getFloat32(this.take(4));
+      case 0xcb: return v.getFloat64(this.take(8));
+      case 0xcc: return v.getUint8(this.take(1));
+      case 0xcd: return v.getUint16(this.take(2));
+      case 0xce: return v.getUint32(this.take(4));
+      case 0xcf: return Number(v.getBigUint64(this.take(8)));
+      case 0xd0: return v.getInt8(this.take(1));
+      case 0xd1: return v.getInt16(this.take(2));
+      case 0xd2: return v.getInt32(this.take(4));
+      case 0xd3: return Number(v.getBigInt64(this.take(8)));
+      case 0xd9: return this.str(v.getUint8(this.take(1)));
+      case 0xda: return this.str(v.getUint16(this.take(2)));
+      case 0xdb: return this.str(v.getUint32(this.take(4)));
+      case 0xdc: return this.array(v.getUint16(this.take(2)));
+      case 0xdd: return this.array(v.getUint32(this.take(4)));
+      case 0xde: return this.map(v.getUint16(this.take(2)));
+      case 0xdf: return this.map(v.getUint32(this.take(4)));
+      default: throw new Error(`msgpack: unsupported type 0x${c.toString(16)}`);
+    }
+  }
+}
+
+export function decode(data) {
+  const bytes = data instanceof Uint8Array ? data : new Uint8Array(data);
+  const r = new Reader(bytes);
+  const value = r.value();
+  if (r.pos !== bytes.length) throw new Error("msgpack: trailing bytes");
+  return value;
+}
+
+// ---------------------- Socket.IO parser ----------------------
+
+export class Encoder {
+  encode(packet) {
+    return [encode(packet)];
+  }
+}
+
+export class Decoder {
+  constructor() {
+    this.listeners = {};
+  }
+  on(event, fn) {
+    (this.listeners[event] ||= []).push(fn);
+    return this;
+  }
+  off(event, fn) {
+    if (!event) this.listeners = {};
+    else if (!fn) delete this.listeners[event];
+    else this.listeners[event] = (this.listeners[event] || []).filter((f) => f !== fn);
+    return this;
+  }
+  emit(event, ...args) {
+    for (const fn of [...(this.listeners[event] || [])]) fn(...args);
+    return this;
+  }
+  add(data) {
+    if (typeof data === "string") throw new Error("msgpack: expected a binary frame");
+    const packet = decode(data);
+    if (!Number.isInteger(packet.type) || typeof packet.nsp !== "string") {
+      throw new Error("msgpack: invalid packet");
+    }
+    this.emit("decoded", packet);
+  }
+  destroy() {
+    this.listeners = {};
+  }
+}
@@ -1,13 +1,14 @@
-import asyncio
 import pytest
 
 from server import _end_round, Room, Player, GameState, role_breakdown
+from engine import RoundSettled, drain_effects
+from tiles import tiles_from_labels
 
 
 def _make_room(dealer_hand, child_hand, bet=5):
     room = Room(room_id="TEST")
-    dealer = Player(sid="d", name="Dealer", seat_index=0, hand=dealer_hand, points=300)
-    child = Player(sid="c", name="Child", seat_index=1, hand=child_hand, points=300, bet_points=bet)
+    dealer = Player(sid="d", name="Dealer", seat_index=0, hand=tiles_from_labels(dealer_hand), points=300)
+    child = Player(sid="c", name="Child", seat_index=1, hand=tiles_from_labels(child_hand), points=300, bet_points=bet)
     room.players_by_sid = {"d": dealer, "c": child}
     room.seat_to_sid = {0: "d", 1: "c", 2: None, 3: None}
     room.state = GameState(
@@ -22,9 +23,32 @@ def _make_room(dealer_hand, child_hand, bet=5):
     return room, dealer, child
 
 
+@pytest.fixture
+def fake_sio(monkeypatch):
+    """server.sio の送信とルームの出入りを差し替える。送ったものは返すリストに (event, 宛先, data) で溜まる
+
+    宛先は to（無ければ room）。閲覧者ごとの差分同期の状態も空から始める。
+    """
+    import server
+
+    sent = []
+
+    async def emit(event, data=None, to=None, room=None, **kw):
+        sent.append((event, to if to is not None else room, data))
+
+    async def noop(*a, **kw):
+        pass
+
+    monkeypatch.setattr(server.sio, "emit", emit)
+    for name in ("enter_room", "leave_room", "close_room"):
+        monkeypatch.setattr(server.sio, name, noop)
+    monkeypatch.setattr(server, "viewer_syncs", {})
+    return sent
+
+
 def _expected_delta(room, dealer, child, outcome):
-    dealer_role = role_breakdown(dealer.hand, room.state.dora_displays)["total"]
-    child_role = role_breakdown(child.hand, room.state.dora_displays)["total"]
+    dealer_role = role_breakdown(dealer.hand, room.state.dora_weights)["total"]
+    child_role = role_breakdown(child.hand, room.state.dora_weights)["total"]
     bet = 5#int(child.bet_points or 0)
     if outcome == "child_win":
         return bet * child_role
@@ -60,9 +84,935 @@ def _expected_delta(room, dealer, child, outcome):
         (["9萬"], ["9萬"], "dealer_win"),
     ],
 )
-def test_end_round_patterns(monkeypatch, dealer_hand, child_hand, outcome):
-    monkeypatch.setattr(asyncio, "create_task", lambda coro: None)
+def test_end_round_patterns(dealer_hand, child_hand, outcome):
     room, dealer, child = _make_room(dealer_hand, child_hand)
     _end_round(room)
     delta = room.state.results["pairs"][1]["delta"]
     assert delta == _expected_delta(room, dealer, child, outcome)
+    # 副作用は実行されず outbox に積まれるだけ
+    assert drain_effects(room) == [RoundSettled(room.state.results)]
+    assert room.outbox == []
+
+
+def test_hand_table_matches_evaluate_signature(tmp_path):
+    from hand_table import (
+        MAX_BASE_HALF, MAX_EAST, TSUMO_KINDS, HandTable, evaluate_signature, load_hand_table, write_table,
+    )
+
+    path = str(tmp_path / "cache" / "hand_table.bin")
+    write_table(path, max_len=8)
+    table = HandTable.open(path)
+    for kind in TSUMO_KINDS:
+        for length in range(9):
+            for n_east in range(MAX_EAST + 1):
+                for base_half in range(MAX_BASE_HALF + 1):
+                    sig = (kind, length, n_east, base_half)
+                    assert table.outcome(*sig) == evaluate_signature(*sig), sig
+    # 表の範囲外は直接計算する
+    for sig in [(0, 9, 0, 20), (0, 12, 1, 2), (0, 3, MAX_EAST + 1, 10), (0, 6, 0, MAX_BASE_HALF + 1)]:
+        assert table.outcome(*sig) == evaluate_signature(*sig)
+    # 書けない場所ならメモリ上の表を使う（ファイルは作らない）
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_bytes(b"")
+    mem = load_hand_table(str(blocker / "hand_table.bin"), max_len=8)
+    assert mem.outcome(10, 2, 1, 20) == table.outcome(10, 2, 1, 20) and blocker.read_bytes() == b""
+
+
+def test_hand_summary_follows_every_mutation():
+    from hand_table import Hand, hand_signature
+
+    e, w, m5, p5, p9 = tiles_from_labels(["東", "白", "5萬", "5筒", "9筒"])
+    hand = Hand([m5, p5])
+    steps = [
+        lambda h: h.__iadd__([e]),
+        lambda h: h.pop(),
+        lambda h: h.insert(0, e),
+        lambda h: h.remove(e),
+        lambda h: h.__setitem__(1, m5),
+        lambda h: h.__setitem__(slice(0, 2), [w, e, p9]),
+        lambda h: h.__delitem__(slice(1, None)),
+        lambda h: h.append(w),
+        lambda h: h.__imul__(2),
+        lambda h: h.pop(0),
+        lambda h: h.sort(),
+        lambda h: h.clear(),
+        lambda h: h.extend([p9, p9]),
+    ]
+    for step in steps:
+        step(hand)
+        assert hand.signature() == hand_signature(list(hand)), list(hand)
+    hand += [e]
+    assert type(hand) is Hand and hand.signature() == hand_signature(list(hand))
+
+
+def test_role_breakdown_dora_weights():
+    # 9萬→1、北→風牌、中→三元牌 を指す
+    st = GameState(dora_displays=tiles_from_labels(["9萬", "北", "中", "中"]))
+    hand = tiles_from_labels(["1筒", "東", "白"])
+    items = {i["name"]: i["points"] for i in role_breakdown(hand, st.dora_weights)["items"]}
+    assert items["ドラ"] == 4
+
+
+def test_batch_scoring_matches_scalar():
+    pytest.importorskip("numpy")
+    import random
+    from batch_scoring import encode_hands, score_hands
+    from server import hand_total
+    from tiles import compile_dora_weights
+
+    rng = random.Random(0)
+    hands = [[rng.choice([0, 8, 9, 27, 28, rng.randrange(34)]) for _ in range(rng.randint(0, 12))] for _ in range(2000)]
+    weights = compile_dora_weights([rng.randrange(34) for _ in range(34)])
+    scores = score_hands(*encode_hands(hands), weights)
+    assert scores.totals.tolist() == [hand_total(h) for h in hands]
+    assert scores.roles.tolist() == [role_breakdown(h, weights)["total"] for h in hands]
+
+
+def test_draw_odds_matches_enumeration():
+    from odds import draw_odds, fresh_counts
+    from server import is_special_role
+
+    dora = tiles_from_labels(["3萬", "東"])
+    weights = GameState(dora_displays=dora).dora_weights
+    for labels in (["東"], ["7萬"], ["3筒", "2索"], ["5萬", "5萬"]):
+        hand = tiles_from_labels(labels)
+        counts = fresh_counts(hand)
+        draws = [t for t, c in enumerate(counts) for _ in range(c)]
+        odds = draw_odds(hand, counts, weights)
+        busts = [t for t in draws if role_breakdown(hand + [t], weights)["total"] == 0]
+        specials = [t for t in draws if is_special_role(hand + [t])]
+        roles = sum(role_breakdown(hand + [t], weights)["total"] for t in draws)
+        assert odds.remaining == len(draws)
+        assert odds.bust == pytest.approx(len(busts) / len(draws))
+        assert odds.special == pytest.approx(len(specials) / len(draws))
+        assert odds.expected_role == pytest.approx(roles / len(draws))
+
+
+def test_wall_is_reproducible_from_seed():
+    from tiles import DORA_DISPLAY_COUNT, STANDARD_TILES, Wall
+
+    a, b = Wall.shuffled(42), Wall.shuffled(42)
+    assert a.dora() == b.dora() and list(a) == list(b)
+    assert sorted(a.dora() + list(a)) == list(STANDARD_TILES)
+    assert len(a) == len(STANDARD_TILES) - DORA_DISPLAY_COUNT
+    drawn = [a.pop() for _ in range(10)]
+    assert drawn == list(b)[::-1][:10]
+    assert sum(a.counts) == len(a) and all(a.counts[t] == list(a).count(t) for t in range(34))
+
+    # 作り直しは同じバッファを使い、seed だけで決まる
+    buf = a.buf
+    a.reshuffle(42)
+    assert a.buf is buf and list(a) == list(b) and a.counts == b.counts
+
+
+def test_simulation_is_reproducible_and_zero_sum():
+    from simulate import run_chunk
+
+    a = run_chunk(["bot", "threshold:7", "stay"], 300, seed=7)
+    b = run_chunk(["bot", "threshold:7", "stay"], 300, seed=7)
+    assert a == b
+    assert a.rounds == 300
+    assert sum(s.delta for s in a.seats) == 0
+
+
+def test_bot_policy_table_roundtrip(tmp_path):
+    from bot_policy import DIFFICULTIES, load_policy, write_policy
+    from hand_table import Hand
+    from odds import fresh_counts
+    from server import _bot_bet, _bot_draws
+
+    path = str(tmp_path / "hard.bin")
+    write_policy(path, "hard", DIFFICULTIES["hard"])
+    policy = load_policy(path)
+    assert policy.name == "hard"
+
+    counts = fresh_counts()
+    dealer = Hand(tiles_from_labels(["白", "5筒"]))
+    assert policy.should_draw(Hand(tiles_from_labels(["白"])), dealer, counts)
+    assert not policy.should_draw(Hand(tiles_from_labels(["東", "白"])), dealer, counts)   # 十半
+    assert not policy.should_draw(Hand(tiles_from_labels(["5萬", "4筒"])), dealer, counts)
+    assert policy.should_draw(Hand(tiles_from_labels(["9萬", "8筒"])), dealer, counts) is None  # バースト済み
+    assert all(0 <= policy.bet(t, counts) <= 10 for t in range(34))
+
+    room, _, child = _make_room(["白", "5筒"], ["7萬"])
+    # 子の BOT は親の伏せ札（白）を知らないので、山に戻した枚数で判断する
+    seen = list(room.state.wall.counts)
+    seen[dealer[0]] += 1
+    assert _bot_draws(room, child, policy) == policy.should_draw(child.hand, dealer, seen)
+    assert _bot_bet(room, child, policy) == min(policy.bet(child.hand[0], seen), 300)
+
+
+def test_missing_bot_policy_falls_back_to_heuristic(tmp_path, caplog):
+    import engine
+    from bot_policy import DIFFICULTIES, write_policy
+
+    # 生成していない表・壊れた表を指定しても起動は止めない
+    assert engine._load_bot_policy(str(tmp_path / "never-generated.bin")) is None
+    (tmp_path / "broken.bin").write_bytes(b"TP")
+    assert engine._load_bot_policy(str(tmp_path / "broken.bin")) is None
+    assert "using the heuristic bot" in caplog.text
+    # 書き出しは一時ファイル経由で、後に何も残さない
+    write_policy(str(tmp_path / "easy.bin"), "easy", DIFFICULTIES["easy"])
+    assert engine._load_bot_policy(str(tmp_path / "easy.bin")).name == "easy"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["broken.bin", "easy.bin"]
+
+
+def test_bot_odds_do_not_see_the_dealers_hidden_tile(monkeypatch):
+    import engine
+    from odds import NO_ODDS
+    from tiles import NUM_TILE_TYPES, Wall
+
+    seen = []
+    monkeypatch.setattr(engine, "BOT_POLICY", None)
+    monkeypatch.setattr(engine, "BOT_USE_ODDS", True)
+    monkeypatch.setattr(engine, "draw_odds", lambda hand, counts, **kw: seen.append(list(counts)) or NO_ODDS)
+    east, haku = tiles_from_labels(["東", "白"])
+    # 山には白が1枚も残っていない。伏せ札が白だと分かるのは本物の山を見たときだけ
+    for dealer_first, expect_haku in [(haku, 1), (east, 0)]:
+        room, dealer, child = _make_room(["白", "5筒"], ["7萬"])
+        dealer.hand[0] = dealer_first
+        room.state.wall = Wall([t for t in range(NUM_TILE_TYPES) if t != haku for _ in range(2)])
+        seen.clear()
+        engine._bot_draws(room, child)
+        engine._bot_bet(room, child)
+        assert seen and all(c[haku] == expect_haku for c in seen)
+        # 親本人と、伏せ札を公開した後は本当の残り
+        room.state.dealer_first_hidden = False
+        seen.clear()
+        engine._bot_draws(room, child)
+        assert all(c[haku] == 0 for c in seen)
+
+
+def test_bot_heuristic_ignores_odds_unless_enabled(monkeypatch):
+    import engine
+    from odds import NO_ODDS
+
+    # 次の1枚でほぼ確実にバーストし、役も必ず付く山だとする
+    monkeypatch.setattr(engine, "BOT_POLICY", None)
+    monkeypatch.setattr(engine, "draw_odds", lambda hand, counts, **kw: NO_ODDS._replace(bust=0.9, special=1.0))
+    room, dealer, child = _make_room(["白", "5筒"], ["3萬"])
+    monkeypatch.setattr(engine, "BOT_USE_ODDS", False)
+    draws, bet = engine._bot_draws(room, child), engine._bot_bet(room, child)
+    assert draws is True and bet < 5
+    monkeypatch.setattr(engine, "BOT_USE_ODDS", True)
+    assert engine._bot_draws(room, child) is False
+    assert engine._bot_bet(room, child) > bet
+
+
+def test_state_payload_overlays_dealer_view():
+    from server import HIDDEN_TILE, _viewer_payload, build_state_payload
+
+    room, dealer, child = _make_room(["7萬", "2筒"], ["東"])
+    public = build_state_payload(room)
+    to_dealer = _viewer_payload(room, public, "d")
+    to_child = _viewer_payload(room, public, "c")
+    assert (to_dealer["you_seat"], to_child["you_seat"]) == (0, 1)
+    assert to_dealer["players"][0]["hand"] == ["7萬", "2筒"]
+    assert to_child["players"][0]["hand"] == [HIDDEN_TILE, "2筒"]
+    # 子の見え方は共通部分そのもの。親本人の差分も子の行は共有する
+    assert to_child["players"] is public["players"]
+    assert to_dealer["players"][1] is public["players"][1]
+    assert public["you_seat"] is None
+
+
+def test_state_patches_replay_to_the_same_payload():
+    import json
+    from engine import _draw_tile_for_player, _prepare_betting_phase, _start_playing_phase, _stay_for_player
+    from server import _viewer_payload, build_state_payload
+    from state_sync import ViewerSync, apply_patch
+
+    room, dealer, child = _make_room(["7萬"], ["東"])
+    room.state.shuffle_wall(3)
+    wire = lambda x: json.loads(json.dumps(x))
+    sync, history = ViewerSync(), {}
+    events = []
+    for step in range(40):
+        st = room.state
+        if st.phase in ("playing",):
+            p = room.players_by_sid[room.seat_to_sid[st.turn_seat]]
+            (_draw_tile_for_player if len(p.hand) < 3 else _stay_for_player)(room, p)
+        else:
+            _prepare_betting_phase(room)
+            child.bet_points = 2
+            _start_playing_phase(room)
+        room.state_version += 1
+        payload = _viewer_payload(room, build_state_payload(room), "c")
+        event, data = sync.packet(room.state_version, payload)
+        data = wire(data)
+        events.append(event)
+        if event == "state":
+            state = data
+        else:
+            state = apply_patch(wire(history[data["base"]]), data["ops"])
+        history[room.state_version] = state
+        assert {k: v for k, v in state.items() if k != "version"} == wire(payload)
+        if step % 3 != 2:   # ack が遅れることもある
+            sync.ack(room.state_version)
+    assert events[0] == "state" and events.count("state_patch") > len(events) // 2
+
+
+def test_broadcast_shares_encoded_patches(fake_sio):
+    import asyncio
+    import json
+    import server
+    from engine import Player
+    from wire import OrjsonCodec
+
+    room, dealer, child = _make_room(["7萬", "2筒"], ["東"])
+    room.players_by_sid["c2"] = Player(sid="c2", name="Child2", seat_index=2, hand=tiles_from_labels(["白"]))
+    room.seat_to_sid[2] = "c2"
+    sent = fake_sio
+
+    async def broadcast():
+        await server.emit_room_state(room)
+        await server.flush_room_state(room)
+
+    asyncio.run(broadcast())
+    assert sorted(to for _, to, _ in sent) == ["c", "c2", "d"]   # 初回は各人にスナップショット
+    for sid in ("d", "c", "c2"):
+        server.viewer_syncs[sid].ack(room.state_version)
+
+    sent.clear()
+    room.state.turn_seat = 1
+    asyncio.run(broadcast())
+    # 子2人は同じパッチを1回の emit で、伏せ札を見ている親は別に
+    assert sorted((event, tuple(to) if isinstance(to, list) else (to,)) for event, to, _ in sent) == [
+        ("state_patch", ("c", "c2")), ("state_patch", ("d",))]
+
+    payload = server._viewer_payload(room, server.build_state_payload(room), "c")
+    assert json.loads(OrjsonCodec.dumps(payload)) == json.loads(json.dumps(payload))
+
+
+def test_resolve_serializer_prefers_orjson_and_falls_back(monkeypatch):
+    import wire
+
+    monkeypatch.delenv("TOPPAN_SIO_SERIALIZER", raising=False)
+    monkeypatch.setattr(wire, "orjson", object())
+    assert wire.resolve_serializer() == wire.resolve_serializer("auto") == "orjson"
+    monkeypatch.setenv("TOPPAN_SIO_SERIALIZER", "JSON")
+    assert wire.resolve_serializer() == "json"
+    # orjson が無ければ auto は標準 json、明示した orjson はエラー
+    monkeypatch.setattr(wire, "orjson", None)
+    assert wire.resolve_serializer("auto") == "json"
+    with pytest.raises(RuntimeError):
+        wire.resolve_serializer("orjson")
+    monkeypatch.setattr(wire.importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(RuntimeError):
+        wire.resolve_serializer("msgpack")
+    with pytest.raises(ValueError):
+        wire.resolve_serializer("pickle")
+    assert wire.server_options("json") == {}
+
+
+def test_room_state_coalesces_until_cutin_or_settlement(fake_sio):
+    import asyncio
+    import server
+    from engine import _draw_tile_for_player, _end_round
+
+    room, dealer, child = _make_room(["7萬"], ["東"])
+    room.state.set_wall(tiles_from_labels(["5萬", "白", "2筒", "7筒"]), [])   # 末尾から引く
+    sent = fake_sio
+
+    def versions():
+        return [data["version"] for _, _, data in sent]
+
+    async def play():
+        # 同じ周回の変更は1回の送信にまとまる
+        room.state.turn_seat = 1
+        await server.emit_room_state(room)
+        room.state.turn_seat = 0
+        await server.emit_room_state(room)
+        assert sent == []
+        await asyncio.sleep(0.01)
+        assert set(versions()) == {1}
+        # カットイン（7萬+7筒=ツモ）は次の変更で消える前にその場で送る
+        _draw_tile_for_player(room, dealer)
+        await server.emit_room_state(room)
+        assert sent[-1][2]["cutin"]["label"] and room.state_version == 2
+        room.state.cutin = None
+        await server.emit_room_state(room)
+        # 清算もその場で（待っていた変更も一緒に）
+        _end_round(room)
+        await server.emit_room_state(room)
+        assert room.state_version == 3 and sent[-1][2]["phase"] == "ended"
+        await asyncio.sleep(0.01)
+
+    asyncio.run(play())
+    assert versions().count(3) == 2   # 親と子に1回ずつ
+
+
+def test_settlement_is_sent_once_before_the_state_that_references_it(monkeypatch, fake_sio):
+    import asyncio
+    import server
+
+    room, dealer, child = _make_room(["7萬", "2筒"], ["東", "白"])
+    monkeypatch.setattr(server.manager, "rooms", {"TEST": room})
+    monkeypatch.setattr(server.manager, "sid_room", {"d": "TEST", "c": "TEST"})
+    monkeypatch.setattr(server, "emit_settlement_to_chat", lambda *a: asyncio.sleep(0))
+    monkeypatch.setattr(server, "auto_next_round", lambda *a: asyncio.sleep(0))
+    monkeypatch.setattr(server, "_kick_broke_players", lambda *a: asyncio.sleep(0))
+
+    async def settle():
+        server._end_round(room)
+        server._run_effects(room)
+        await server.emit_room_state(room)
+        await asyncio.sleep(0.01)
+        return await server.get_settlement("c", {"id": room.state.results["id"]})
+
+    refetched = asyncio.run(settle())
+    sent = [(event, data) for event, _, data in fake_sio]
+    events = [event for event, _ in sent]
+    assert events == ["settlement", "state", "state"]
+    settlement = sent[0][1]
+    assert settlement["id"] == 1 and [p["seat"] for p in settlement["pairs"]] == [1]
+    assert settlement["pairs"][0]["delta"] == room.state.results["pairs"][1]["delta"]
+    assert all("results" not in data and data["results_id"] == 1 for _, data in sent[1:])
+    assert refetched == {"ok": True, "settlement": settlement}
+
+
+def test_system_chat_is_batched_and_replayed(fake_sio):
+    import asyncio
+    import server
+    from chatlog import ChatHistory, ChatRateLimiter
+
+    limit = ChatRateLimiter(burst=2, rate=1.0)
+    assert [limit.allow(now=t) for t in (0.0, 0.0, 0.0, 0.5, 1.0)] == [True, True, False, False, True]
+
+    history = ChatHistory(size=3)
+    for i in range(5):
+        history.append({"message": str(i)})
+    assert [(m["id"], m["message"]) for m in history.recent()] == [(3, "2"), (4, "3"), (5, "4")]
+
+    room, dealer, child = _make_room(["7萬", "2筒"], ["東", "白"])
+    server._end_round(room)
+    asyncio.run(server.emit_settlement_to_chat(room, room.state.results))
+    asyncio.run(server.replay_chat(room, "late"))
+    (_, _, msg), (event, to, replay) = fake_sio
+    assert msg["system"] and msg["message"].startswith(("Dealer->Child", "Child->Dealer"))
+    assert "bet額: 5" in msg["message"]
+    assert (event, to, replay) == ("chat_history", "late", {"messages": [msg]})
+
+
+def test_room_manager_indexes_players_by_sid(monkeypatch):
+    import asyncio
+    import server
+    from engine import Player
+
+    manager = server.RoomManager()
+
+    async def scenario():
+        a = await manager.create_room()
+        b = await manager.create_room()
+        manager.add_player_locked(a, Player(sid="x", name="X", seat_index=0))
+        manager.add_player_locked(a, Player(sid="y", name="Y", seat_index=1))
+        manager.add_player_locked(a, Player(sid="bot", name="B", seat_index=2, is_bot=True))
+        manager.add_player_locked(b, Player(sid="z", name="Z", seat_index=0))
+        assert (manager.room_of("x"), manager.room_of("z"), manager.room_of("bot")) == (a, b, None)
+        assert await manager.remove_player("x") is a and a.host_sid in (None, "y", "bot")
+        assert manager.room_of("x") is None and "x" not in a.players_by_sid
+        assert await manager.remove_player("x") is None      # 2回目は何もしない
+        assert await manager.remove_player("z") is None      # 空になったルームは消える
+        assert b.room_id not in manager.rooms and manager.sid_room == {"y": a.room_id}
+
+    asyncio.run(scenario())
+
+
+def test_join_leaves_the_old_room_only_after_taking_a_seat(monkeypatch, fake_sio):
+    import asyncio
+    import server
+    from engine import Player
+
+    monkeypatch.setattr(server, "_schedule_bots", lambda room: None)
+    manager = server.RoomManager()
+    monkeypatch.setattr(server, "manager", manager)
+
+    async def scenario():
+        old = (await server.create_room("x", {"name": "X"}))["room_id"]
+        await server.join_room("y", {"room_id": old, "name": "Y"})
+        target = (await server.create_room("a", {"name": "A"}))["room_id"]
+        room = manager.get_room(target)
+        for sid in ("b", "c"):
+            await server.join_room(sid, {"room_id": target, "name": sid})
+
+        # 空きを見てから席を取るまでの間に埋まった: 前のルームの席はそのまま
+        await room.lock.acquire()
+        joining = asyncio.ensure_future(server.join_room("x", {"room_id": target, "name": "X"}))
+        await asyncio.sleep(0)
+        manager.add_player_locked(room, Player(sid="d", name="D", seat_index=3))
+        room.lock.release()
+        assert (await joining) == {"ok": False, "error": "Room is full"}
+        assert manager.room_of("x").room_id == old and manager.get_room(old).host_sid == "x"
+
+        # 空いていれば座ってから前のルームを抜ける
+        await manager.remove_player("d")
+        ack = await server.join_room("x", {"room_id": target, "name": "X"})
+        assert ack["ok"] and manager.room_of("x") is room and "x" in room.players_by_sid
+        assert "x" not in manager.get_room(old).players_by_sid and manager.get_room(old).host_sid == "y"
+
+    asyncio.run(scenario())
+
+
+def test_room_ids_are_a_permutation_of_the_counter():
+    from room_table import RoomIdAllocator, ShardedRooms
+
+    small = RoomIdAllocator(seed=5, length=2)
+    ids = [small.next_id() for _ in range(36 * 36)]
+    assert len(set(ids)) == len(ids) and all(len(i) == 2 for i in ids)
+    with pytest.raises(RuntimeError):
+        small.next_id()
+    assert [RoomIdAllocator(seed=9).next_id() for _ in range(2)] == [RoomIdAllocator(seed=9).next_id()] * 2
+
+    rooms = ShardedRooms(num_shards=4)
+    for i in ids[:100]:
+        rooms[i] = i
+    del rooms[ids[0]]
+    assert len(rooms) == 99 and ids[0] not in rooms and rooms.get(ids[1]) == ids[1]
+    assert sorted(rooms) == sorted(ids[1:100])
+
+
+def test_match_pool_fills_fullest_free_room_first():
+    import asyncio
+    import server
+
+    manager = server.RoomManager()
+
+    async def scenario():
+        # 同じ周回に来た5人は 4 + 1 に分かれる
+        rooms = await asyncio.gather(*(manager.pool.join(f"p{i}", "P") for i in range(5)))
+        full, rest = rooms[0], rooms[4]
+        assert all(r is full for r in rooms[:4]) and rest is not full
+        assert full.humans() == 4 and rest.humans() == 1
+        # 人間1人 + BOT の卓より、人間3人の卓（1人抜けた卓）が先に埋まる
+        assert await manager.remove_player("p0") is full and full.humans() == 3
+        assert await manager.pool.join("q0", "Q") is full
+        # 次は 1人 + BOT の卓。BOT がどいて人間が座る
+        assert any(p.is_bot for p in rest.players())
+        assert await manager.pool.join("q1", "Q") is rest
+        assert rest.humans() == 2 and manager.room_of("q1") is rest
+
+    asyncio.run(scenario())
+
+
+def test_match_pool_keeps_bots_that_are_mid_round():
+    import asyncio
+    import server
+    from engine import Player
+
+    manager = server.RoomManager()
+
+    async def scenario():
+        # 人間1人 + BOT 3体で満席、対局中（BOT が親や手番でベットもしている）
+        room = manager.new_room(is_free_match=True)
+        manager.add_player_locked(room, Player(sid="h", name="H", seat_index=0))
+        for seat in (1, 2, 3):
+            manager.add_player_locked(room, Player(sid=f"B{seat}", name="BOT", seat_index=seat,
+                                                   is_bot=True, bet_points=5, hand=[seat]))
+        room.state.phase = "playing"
+        room.state.dealer_seat = room.state.turn_seat = 2
+        manager.pool.offer(room)
+        before = dict(room.seat_to_sid)
+        other = await manager.pool.join("x", "X")
+        assert other is not room and room.seat_to_sid == before and room.players_by_sid["B2"].hand == [2]
+        # ラウンドが終われば BOT と入れ替わる
+        room.state.phase = "ended"
+        assert await manager.pool.join("y", "Y") is room
+        assert room.humans() == 2 and manager.room_of("y") is room
+
+    asyncio.run(scenario())
+
+
+def test_reaper_reclaims_idle_rooms_and_caps_room_count(monkeypatch, fake_sio):
+    import asyncio
+    import server
+    from engine import Player
+    from reaper import RoomLimitError, RoomReaper
+
+    manager = server.RoomManager()
+    monkeypatch.setattr(server, "manager", manager)
+    manager.reaper = RoomReaper(ttls={"waiting": 100.0}, empty_ttl=10.0, max_rooms=2, evict_min_idle=50.0)
+
+    async def scenario():
+        empty = manager.new_room()
+        played = manager.new_room()
+        manager.add_player_locked(played, Player(sid="h", name="H", seat_index=0))
+        manager.reaper.touch(empty.room_id, now=0.0)
+        manager.reaper.touch(played.room_id, now=0.0)
+        # 人間のいないルームは empty_ttl、いるルームはフェーズの TTL で消える
+        assert manager.reaper.expired(manager.rooms, now=20.0) == [empty]
+        for room in manager.reaper.expired(manager.rooms, now=20.0):
+            manager.close_room(room, "idle")
+        assert empty.room_id not in manager.rooms and played.room_id in manager.rooms
+        assert manager.reaper.stats.reclaimed_rooms == 1 and manager.reaper.stats.reclaimed_bytes > 0
+
+        # 上限: 人間のいるルームが最近動いていれば断り、人間のいないルームなら追い出す
+        manager.reaper.touch(played.room_id)
+        busy = manager.new_room()
+        manager.add_player_locked(busy, Player(sid="b", name="B", seat_index=0))
+        manager.touch(busy)
+        for room_id in list(manager.reaper.active):
+            manager.reaper.touch(room_id)
+        with pytest.raises(RoomLimitError):
+            manager.new_room()
+        manager.close_room(busy, "idle")
+        spare = manager.new_room()   # 2件目（上限ちょうど）
+        newest = manager.new_room()  # spare（人間なし）を追い出して作る
+        assert spare.room_id not in manager.rooms and newest.room_id in manager.rooms
+        assert manager.room_of("b") is None and manager.room_of("h") is played
+        stats = manager.reaper.stats
+        assert (stats.reclaimed_rooms, stats.evicted_rooms, stats.rejected_rooms) == (2, 1, 1)
+        await asyncio.sleep(0)
+        assert ("room_closed", busy.room_id, {"room_id": busy.room_id, "reason": "idle"}) in fake_sio
+
+    asyncio.run(scenario())
+
+
+def test_cluster_routes_rooms_and_relays_emits_between_workers():
+    import asyncio
+    import socketio
+    from cluster import ClusterConfig, MemoryManager, shard_of
+    from server import RoomManager
+
+    urls = ("http://w0", "http://w1", "http://w2")
+    workers = [ClusterConfig(i, urls) for i in range(3)]
+    for cfg in workers:
+        manager = RoomManager(id_seed=1, cluster=cfg)
+        ids = [manager.new_room().room_id for _ in range(50)]
+        assert all(shard_of(rid, 3) == cfg.index for rid in ids)   # 自分の持ち分のIDだけ使う
+        assert {w.owns(ids[0]) for w in workers} == {True, False}
+        assert workers[0].url_for(ids[0]) == urls[cfg.index]
+
+    async def scenario():
+        servers = [socketio.AsyncServer(async_mode="asgi", client_manager=MemoryManager("memory://test-cluster"))
+                   for _ in range(2)]
+        delivered, published = [], []
+        for i, s in enumerate(servers):
+            s.manager.set_server(s)
+            s.manager.initialize()
+
+            async def send(eio_sid, pkt, i=i):
+                delivered.append((i, eio_sid))
+            s._send_eio_packet = send
+        publish = servers[0].manager._publish
+
+        async def spy(data):
+            published.append(data["event"])
+            await publish(data)
+        servers[0].manager._publish = spy
+        local = await servers[0].manager.connect("eio-0", "/")
+        remote = await servers[1].manager.connect("eio-1", "/")
+        await servers[0].emit("state", {"v": 1}, to=local)    # このワーカーの sid だけ: キューに流さない
+        await servers[0].emit("state", {"v": 2}, to=remote)   # 他のワーカーの sid: キュー越しに届く
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert sorted(delivered) == [(0, "eio-0"), (1, "eio-1")] and published == ["state"]
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_roundtrip_and_reattach(monkeypatch, tmp_path, fake_sio):
+    import asyncio
+    import os
+    import snapshot
+    import server
+    from chatlog import ChatHistory
+
+    room, dealer, child = _make_room(["7萬", "2筒"], ["東"])
+    room.state.shuffle_wall(42)
+    room.state.wall.pop()
+    room.state.results = {"id": 3, "pairs": {1: {"outcome": "push"}}}
+    room.settlement_seq = 3
+    room.chat_log = ChatHistory()
+    room.chat_log.append({"name": "Child", "message": "hi"})
+    room.players_by_sid["b"] = Player(sid="b", name="BOT", seat_index=2, is_bot=True)
+    room.seat_to_sid[2] = "b"
+
+    path = str(tmp_path / "rooms.snapshot")
+    captured = snapshot.capture([room])
+    snapshot.save(path, captured, [("tok-d", "TEST", "d")])
+    (restored,), sessions = snapshot.load(path)
+    assert sessions == [("tok-d", "TEST", "d")]
+    assert snapshot.capture([restored]) == captured
+    assert restored.state.wall.counts == room.state.wall.counts and len(restored.state.wall) == len(room.state.wall)
+    assert restored.state.dora_weights == room.state.dora_weights
+    assert restored.players_by_sid["d"].hand.signature() == dealer.hand.signature()
+    assert restored.chat_log.recent() == room.chat_log.recent() and restored.chat_log.seq == 1
+    assert [p.name for p in os.scandir(tmp_path)] == ["rooms.snapshot"]   # 一時ファイルは残らない
+
+    # フィールドが増減した後の読み込み: 無いフィールドは既定値、知らないフィールドは捨てる
+    schema = dict(snapshot._SCHEMA, player=snapshot._PLAYER_FIELDS[:-1] + ("retired",))
+    (older,) = [snapshot.restore_room(d, schema) for d in captured]
+    assert older.players_by_sid["b"].is_bot is False and older.players_by_sid["d"].points == 300
+
+    monkeypatch.setattr(server, "_schedule_bots", lambda room: None)
+    manager = server.RoomManager()
+    monkeypatch.setattr(server, "manager", manager)
+
+    async def reattach():
+        assert manager.adopt(restored, {sid: token for token, _, sid in sessions})
+        # token の無い席は空く。token のある席は繋ぎ直すまで索引に無いまま預かる
+        assert "c" not in restored.players_by_sid and restored.seat_to_sid[1] is None
+        assert manager.room_of("d") is None and manager.sessions.holds("d")
+        # 同じ名前で参加しても親の席には戻れない（空いた席に新しく座る）
+        assert (await server.join_room("x", {"room_id": "TEST", "name": "Dealer"}))["ok"]
+        assert restored.players_by_sid["x"].seat_index == 1 and restored.seat_to_sid[0] == "d"
+        assert (await server.resume("d2", {"token": "guess"}))["ok"] is False
+        assert (await server.resume("d2", {"token": "tok-d"}))["ok"]
+        assert manager.room_of("d2") is restored and restored.seat_to_sid[0] == "d2"
+        assert "d" not in restored.players_by_sid and restored.players_by_sid["d2"].hand == dealer.hand
+
+    asyncio.run(reattach())
+
+
+def test_event_log_replays_rooms_to_any_sequence_number(monkeypatch, tmp_path, fake_sio):
+    import asyncio
+    import copy
+    import random
+    import eventlog
+    import server
+    import snapshot
+    from engine import _bot_step_locked, _start_next_round_locked, drain_effects, hand_total
+
+    monkeypatch.setattr(server, "_schedule_bots", lambda room: None)
+    log = eventlog.EventLog(str(tmp_path), name="w0.evlog")
+    manager = server.RoomManager(id_seed=1, events=log)
+    monkeypatch.setattr(server, "manager", manager)
+    settlements = []
+
+    async def play():
+        rid = (await server.create_room("h1", {"name": "A"}))["room_id"]
+        room = manager.get_room(rid)
+        room.rng = random.Random(3)   # 山の seed は記録から読むが、遊び方（引く・止まる）を毎回同じにする
+        await server.join_room("h2", {"room_id": rid, "name": "B"})
+        await server.add_bot("h1", {})
+        await server.set_initial_points("h2", {"points": 5000})
+        assert (await server.start_game("h1", {}))["ok"]
+        for step in range(400):
+            st = room.state
+            if len(settlements) == 3 and "h2" in room.players_by_sid:
+                # 途中で抜けた席に別の人が座り、繋ぎ直しで sid も変わる
+                await server.leave_room("h2", {})
+                await server.join_room("h3", {"room_id": rid, "name": "C"})
+                async with room.lock:
+                    manager.rebind_locked(room, room.players_by_sid["h3"], "h3b")
+            elif st.phase == "reset_prompt" and not room.players_by_sid[room.seat_to_sid[st.dealer_seat]].is_bot:
+                await server.dealer_reset(room.seat_to_sid[st.dealer_seat], {"reset": step % 3 == 0})
+            elif st.phase == "ended":
+                async with room.lock:
+                    drain_effects(room)
+                    _start_next_round_locked(room)
+            else:
+                sid = room.seat_to_sid.get(st.turn_seat) if st.phase == "playing" else None
+                p = room.players_by_sid.get(sid) if sid else None
+                if p is not None and not p.is_bot:
+                    await (server.draw_tile if hand_total(p.hand) < 7 else server.stay)(sid, {})
+                elif st.phase == "betting" and any(p.bet_points is None and not p.is_bot
+                                                   and p.seat_index != st.dealer_seat for p in room.players()):
+                    for p in room.players():
+                        if not p.is_bot and p.bet_points is None and p.seat_index != st.dealer_seat:
+                            await server.set_bet_points(p.sid, {"bet": 3 + step % 5})
+                else:
+                    async with room.lock:
+                        _bot_step_locked(room)
+            if room.state.phase == "ended" and (not settlements or settlements[-1][1]["id"] != room.state.results["id"]):
+                settlements.append((room.event_seq, copy.deepcopy(room.state.results)))
+            if len(settlements) >= 8:
+                break
+        return room
+
+    room = asyncio.run(play())
+    assert len(settlements) >= 8
+    log.write(log.take())
+    log.write(eventlog.encode_event(room.room_id, 10**6, 0.0, eventlog.EV_DRAW, 1, 0)[:-3])   # 書きかけの末尾
+    log.close()
+
+    history = eventlog.load_history(eventlog.read_events(str(tmp_path)))[room.room_id]
+    assert [e.seq for e in history] == list(range(1, room.event_seq + 1))
+    assert history[0].op == eventlog.EV_CHECKPOINT and any(e.op == eventlog.EV_REBIND for e in history)
+
+    def comparable(r):
+        attrs, seats, players, state, wall, _ = snapshot.capture_room(r)
+        return attrs[:4] + attrs[5:], seats, sorted(players), state, wall
+
+    assert comparable(eventlog.replay(history)) == comparable(room)
+    for seq, results in settlements:
+        assert eventlog.replay(history, upto=seq).state.results == results
+    # 引数を変えると食い違いとして返る（ルール変更の確かめ方）
+    bet = next(e for e in history if e.op == eventlog.EV_BET)
+    steps = list(eventlog.replay_steps(history[:history.index(bet)] + [bet._replace(seat=3)]))
+    assert steps[-1][2] == "no player at seat 3"
+
+
+def test_event_log_rotates_prunes_and_survives_write_errors(monkeypatch, tmp_path, fake_sio):
+    import asyncio
+    import os
+    import eventlog
+    import server
+
+    monkeypatch.setattr(server, "_schedule_bots", lambda room: None)
+    log = eventlog.EventLog(str(tmp_path), segment_bytes=2000, retain_bytes=8000)
+    manager = server.RoomManager(id_seed=1, events=log)
+    monkeypatch.setattr(server, "manager", manager)
+    monkeypatch.setattr(server, "EVENT_LOG", log)
+
+    def history():
+        return eventlog.load_history(eventlog.read_events(str(tmp_path)))[room.room_id]
+
+    async def scenario():
+        nonlocal room
+        room = manager.get_room((await server.create_room("a", {"name": "A"}))["room_id"])
+        await server.set_initial_points("a", {"points": 100})
+
+        # 書けなかった分はバッファに戻り、書きかけは切り詰めて次は新しいセグメントに書く
+        first = log.path
+
+        def full_disk(fd):
+            raise OSError("No space left on device")
+
+        with monkeypatch.context() as m:
+            m.setattr(eventlog.os, "fsync", full_disk)
+            with pytest.raises(OSError):
+                await server.flush_event_log()
+        assert log.path != first and log.write_errors == 1 and log.buffer
+        assert list(eventlog.read_events(first)) == []
+        await server.flush_event_log()
+        assert [e.seq for e in history()] == list(range(1, room.event_seq + 1))
+
+        # 大きさでセグメントを移り、古いものは消える。残ったセグメントだけで今の卓まで再生できる
+        for i in range(300):
+            await server.set_initial_points("a", {"points": 100 + i})
+            if i % 10 == 9:
+                await server.flush_event_log()
+        await server.flush_event_log()
+        segments = eventlog.segment_paths(str(tmp_path))
+        assert log.pruned > 0 and sum(os.path.getsize(p) for p in segments) <= 8000 + 2 * 2000
+        replayed = eventlog.replay(history())
+        assert replayed.event_seq == room.event_seq and replayed.players_by_sid["a"].initial_points == 399
+
+    room = None
+    asyncio.run(scenario())
+
+
+def test_draw_from_an_empty_wall_is_accepted_and_replays_cleanly():
+    from engine import EV_DRAW, RoundSettled, drain_effects
+    from eventlog import Event, apply_event
+
+    room, dealer, child = _make_room(["7萬", "2筒"], ["東"])
+    room.event_seq = 4
+    assert apply_event(room, Event("TEST", 5, 0.0, EV_DRAW, 0, 0, b"")) is None
+    assert room.event_seq == 5 and room.state.phase == "ended"
+    assert [type(e) for e in drain_effects(room)] == [RoundSettled]
+
+
+def test_reconnect_token_holds_seat_and_catches_up(monkeypatch, fake_sio):
+    import asyncio
+    import server
+    from sessions import SessionTable
+
+    sent = fake_sio
+    manager = server.RoomManager()
+    manager.sessions = SessionTable(grace=5.0)
+    monkeypatch.setattr(server, "manager", manager)
+
+    async def scenario():
+        rid = (await server.create_room("a", {"name": "A"}))["room_id"]
+        token = (await server.join_room("b", {"room_id": rid, "name": "B"}))["token"]
+        room = manager.get_room(rid)
+        await asyncio.sleep(0.01)
+        version = room.state_version
+        await server.state_ack("b", {"version": version})
+        chat_id = room.chat_log.seq
+
+        # 切断: 席・host はそのまま、誰にも何も送らない
+        sent.clear()
+        await server.disconnect("b")
+        await asyncio.sleep(0.01)
+        assert sent == [] and manager.sessions.holds("b") and room.seat_to_sid[1] == "b"
+        await server.set_initial_points("a", {"points": 500})
+        await server.chat("a", {"message": "hi"})
+        await asyncio.sleep(0.01)
+        assert all(to != "b" for _, to, _ in sent)   # 切断中の人には送らない
+
+        # 戻る: 同じ席、ack 済みの state からのパッチ1回と取りこぼしたチャットだけ
+        sent.clear()
+        ack = await server.resume("b2", {"token": token, "version": version, "chat_id": chat_id})
+        assert ack == {"ok": True, "room_id": rid, "token": token}
+        assert room.seat_to_sid[1] == "b2" and room.players_by_sid["b2"].name == "B" and manager.room_of("b2") is room
+        assert manager.room_of("b") is None and not manager.sessions.holds("b2")
+        (event, to, patch), (history, _, chats) = sent
+        assert (event, to, patch["base"], history) == ("state_patch", "b2", version, "chat_history")
+        assert [m["message"] for m in chats["messages"]] == ["hi"] and chats["after"] == chat_id
+        assert manager.sessions.stats.resumed == 1
+
+        # 期限切れ: 普通の退室になり、token も使えなくなる
+        manager.sessions.grace = 0.01
+        await server.disconnect("b2")
+        await asyncio.sleep(0.05)
+        assert room.seat_to_sid[1] is None and manager.room_of("b2") is None
+        assert (await server.resume("b3", {"token": token}))["ok"] is False
+        assert manager.sessions.stats.expired == 1 and token not in manager.sessions.by_token
+
+    asyncio.run(scenario())
+
+
+def test_bot_scheduler_batches_due_rooms_with_per_room_pacing():
+    import asyncio
+    from bot_scheduler import BotScheduler
+
+    async def scenario():
+        calls = []
+        pace = {"fast": 0.01, "slow": 0.05}
+        left = {"fast": 4, "slow": 2, "once": 1}
+
+        async def step(room_id):
+            calls.append(room_id)
+            left[room_id] -= 1
+            return pace.get(room_id) if left[room_id] else None
+
+        sched = BotScheduler(step, batch=2)
+        for rid in ("slow", "fast", "once"):
+            sched.schedule(rid)
+        sched.schedule("fast")   # 積んであれば何もしない
+        assert len(sched) == 3
+        await asyncio.sleep(0.2)
+        # 最初の起床で3ルームをまとめて動かし、その後はルームごとの間隔で
+        assert calls[:3] == ["slow", "fast", "once"]
+        assert calls.count("fast") == 4 and calls.count("slow") == 2 and calls.count("once") == 1
+        assert len(sched) == 0 and sched.timer is None
+        assert calls.index("slow", 1) > calls.index("fast", 1)
+
+        st = sched.stats.as_dict()
+        assert st["steps"] == 7 and st["wakeups"] < 7 and st["rooms_per_wakeup"] > 1
+        assert 0 <= st["lag_p50_ms"] <= st["lag_max_ms"]
+
+        # cancel したルームは動かさない
+        sched.schedule("gone", 0.01)
+        sched.cancel("gone")
+        await asyncio.sleep(0.03)
+        assert "gone" not in calls and sched.stats.steps == 7
+
+    asyncio.run(scenario())
+
+
+def test_bot_scheduler_keeps_the_pause_when_rescheduled_mid_step():
+    import asyncio
+    from bot_scheduler import BotScheduler
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        times = []
+
+        async def step(room_id):
+            times.append(loop.time())
+            await asyncio.sleep(0)
+            if len(times) <= 3:
+                sched.schedule(room_id)   # step の最中に人間が操作した
+            return 0.05 if len(times) < 3 else None
+
+        sched = BotScheduler(step)
+        sched.schedule("R")
+        await asyncio.sleep(0.3)
+        # 3手目は None を返したが、その最中の schedule でもう1回動く。BOT の手の間は step が返した 0.05 秒空く
+        assert len(times) == 4
+        assert all(b - a >= 0.05 for a, b in zip(times, times[1:3]))
+
+    asyncio.run(scenario())
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+牌の整数エンコーディング
+------------------------
+サーバ内部では牌を 0–33 の整数 ID で扱い、表示用ラベル（"5萬" など）への
+変換はクライアントへ送る直前にだけ行う。
+
+    0–8   : 1萬–9萬
+    9–17  : 1筒–9筒
+    18–26 : 1索–9索
+    27–33 : 東 南 西 北 白 發 中
+
+赤5は現在の牌セットに含まれないため ID を割り当てていない。
+各テーブルは ID をそのまま添字にして引く。
+"""
+
+from __future__ import annotations
+import random
+from array import array
+from typing import Iterable, List, Optional
+
+SUITS = ["萬", "筒", "索"]
+HONOR_LABELS = ["東", "南", "西", "北", "白", "發", "中"]
+
+NUM_TILE_TYPES = 34
+COPIES_PER_TILE = 4
+EAST = 27  # 東
+
+TILE_LABELS: List[str] = [f"{num}{kanji}" for kanji in SUITS for num in range(1, 10)] + HONOR_LABELS
+LABEL_TO_TILE = {label: i for i, label in enumerate(TILE_LABELS)}
+
+# 数牌の数字（字牌は 0）
+TILE_NUMBER: List[int] = [i % 9 + 1 if i < 27 else 0 for i in range(NUM_TILE_TYPES)]
+# スート（0:萬 1:筒 2:索 3:字牌）
+TILE_SUIT: List[int] = [i // 9 for i in range(NUM_TILE_TYPES)]
+IS_HONOR: List[bool] = [i >= 27 for i in range(NUM_TILE_TYPES)]
+# 点数: 数牌は数字、字牌は 0.5
+TILE_VALUE: List[float] = [float(n) if n else 0.5 for n in TILE_NUMBER]
+# 点数の2倍（整数で足し合わせるため）
+TILE_HALF: List[int] = [2 * n if n else 1 for n in TILE_NUMBER]
+# ツモ判定用の「頭文字」: 数牌は数字、字牌は牌ごとに固有
+TILE_RANK: List[int] = [n if n else 10 + i for i, n in enumerate(TILE_NUMBER)]
+
+# ドラ区分: 0–8 は数字 1–9、9 は風牌（東南西北）、10 は三元牌（白發中）
+NUM_DORA_CLASSES = 11
+DORA_CLASS: List[int] = [n - 1 if n else (9 if i < 31 else 10) for i, n in enumerate(TILE_NUMBER)]
+# ドラ表示牌が指す区分: 数牌は次の数字（9 → 1）、字牌は同じ区分
+DORA_NEXT: List[int] = [n % 9 if n else DORA_CLASS[i] for i, n in enumerate(TILE_NUMBER)]
+
+# 136枚の標準セット（花牌なし）。シャッフル前のテンプレート
+STANDARD_TILES = tuple(t for t in range(NUM_TILE_TYPES) for _ in range(COPIES_PER_TILE))
+# 山の先頭から取り除くドラ表示牌の枚数
+DORA_DISPLAY_COUNT = 34
+
+
+def tile_label(tile: int) -> str:
+    return TILE_LABELS[tile]
+
+
+def tile_from_label(label: str) -> int:
+    return LABEL_TO_TILE[label.strip()]
+
+
+def tiles_from_labels(labels: Iterable[str]) -> List[int]:
+    return [LABEL_TO_TILE[s.strip()] for s in labels]
+
+
+def tile_labels(tiles: Iterable[int]) -> List[str]:
+    return [TILE_LABELS[t] for t in tiles]
+
+
+def compile_dora_weights(dora: Iterable[int]) -> List[int]:
+    """ドラ表示牌から牌IDごとのドラ点（長さ34）を作る。山の生成ごとに1回だけ呼ぶ。"""
+    if not dora:
+        return [0] * NUM_TILE_TYPES
+    class_points = [0] * NUM_DORA_CLASSES
+    for t in dora:
+        class_points[DORA_NEXT[t]] += 1
+    return [class_points[DORA_CLASS[t]] for t in range(NUM_TILE_TYPES)]
+
+
+class Wall:
+    """山。牌IDの array（1牌1バイト）と読み出し位置、牌種ごとの残り枚数（長さ34）を持つ。
+
+    buf[:start] はドラ表示牌、buf[start:cursor] が残りの山で末尾（cursor 側）から引く。
+    引いても buf は縮めず cursor を下げるだけ。shuffled / reshuffle で作った山は
+    seed から同じ並びを再現できる（デバッグ・リプレイ用。クライアントには送らない）。
+    """
+
+    __slots__ = ("buf", "start", "cursor", "counts", "seed")
+
+    def __init__(self, tiles: Iterable[int] = ()) -> None:
+        self.buf = array("b", tiles)
+        self.start = 0
+        self.cursor = len(self.buf)
+        self.seed: Optional[int] = None
+        self.counts: List[int] = [0] * NUM_TILE_TYPES
+        for t in self.buf:
+            self.counts[t] += 1
+
+    @classmethod
+    def shuffled(cls, seed: int, dora_count: int = DORA_DISPLAY_COUNT) -> "Wall":
+        wall = cls()
+        wall.reshuffle(seed, dora_count)
+        return wall
+
+    def reshuffle(self, seed: int, dora_count: int = DORA_DISPLAY_COUNT) -> None:
+        """標準セットを seed でシャッフルし直す（バッファは使い回す）"""
+        # list のシャッフルの方が array より速いので、並びを作ってから1回でコピーする
+        order = list(STANDARD_TILES)
+        random.Random(seed).shuffle(order)
+        if len(self.buf) == len(order):
+            self.buf[:] = array("b", order)
+        else:
+            self.buf = array("b", order)
+        self.seed = seed
+        self.start = dora_count
+        self.cursor = len(self.buf)
+        counts = [COPIES_PER_TILE] * NUM_TILE_TYPES
+        for t in self.buf[:dora_count]:
+            counts[t] -= 1
+        self.counts = counts
+
+    @classmethod
+    def restore(cls, buf: bytes, start: int, cursor: int, seed: Optional[int],
+                counts: Optional[List[int]] = None) -> "Wall":
+        """保存したバッファと読み出し位置から作り直す（snapshot.py）。counts が無ければ buf[start:cursor] から数える"""
+        wall = cls.__new__(cls)
+        wall.buf = array("b", buf)
+        wall.start = start
+        wall.cursor = cursor
+        wall.seed = seed
+        if counts is None:
+            rest = buf[start:cursor]
+            counts = [rest.count(t) for t in range(NUM_TILE_TYPES)]
+        wall.counts = list(counts)
+        return wall
+
+    def dora(self) -> List[int]:
+        return self.buf[:self.start].tolist()
+
+    def pop(self) -> int:
+        if self.cursor <= self.start:
+            raise IndexError("pop from empty wall")
+        self.cursor -= 1
+        t = self.buf[self.cursor]
+        self.counts[t] -= 1
+        return t
+
+    def __len__(self) -> int:
+        return self.cursor - self.start
+
+    def __iter__(self):
+        return iter(self.buf[self.start:self.cursor])
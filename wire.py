@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Socket.IO の直列化
+------------------
+環境変数 TOPPAN_SIO_SERIALIZER で切り替える:
+
+    auto     orjson が入っていれば orjson、無ければ標準 json（既定）
+    json     標準 json（python-socketio の既定）
+    orjson   orjson。テキスト JSON のままなので client.js はそのまま読める
+    msgpack  バイナリパケット（python-socketio の MsgPackPacket）。
+             client.js は /api/wire を見て static/msgpack_parser.js をパーサに使う
+
+ブロードキャストの使い回し（同じパケットを受け取る人はまとめて1回だけエンコードする）は
+server.py の emit_room_state 側で行う。bench/wire.py で各方式のエンコード時間とバイト数を比べられる。
+"""
+
+from __future__ import annotations
+import importlib.util
+import os
+from typing import Any, Dict, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson はオプション
+    orjson = None
+
+SERIALIZERS = ("auto", "json", "orjson", "msgpack")
+
+
+class OrjsonCodec:
+    """python-socketio / python-engineio の json= に渡せる dumps/loads（標準 json と同じ呼び方）"""
+
+    @staticmethod
+    def dumps(obj: Any, **_kwargs: Any) -> str:
+        # 結果の席番号など int キーの dict があるので OPT_NON_STR_KEYS（標準 json と同じく文字列化）
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    @staticmethod
+    def loads(s: Any, **_kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+def resolve_serializer(name: Optional[str] = None) -> str:
+    """設定名を実際に使う方式（json / orjson / msgpack）に解決する"""
+    name = (name or os.environ.get("TOPPAN_SIO_SERIALIZER") or "auto").lower()
+    if name not in SERIALIZERS:
+        raise ValueError(f"unknown serializer {name!r} (choose from {', '.join(SERIALIZERS)})")
+    if name == "auto":
+        return "orjson" if orjson is not None else "json"
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("TOPPAN_SIO_SERIALIZER=orjson requires the orjson package")
+    if name == "msgpack":
+        if importlib.util.find_spec("msgpack") is None:
+            raise RuntimeError("TOPPAN_SIO_SERIALIZER=msgpack requires the msgpack package")
+    return name
+
+
+def server_options(serializer: str) -> Dict[str, Any]:
+    """socketio.AsyncServer に渡すキーワード引数"""
+    if serializer == "orjson":
+        return {"json": OrjsonCodec}
+    if serializer == "msgpack":
+        return {"serializer": "msgpack"}
+    return {}
+